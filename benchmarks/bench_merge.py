@@ -0,0 +1,72 @@
+"""
+Throughput and peak python memory of utils.merge_files against reading each part into memory and writing it.
+
+usage: python benchmarks/bench_merge.py [size_mb] [parts] [dir]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import aiofiles
+import bilix.utils
+from bilix.utils import merge_files
+
+
+async def merge_files_read(file_list, new_path: Path):
+    # the previous implementation
+    first_file = file_list[0]
+    async with aiofiles.open(first_file, 'ab') as f:
+        for idx in range(1, len(file_list)):
+            async with aiofiles.open(file_list[idx], 'rb') as fa:
+                await f.write(await fa.read())
+            os.remove(file_list[idx])
+    os.rename(first_file, new_path)
+
+
+def make_parts(tmp: Path, size: int, parts: int):
+    block = os.urandom(1024 * 1024)
+    file_list = []
+    for i in range(parts):
+        file = tmp / f'part-{i}'
+        with open(file, 'wb') as f:
+            for _ in range(size // parts // len(block)):
+                f.write(block)
+        file_list.append(file)
+    return file_list
+
+
+async def run(merge, size: int, parts: int, tmp: Path, trace: bool):
+    file_list = make_parts(tmp, size, parts)
+    os.sync()
+    if trace:
+        tracemalloc.start()
+    a = time.perf_counter()
+    await merge(file_list, tmp / 'merged')
+    cost = time.perf_counter() - a
+    peak = tracemalloc.get_traced_memory()[1] if trace else 0
+    tracemalloc.stop()
+    os.remove(tmp / 'merged')
+    return cost, peak
+
+
+async def main():
+    size = (int(sys.argv[1]) if len(sys.argv) > 1 else 1024) * 1024 * 1024
+    parts = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory(dir=sys.argv[3] if len(sys.argv) > 3 else None) as tmp:
+        tmp = Path(tmp)
+        print(f"{size >> 20}MB in {parts} parts at {tmp}")
+        cases = [('read + write', merge_files_read, None), ('merge_files', merge_files, set()),
+                 ('chunked fallback', merge_files, {'reflink', 'copy_file_range', 'sendfile'})]
+        for name, merge, unsupported in cases:
+            if unsupported is not None:
+                bilix.utils._unsupported_copy = set(unsupported)
+            cost, _ = await run(merge, size, parts, tmp, trace=False)
+            _, peak = await run(merge, size, parts, tmp, trace=True)
+            print(f"{name:>16}: {size / cost / 1024 ** 3:.2f}GB/s, peak python memory {peak / 1024 ** 2:.1f}MB")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""
+CPU time of progress accounting per GB downloaded, per-chunk update vs batched advance.
+
+usage: python benchmarks/bench_progress.py [chunk_size] [streams]
+"""
+import asyncio
+import sys
+import time
+from bilix.progress import CLIProgress
+
+GB = 1024 ** 3
+
+
+async def run(batched: bool, chunk_size: int, streams: int) -> float:
+    progress = CLIProgress()
+    task_id = await progress.add_task(description='bench', total=GB)
+
+    async def stream(size: int):
+        for _ in range(size // chunk_size):
+            if batched:
+                await progress.advance(task_id, chunk_size)
+            else:
+                await progress.update(task_id, advance=chunk_size)
+        if batched:
+            await progress.flush(task_id)
+
+    a = time.process_time()
+    await asyncio.gather(*[stream(GB // streams) for _ in range(streams)])
+    cost = time.process_time() - a
+    assert progress.tasks[task_id].completed == GB // streams // chunk_size * chunk_size * streams
+    await progress.update(task_id, visible=False)
+    return cost
+
+
+async def main():
+    chunk_size = int(sys.argv[1]) if len(sys.argv) > 1 else 16 * 1024
+    streams = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    before = await run(False, chunk_size, streams)
+    after = await run(True, chunk_size, streams)
+    print(f"chunk {chunk_size}B, {streams} streams, CPU seconds per GB: "
+          f"update {before:.3f}, advance {after:.3f}, {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
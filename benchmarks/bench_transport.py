@@ -0,0 +1,173 @@
+"""
+Download time of BaseDownloaderPart transport strategies over an emulated long-haul link.
+
+The link adds RTT to every connection and caps each of them at WINDOW/RTT, like a TCP connection stuck at one
+congestion window. The origin speaks HTTP/1.1 and cleartext HTTP/2 (prior knowledge).
+
+usage: python benchmarks/bench_transport.py [rtt_ms] [window_kb]
+"""
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+import h11
+import h2.config
+import h2.connection
+import h2.events
+from bilix.client_pool import client_registry
+from bilix.download import BaseDownloaderPart
+
+DATA = os.urandom(8 * 1024 * 1024)
+H2_PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+def range_response(range_header: str):
+    start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header).groups()
+    start, end = int(start), min(int(end) if end else len(DATA) - 1, len(DATA) - 1)
+    headers = [('content-range', f'bytes {start}-{end}/{len(DATA)}'), ('content-length', str(end - start + 1))]
+    return headers, DATA[start:end + 1]
+
+
+async def serve_h11(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes):
+    conn = h11.Connection(h11.SERVER)
+    conn.receive_data(data)
+    while True:
+        event = conn.next_event()
+        if event is h11.NEED_DATA:
+            if not (data := await reader.read(65536)):
+                return
+            conn.receive_data(data)
+        elif isinstance(event, h11.Request):
+            headers, body = range_response(dict(event.headers)[b'range'].decode())
+            writer.write(conn.send(h11.Response(status_code=206, headers=headers)))
+            writer.write(conn.send(h11.Data(data=body)))
+            writer.write(conn.send(h11.EndOfMessage()))
+            await writer.drain()
+        elif isinstance(event, h11.EndOfMessage):
+            conn.start_next_cycle()
+        elif isinstance(event, h11.ConnectionClosed):
+            return
+
+
+async def serve_h2(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes):
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+    conn.initiate_connection()
+    pending = {}  # stream id -> data to send
+    wake = asyncio.Event()
+
+    async def read_loop(data: bytes):
+        while data:
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    headers, body = range_response(dict(event.headers)[b'range'].decode())
+                    conn.send_headers(event.stream_id, [(':status', '206'), *headers])
+                    pending[event.stream_id] = body
+                elif isinstance(event, h2.events.StreamReset):
+                    pending.pop(event.stream_id, None)
+            writer.write(conn.data_to_send())
+            wake.set()
+            data = await reader.read(65536)
+
+    read_task = asyncio.create_task(read_loop(data))
+    # send a frame of each stream in turn and wait for the link, so resets are seen in time
+    while not read_task.done():
+        sent = False
+        for stream_id, body in list(pending.items()):
+            size = min(len(body), conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size)
+            if size > 0:
+                conn.send_data(stream_id, body[:size])
+                pending[stream_id] = body = body[size:]
+                sent = True
+            if not body:
+                conn.end_stream(stream_id)
+                del pending[stream_id]
+        if sent:
+            writer.write(conn.data_to_send())
+            await writer.drain()
+        else:
+            wake.clear()
+            wake_task = asyncio.create_task(wake.wait())
+            await asyncio.wait([read_task, wake_task], return_when=asyncio.FIRST_COMPLETED)
+            wake_task.cancel()
+    await read_task
+
+
+async def origin(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    data = await reader.read(65536)
+    try:
+        await (serve_h2 if data.startswith(H2_PREFACE) else serve_h11)(reader, writer, data)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+def link(origin_port: int, rtt: float, window: int):
+    async def relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, rate: float = None):
+        queue = asyncio.Queue()
+        send_time = 0.
+
+        async def deliver():
+            while (item := await queue.get()) is not None:
+                t, data = item
+                await asyncio.sleep(t - time.monotonic())
+                writer.write(data)
+                await writer.drain()
+            writer.close()
+
+        task = asyncio.create_task(deliver())
+        try:
+            while data := await reader.read(16 * 1024):
+                now = time.monotonic()
+                if rate:  # one congestion window per rtt
+                    send_time = max(send_time, now) + len(data) / rate
+                    await asyncio.sleep(send_time - now)
+                queue.put_nowait((time.monotonic() + rtt / 2, data))
+        except ConnectionError:
+            pass
+        queue.put_nowait(None)
+        await task
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        o_reader, o_writer = await asyncio.open_connection('127.0.0.1', origin_port)
+        try:
+            await asyncio.gather(relay(reader, o_writer), relay(o_reader, writer, rate=window / rtt),
+                                 return_exceptions=True)
+        except asyncio.CancelledError:  # shutdown
+            pass
+
+    return handle
+
+
+async def download(port: int, strategy: str, http2: bool) -> float:
+    client = client_registry.client(http1=not http2, http2=http2)
+    d = BaseDownloaderPart(client=client, part_concurrency=8, transport_strategy=strategy, media_connections=4)
+    with tempfile.TemporaryDirectory() as tmp:
+        async with d:
+            a = time.monotonic()
+            path = await d.get_file(f'http://127.0.0.1:{port}/media.mp4', path=Path(tmp))
+            cost = time.monotonic() - a
+        assert path.read_bytes() == DATA
+    return cost
+
+
+async def main():
+    rtt = (int(sys.argv[1]) if len(sys.argv) > 1 else 50) / 1000
+    window = (int(sys.argv[2]) if len(sys.argv) > 2 else 128) * 1024
+    origin_server = await asyncio.start_server(origin, '127.0.0.1', 0)
+    link_server = await asyncio.start_server(link(origin_server.sockets[0].getsockname()[1], rtt, window),
+                                             '127.0.0.1', 0)
+    port = link_server.sockets[0].getsockname()[1]
+    print(f"{len(DATA) >> 20}MB, 8 parts, rtt {rtt * 1000:.0f}ms, {window >> 10}KB window per connection")
+    for strategy, http2 in [('shared', True), ('http2', True), ('http1', False)]:
+        cost = await download(port, strategy, http2)
+        print(f"{strategy:>6} ({'h2' if http2 else 'http/1.1'}): {cost:.2f}s, {len(DATA) / cost / 1024 ** 2:.2f}MB/s")
+    link_server.close()
+    origin_server.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Resolution throughput, metadata bytes and parse cpu of api.bilibili.get_video_info_api (view and playurl json) against
+get_video_info_html (scraping the video page).
+
+Without urls a synthetic page is served locally, it is padded to page_kb like the inline scripts and styles of a real
+page. With urls the real site is requested.
+
+usage: python benchmarks/bench_video_info.py [page_kb] [n]
+       python benchmarks/bench_video_info.py url [url ...]
+"""
+import asyncio
+import json
+import sys
+import time
+import httpx
+import bilix.api.bilibili as api
+
+PLAY_INFO = {'code': 0, 'data': {
+    'support_formats': [{'quality': q, 'new_description': d} for q, d in
+                        [(120, '4K 超清'), (116, '1080P 60帧'), (80, '1080P 高清'), (64, '720P 高清'), (32, '480P 清晰')]],
+    'dash': {
+        'duration': 600,
+        'video': [{'id': q, 'base_url': f'https://upos-sz-mirrorcos.bilivideo.com/{q}-{c}.m4s?e=' + 'x' * 400,
+                   'backup_url': [f'https://upos-sz-mirrorcoso1.bilivideo.com/{q}-{c}.m4s?e=' + 'x' * 400],
+                   'codecs': c, 'width': 1920, 'height': 1080, 'segment_base': {'initialization': '0-1000'}}
+                  for q in (120, 116, 80, 64, 32) for c in ('avc1.640032', 'hev1.1.6.L150.90', 'av01.0.08M.08')],
+        'audio': [{'id': 30280, 'base_url': 'https://upos-sz-mirrorcos.bilivideo.com/a.m4s?e=' + 'x' * 400,
+                   'backup_url': [], 'codecs': 'mp4a.40.2'}],
+        'dolby': {'type': 0, 'audio': None}, 'flac': None,
+    }}}
+VIEW = {'code': 0, 'data': {
+    'bvid': 'BV1jK4y1N7ST', 'aid': 2, 'title': 'title', 'pic': 'http://i0.hdslb.com/cover.jpg', 'desc': 'd' * 500,
+    'stat': {'view': 1, 'danmaku': 2, 'reply': 3, 'favorite': 4, 'coin': 5, 'share': 6, 'like': 7},
+    'pages': [{'cid': 10 + i, 'page': i + 1, 'part': f'part {i}'} for i in range(20)]}}
+
+
+def page(page_kb: int) -> str:
+    init_info = {'videoData': VIEW['data'], 'bvid': VIEW['data']['bvid'], 'aid': 2,
+                 'cidMap': {VIEW['data']['bvid']: {'cids': {'1': 10}}},
+                 'related': [{'title': f'related {i}', 'desc': 'd' * 200} for i in range(40)]}
+    html = ('<html><head><meta property="og:image" content="//i0.hdslb.com/cover.jpg@100w"></head><body>'
+            '<h1 title="title">title</h1>'
+            f'<script>window.__playinfo__={json.dumps(PLAY_INFO)}</script>'
+            f'<script>window.__INITIAL_STATE__={json.dumps(init_info)};(function(){{}})</script>')
+    pad = max(0, page_kb * 1024 - len(html.encode()))
+    return html.replace('<body>', f'<body><style>{"." * pad}</style>')
+
+
+def mock_client(page_kb: int) -> httpx.AsyncClient:
+    html = page(page_kb)
+
+    def handler(request: httpx.Request):
+        if request.url.path == '/x/web-interface/view':
+            return httpx.Response(200, json=VIEW)
+        elif request.url.path == '/x/player/playurl':
+            return httpx.Response(200, json=PLAY_INFO)
+        return httpx.Response(200, text=html)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def run(client: httpx.AsyncClient, resolve, urls, n: int):
+    received = 0
+
+    async def count(res: httpx.Response):
+        nonlocal received
+        await res.aread()
+        received += len(res.content)
+
+    client.event_hooks['response'] = [count]
+    a, cpu = time.perf_counter(), time.process_time()
+    for _ in range(n):
+        for url in urls:
+            await resolve(client, url)
+    cost, cpu = time.perf_counter() - a, time.process_time() - cpu
+    total = n * len(urls)
+    return total / cost, received / total, cpu / total
+
+
+def parse_cost(page_kb: int, n: int):
+    """cpu of parsing the responses only, without the http client"""
+    html, view, play_info = page(page_kb), json.dumps(VIEW), json.dumps(PLAY_INFO)
+    url = 'https://www.bilibili.com/video/BV1jK4y1N7ST'
+    a = time.process_time()
+    for _ in range(n):
+        api.VideoInfo.parse_html(url, html)
+    html_cpu = (time.process_time() - a) / n
+    a = time.process_time()
+    for _ in range(n):
+        api.VideoInfo.parse_view(url, json.loads(view), json.loads(play_info))
+    return html_cpu, (time.process_time() - a) / n
+
+
+async def main():
+    urls = [a for a in sys.argv[1:] if a.startswith('http')]
+    if urls:
+        client, n = httpx.AsyncClient(**api.dft_client_settings), 1
+        print(f"{len(urls)} urls from the site")
+    else:
+        page_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        client, urls = mock_client(page_kb), ['https://www.bilibili.com/video/BV1jK4y1N7ST']
+        print(f"synthetic {page_kb}KB page, {n} resolutions")
+    async with client:
+        for name, resolve in [('html', api.get_video_info_html), ('json api', api.get_video_info_api)]:
+            speed, size, cpu = await run(client, resolve, urls, n)
+            print(f"{name:>8}: {speed:.1f} videos/s, {size / 1024:.1f}KB and {cpu * 1000:.2f}ms cpu per video")
+    if not sys.argv[1:] or not sys.argv[1].startswith('http'):  # synthetic page
+        html_cpu, api_cpu = parse_cost(page_kb, n)
+        print(f"parse only: html {html_cpu * 1000:.2f}ms, json api {api_cpu * 1000:.2f}ms per video")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
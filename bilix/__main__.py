@@ -10,6 +10,7 @@ from .__version__ import __version__
 from .log import logger
 from ._handle import Handler
 from .progress import CLIProgress
+from .download.ffmpeg_pool import ffmpeg_pool
 from .utils import parse_bytes_str, s2t
 from .exception import HandleMethodError
 
@@ -165,6 +166,10 @@ def print_help():
         "-tr --time-range", '[dark_cyan]str',
         r'下载视频的时间范围，格式如 h:m:s-h:m:s 或 s-s，默认无，仅get_video时生效',
     )
+    table.add_row(
+        "--ffmpeg-workers", '[dark_cyan]int',
+        '同时运行的ffmpeg进程数（合并音视频、切片等），默认为CPU核数的一半',
+    )
     table.add_row("-h --help", '', "帮助信息")
     table.add_row("-v --version", '', "版本信息")
     table.add_row("--debug", '', "显示debug信息")
@@ -330,6 +335,12 @@ class BasedTimeRange(click.ParamType):
     'browser',
     type=str,
 )
+@click.option(
+    '--ffmpeg-workers',
+    'ffmpeg_workers',
+    type=int,
+    default=None,
+)
 @click.option(
     '--time-range',
     '-tr',
@@ -370,6 +381,8 @@ def main(**kwargs):
         if not kwargs['path'].exists():
             kwargs['path'].mkdir(parents=True)
             logger.info(f'Directory {kwargs["path"]} not exists, auto created')
+        if kwargs['ffmpeg_workers']:
+            ffmpeg_pool.workers = kwargs['ffmpeg_workers']
         executor, cor = Handler.assign(kwargs)
         loop.run_until_complete(cor)
     except HandleMethodError as e:  # method no match
@@ -9,6 +9,7 @@ from danmakuC.bilibili import parse_view
 
 from ._decorator import api
 from bilix.utils import req_retry, legal_title
+from bilix.log import logger
 from bilix.exception import APIError, APIResourceError, APIUnsupportedError
 
 dft_client_settings = {
@@ -286,9 +287,9 @@ class VideoInfo(BaseModel):
     pages: List[Page]  # [[p_name, p_url], ...]
     img_url: str
     status: Status
-    bvid: str = None
-    dash: Dash = None
-    other: List[Media] = None  # flv, mp4
+    bvid: Optional[str] = None
+    dash: Optional[Dash] = None
+    other: Optional[List[Media]] = None  # flv, mp4
 
     @staticmethod
     def parse_html(url, html: str):
@@ -336,16 +337,7 @@ class VideoInfo(BaseModel):
         except AttributeError:  # AttributeError-动画
             pass
         else:
-            try:
-                dash = Dash.from_dict(play_info)
-            except KeyError:
-                pass
-            try:
-                for i in play_info['data']['durl']:
-                    suffix = re.search(r'\.([a-zA-Z0-9]+)\?', i['url']).group(1)
-                    other.append(Media(base_url=i['url'], backup_url=i['backup_url'], suffix=suffix))
-            except KeyError:
-                pass
+            dash, other = VideoInfo.parse_play_info(play_info)
         # extract img url
         img_url = re.search('property="og:image" content="([^"]*)"', html).groups()[0]
         if not img_url.startswith('http'):  # https://github.com/HFrost0/bilix/issues/52 just for some video
@@ -355,14 +347,167 @@ class VideoInfo(BaseModel):
                                p=p, pages=pages, img_url=img_url, bvid=bvid, dash=dash, other=other)
         return video_info
 
+    @staticmethod
+    def parse_play_info(play_info: dict) -> Tuple[Optional[Dash], List[Media]]:
+        """dash and flv/mp4 medias of a playurl response (same as window.__playinfo__ of the page)"""
+        dash, other = None, []
+        try:
+            dash = Dash.from_dict(play_info)
+        except KeyError:
+            pass
+        try:
+            for i in play_info['data']['durl']:
+                suffix = re.search(r'\.([a-zA-Z0-9]+)\?', i['url']).group(1)
+                other.append(Media(base_url=i['url'], backup_url=i['backup_url'], suffix=suffix))
+        except KeyError:
+            pass
+        return dash, other
+
+    @staticmethod
+    def parse_view(url, view: dict, play_info: Optional[dict]):
+        """
+        parse the response of view api of a bv video
+
+        :param url: the video url with optional p query
+        :param view: response of x/web-interface/view
+        :param play_info: response of x/player/playurl of the chosen page, None if not available
+        :return:
+        """
+        data = view['data']
+        p = int(httpx.URL(url).params.get('p', 1)) - 1
+        pages = []
+        base_url = f"https://www.bilibili.com/video/{data['bvid']}"
+        for idx, i in enumerate(data['pages']):
+            p_url = f"{base_url}?p={idx + 1}"
+            p_name = f"P{idx + 1}-{i['part']}" if len(data['pages']) > 1 else ''
+            pages.append(Page(p_name=p_name, p_url=p_url))
+        title = legal_title(data['title'])
+        dash, other = VideoInfo.parse_play_info(play_info) if play_info else (None, [])
+        return VideoInfo(title=title, h1_title=title, aid=data['aid'], cid=data['pages'][p]['cid'],
+                         status=Status(**data['stat']), p=p, pages=pages, img_url=data['pic'],
+                         bvid=data['bvid'], dash=dash, other=other)
+
+    @staticmethod
+    def parse_season(season: dict, p: int, play_info: Optional[dict]):
+        """
+        parse the response of season api of 动漫，电视剧，电影. The season api has no og:title and h1 of the page, so
+        title and h1_title are built from season_title and show_title and may differ from parse_html
+
+        :param season: response of pgc/view/web/season
+        :param p: index of the chosen episode
+        :param play_info: response of pgc/player/web/playurl of the episode, None if not available
+        :return:
+        """
+        result = season['result']
+        episodes = result['episodes']
+        ep = episodes[p]
+        stat = result['stat']
+        status = Status(
+            view=stat['views'], danmaku=stat['danmakus'], coin=stat['coins'], like=stat['likes'],
+            reply=stat['reply'], favorite=stat['favorite'], follow=stat['favorites'], share=stat['share'],
+        )
+        pages = [Page(p_name=i['title'], p_url=i['link']) for i in episodes]
+        title = legal_title(result['season_title'])
+        h1_title = title if len(episodes) == 1 else legal_title(title, ep.get('show_title') or ep['title'])
+        # pgc playurl has result instead of data
+        dash, other = VideoInfo.parse_play_info({'data': play_info['result']}) if play_info else (None, [])
+        img_url = result['cover']
+        if not img_url.startswith('http'):
+            img_url = 'http:' + img_url
+        return VideoInfo(title=title, h1_title=h1_title, aid=ep['aid'], cid=ep['cid'], status=status, p=p,
+                         pages=pages, img_url=img_url, bvid=ep.get('bvid'), dash=dash, other=other)
+
+
+# error codes of view and season api for deleted or missing video
+RESOURCE_ERROR_CODES = (-404, 62002, 62004)
+
+
+async def _get_play_info(client: httpx.AsyncClient, api_url: str, params: dict) -> Optional[dict]:
+    res = await req_retry(client, api_url, params={**params, 'qn': 127, 'fnval': 4048, 'fourk': 1})
+    play_info = json.loads(res.text)
+    return play_info if play_info['code'] == 0 else None  # 需要大会员或该地区不支持
+
 
 @api
-async def get_video_info(client: httpx.AsyncClient, url) -> VideoInfo:
+async def get_video_info_api(client: httpx.AsyncClient, url, season: bool = True) -> VideoInfo:
+    """
+    get video info from view and playurl json api, which is much smaller than the video page
+
+    :param client:
+    :param url: url of bv, av, ep or ss video. For ss the first episode is chosen, while the page chooses the one the
+        site suggests (like the last watched)
+    :param season: resolve 动漫，电视剧，电影 by season api, False to raise APIUnsupportedError for them
+    :return:
+    """
+    if not season and re.search(r'/bangumi/play/', url):
+        raise APIUnsupportedError("动漫，电视剧，电影由页面解析", url)
+    if m := re.search(r'/video/(BV\w+)|/video/av(\d+)', url, re.I):
+        bvid, aid = m.groups()
+        params = {'bvid': bvid} if bvid else {'aid': aid}
+        res = await req_retry(client, 'https://api.bilibili.com/x/web-interface/view', params=params)
+        view = json.loads(res.text)
+        if view['code'] in RESOURCE_ERROR_CODES:
+            raise APIResourceError("视频已失效", url)
+        if view['code'] != 0:
+            raise APIError(view['message'], url)
+        if redirect_url := view['data'].get('redirect_url'):  # bv of 动漫，电视剧，电影
+            return await get_video_info_api(client, redirect_url, season=season)
+        p = int(httpx.URL(url).params.get('p', 1)) - 1
+        cid = view['data']['pages'][p]['cid']
+        play_info = await _get_play_info(client, 'https://api.bilibili.com/x/player/playurl',
+                                         {'bvid': view['data']['bvid'], 'cid': cid})
+        return VideoInfo.parse_view(url, view, play_info)
+    elif m := re.search(r'/bangumi/play/(ep|ss)(\d+)', url):
+        kind, id_ = m.groups()
+        params = {'ep_id': id_} if kind == 'ep' else {'season_id': id_}
+        res = await req_retry(client, 'https://api.bilibili.com/pgc/view/web/season', params=params)
+        season = json.loads(res.text)
+        if season['code'] in RESOURCE_ERROR_CODES:
+            raise APIResourceError("视频已失效", url)
+        if season['code'] != 0:
+            raise APIError(season['message'], url)
+        episodes = season['result']['episodes']
+        p = next((i for i, ep in enumerate(episodes) if str(ep['id']) == id_), None) if kind == 'ep' else 0
+        if p is None:  # ep in sections like PV
+            raise APIUnsupportedError("未知视频类型", url)
+        play_info = await _get_play_info(client, 'https://api.bilibili.com/pgc/player/web/playurl',
+                                         {'ep_id': episodes[p]['id'], 'cid': episodes[p]['cid']})
+        return VideoInfo.parse_season(season, p, play_info)
+    raise APIUnsupportedError("未知视频类型", url)
+
+
+@api
+async def get_video_info_html(client: httpx.AsyncClient, url) -> VideoInfo:
+    """
+    get video info by scraping the video page
+
+    :param client:
+    :param url:
+    :return:
+    """
     res = await req_retry(client, url, follow_redirects=True)
     video_info = VideoInfo.parse_html(url, res.text)
     return video_info
 
 
+async def get_video_info(client: httpx.AsyncClient, url) -> VideoInfo:
+    """
+    get video info from json api, fallback to scraping the video page when json api is not supported or failed.
+    动漫，电视剧，电影 are always resolved by their page, whose og:title and h1 name the downloaded files
+
+    :param client:
+    :param url:
+    :return:
+    """
+    try:
+        return await get_video_info_api(client, url, season=False)
+    except APIResourceError:
+        raise
+    except (APIError, httpx.HTTPError) as e:
+        logger.debug(f"json api failed for {url}, fallback to html: {e}")
+    return await get_video_info_html(client, url)
+
+
 @api
 async def get_subtitle_info(client: httpx.AsyncClient, bvid, cid):
     params = {'bvid': bvid, 'cid': cid}
@@ -43,8 +43,10 @@ async def get_media_info(client: httpx.AsyncClient, pid: str) -> Tuple[str, Sequ
     m3u8_info = m3u8.loads(res.text)
     if m3u8_info.base_uri is None:
         m3u8_info.base_uri = re.match(r'(https?://[^/]*)/', m3u8_main_url).groups()[0]
-    m3u8_urls = list(sorted((i.absolute_uri for i in m3u8_info.playlists), reverse=True,
-                            key=lambda s: int(re.findall(r'/(\d+).m3u8', s)[0])))
+    # by BANDWIDTH, or the number in the path if it is missing
+    playlists = sorted(m3u8_info.playlists, reverse=True, key=lambda p: p.stream_info.bandwidth or
+                       int(re.findall(r'/(\d+).m3u8', p.absolute_uri)[0]))
+    m3u8_urls = [p.absolute_uri for p in playlists]
     return title, m3u8_urls
 
 
@@ -0,0 +1,236 @@
+import asyncio
+import weakref
+from collections import defaultdict
+from typing import Dict, Optional, Tuple, Callable, List
+import httpx
+
+# request extension of media requests, value is (strategy, connections), see media_extensions
+MEDIA_EXTENSION = 'bilix_media'
+TRANSPORT_STRATEGIES = ('shared', 'http1', 'http2')
+
+
+def media_extensions(strategy: str, connections: int) -> dict:
+    """
+    extensions of media requests to choose their transport strategy in a pooled client
+
+    :param strategy: 'shared' for the client's own connections, 'http1' for at most connections HTTP/1.1 connections per
+        host, 'http2' for connections HTTP/2 connections per host with the streams spread among them
+    :param connections: connection number of each host
+    :return:
+    """
+    assert strategy in TRANSPORT_STRATEGIES, f"transport strategy should be one of {TRANSPORT_STRATEGIES}"
+    assert connections > 0
+    return {} if strategy == 'shared' else {MEDIA_EXTENSION: (strategy, connections)}
+
+
+class _HostReleaseStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        """response stream that releases the host slot when it is closed"""
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release:
+                self._release()
+                self._release = None
+
+
+class _LoopState:
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        """connections can not be used across event loops, each loop has its own transport"""
+        self.transport = transport
+        self.host_semas: Dict[str, asyncio.Semaphore] = {}
+        self.active: Dict[str, int] = defaultdict(int)
+        # transports of media requests by (strategy, connections)
+        self.media: Dict[Tuple[str, int], List[httpx.AsyncHTTPTransport]] = {}
+        # active requests of (media transport, host)
+        self.media_active: Dict[Tuple[int, str], int] = defaultdict(int)
+        self.media_semas: Dict[Tuple[str, int, str], asyncio.Semaphore] = {}
+
+
+class ConnectionPool:
+    def __init__(self, key: Tuple, transport_settings: dict, max_per_host: Optional[int]):
+        """
+        A connection pool shared by clients with the same transport settings
+
+        :param key: registry key
+        :param transport_settings: kwargs of httpx.AsyncHTTPTransport
+        :param max_per_host: max concurrent requests (connections for http1) to a host, None for no cap
+        """
+        self.key = key
+        self.transport_settings = transport_settings
+        self.max_per_host = max_per_host
+        self.clients = 0
+        self.requests = 0
+        self._states: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState]' = \
+            weakref.WeakKeyDictionary()
+
+    def _state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        if loop not in self._states:
+            self._states[loop] = _LoopState(httpx.AsyncHTTPTransport(**self.transport_settings))
+        return self._states[loop]
+
+    def _media_transports(self, state: _LoopState, strategy: str, connections: int) -> List[httpx.AsyncHTTPTransport]:
+        if (strategy, connections) not in state.media:
+            settings = {**self.transport_settings, 'http2': strategy == 'http2'}
+            if strategy == 'http1':
+                settings['http1'] = True
+            # each http2 transport keeps one connection to a host, so there are connections of them
+            state.media[strategy, connections] = [httpx.AsyncHTTPTransport(**settings)
+                                                  for _ in range(connections if strategy == 'http2' else 1)]
+        return state.media[strategy, connections]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        state = self._state()
+        host = request.url.host
+        transport, media_key, sema, media_sema = state.transport, None, None, None
+        if media := request.extensions.get(MEDIA_EXTENSION):
+            strategy, connections = media
+            transports = self._media_transports(state, strategy, connections)
+            # the least busy connection of the host
+            idx = min(range(len(transports)), key=lambda i: state.media_active[i, host])
+            transport, media_key = transports[idx], (idx, host)
+            if strategy == 'http1':  # one request for each connection
+                media_sema = state.media_semas.setdefault((strategy, connections, host),
+                                                          asyncio.Semaphore(connections))
+        if self.max_per_host:
+            sema = state.host_semas.setdefault(host, asyncio.Semaphore(self.max_per_host))
+            await sema.acquire()
+        if media_sema:
+            try:
+                await media_sema.acquire()
+            except BaseException:
+                if sema:
+                    sema.release()
+                raise
+        state.active[host] += 1
+        if media_key:
+            state.media_active[media_key] += 1
+        self.requests += 1
+
+        def release():
+            state.active[host] -= 1
+            if media_key:
+                state.media_active[media_key] -= 1
+            if media_sema:
+                media_sema.release()
+            if sema:
+                sema.release()
+
+        try:
+            res = await transport.handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        res.stream = _HostReleaseStream(res.stream, release)
+        return res
+
+    async def aclose(self):
+        # transports of other loops are dropped with their loops
+        if state := self._states.pop(asyncio.get_running_loop(), None):
+            for transport in [state.transport, *(t for ts in state.media.values() for t in ts)]:
+                await transport.aclose()
+        self._states.clear()
+
+    def stats(self) -> dict:
+        state = self._states.get(asyncio.get_running_loop()) if _in_loop() else None
+        transports = [state.transport, *(t for ts in state.media.values() for t in ts)] if state else []
+        connections = [c for t in transports for c in getattr(getattr(t, '_pool', None), 'connections', [])]
+        return {
+            'clients': self.clients,
+            'requests': self.requests,
+            'active': {h: n for h, n in state.active.items() if n} if state else {},
+            'connections': len(connections),
+            'idle_connections': sum(1 for c in connections if c.is_idle()),
+        }
+
+
+def _in_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class _PooledTransport(httpx.AsyncBaseTransport):
+    def __init__(self, registry: 'ClientRegistry', pool: ConnectionPool):
+        """transport of one client, closing it only detaches the client from the shared pool"""
+        self._registry = registry
+        self._pool = pool
+        self._closed = False
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self._pool.handle_async_request(request)
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            await self._registry.release(self._pool)
+
+
+class ClientRegistry:
+    # settings of httpx.AsyncClient that belong to the transport
+    TRANSPORT_KEYS = ('verify', 'cert', 'http1', 'http2', 'trust_env')
+    # clients with these settings have their own transports
+    UNSHARED_KEYS = ('transport', 'mounts', 'proxy', 'proxies', 'app', 'uds')
+    # keep more idle connections for longer than httpx's default, media CDNs are requested again and again
+    LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=30.)
+    # cap of concurrent requests to a host across all clients of a pool, None for no cap. Downloaders already bound
+    # their own concurrency (DownloaderBilibili streams up to 3 videos x 2 medias x part_concurrency 10 to one CDN
+    # host), a lower cap here would queue their streams silently
+    MAX_PER_HOST: Optional[int] = None
+
+    def __init__(self):
+        """
+        Registry of connection pools keyed by client settings (like dft_client_settings of each site). Clients created
+        by the registry keep their own headers and cookies but share TLS sessions and connections with clients of
+        the same transport settings.
+        """
+        self.pools: Dict[Tuple, ConnectionPool] = {}
+
+    def _key(self, settings: dict) -> Tuple:
+        return tuple((k, repr(settings[k])) for k in self.TRANSPORT_KEYS + ('limits',) if k in settings)
+
+    def client(self, **settings) -> httpx.AsyncClient:
+        """
+        create a httpx.AsyncClient with a shared connection pool
+
+        :param settings: kwargs of httpx.AsyncClient
+        :return:
+        """
+        if any(k in settings for k in self.UNSHARED_KEYS):
+            return httpx.AsyncClient(**settings)
+        key = self._key(settings)
+        if key not in self.pools:
+            transport_settings = {k: settings[k] for k in self.TRANSPORT_KEYS if k in settings}
+            transport_settings['limits'] = settings.get('limits', self.LIMITS)
+            self.pools[key] = ConnectionPool(key, transport_settings, self.MAX_PER_HOST)
+        pool = self.pools[key]
+        pool.clients += 1
+        client_settings = {k: v for k, v in settings.items() if k not in self.TRANSPORT_KEYS + ('limits',)}
+        return httpx.AsyncClient(transport=_PooledTransport(self, pool), **client_settings)
+
+    async def release(self, pool: ConnectionPool):
+        """a client of the pool is closed, close the pool if it has no client"""
+        pool.clients -= 1
+        if pool.clients <= 0:
+            if self.pools.get(pool.key) is pool:
+                del self.pools[pool.key]
+            await pool.aclose()
+
+    def stats(self) -> Dict[str, dict]:
+        """usage of each pool in the current event loop"""
+        return {', '.join(f'{k}={v}' for k, v in key) or 'default': pool.stats() for key, pool in self.pools.items()}
+
+
+# default clients of the downloaders come from here, so those of the same site share connections
+client_registry = ClientRegistry()
@@ -4,7 +4,10 @@ from typing import Union, Optional
 from contextlib import asynccontextmanager
 import aiofiles
 import httpx
+from bilix.client_pool import client_registry
 from bilix.log import logger as dft_logger
+from bilix.download.limiter import TokenBucket, BandwidthManager
+from bilix.download.ffmpeg_pool import FFmpegPool, ffmpeg_pool
 from bilix.utils import req_retry, update_cookies_from_browser, path_check
 from bilix.progress.abc import Progress
 from bilix.progress import CLIProgress
@@ -30,10 +33,9 @@ class BaseDownloader:
         :param speed_limit: global download rate for the downloader, should be a number (Byte/s unit)
         :param progress: progress obj
         """
-        self.client = client if client else httpx.AsyncClient(headers={'user-agent': 'PostmanRuntime/7.29.0'})
+        self.client = client if client else client_registry.client(headers={'user-agent': 'PostmanRuntime/7.29.0'})
         if browser:  # load cookies from browser, may need auth
             update_cookies_from_browser(self.client, browser, self.COOKIE_DOMAIN)
-        assert speed_limit is None or speed_limit > 0
         self.speed_limit = speed_limit
         # use cli progress by default
         self.progress = progress or CLIProgress()
@@ -41,6 +43,11 @@ class BaseDownloader:
         self.stream_retry = stream_retry
         # active stream number
         self._stream_num = 0
+        # process-wide budget attached by BandwidthManager.attach
+        self.bandwidth: Optional[BandwidthManager] = None
+        self.bandwidth_site: str = self.__class__.__name__
+        # ffmpeg of all downloaders run in the shared pool
+        self.ffmpeg_pool: FFmpegPool = ffmpeg_pool
 
     async def __aenter__(self):
         await self.client.__aenter__()
@@ -115,20 +122,33 @@ class BaseDownloader:
         """current activate network stream number"""
         return self._stream_num
 
-    LIMIT_BOUND: float = 1e5
-    DELAY_SLOPE: float = 0.1
+    # burst of the speed limiter in seconds of speed_limit
+    BURST_TIME: float = 0.1
+    # chunk size range when speed is limited
+    MIN_CHUNK_SIZE: int = 1024
+    MAX_CHUNK_SIZE: int = 64 * 1024
+
+    @property
+    def speed_limit(self) -> Optional[float]:
+        return self._limiter.rate if self._limiter else None
+
+    @speed_limit.setter
+    def speed_limit(self, speed_limit: Union[float, int, None]):
+        assert speed_limit is None or speed_limit > 0
+        self._limiter = TokenBucket(speed_limit, burst=speed_limit * self.BURST_TIME) if speed_limit else None
 
     @property
     def chunk_size(self) -> Optional[int]:
-        if self.speed_limit and self.speed_limit < self.LIMIT_BOUND:
-            # only restrict chunk_size when speed_limit is too low
-            return int(self.speed_limit * self.DELAY_SLOPE)
+        if self._limiter:
+            # each stream reads about BURST_TIME/2 of its share at a time, so the sleeps stay fine-grained
+            share = self._limiter.burst / 2 / max(1, self.stream_num)
+            return int(min(self.MAX_CHUNK_SIZE, max(self.MIN_CHUNK_SIZE, share)))
         # default to None setup
         return None
 
-    async def _check_speed(self, content_size):
-        if self.speed_limit and (cur_speed := self.progress.active_speed) > self.speed_limit:
-            t_tgt = content_size / self.speed_limit * self.stream_num
-            t_real = content_size / cur_speed
-            t = t_tgt - t_real
-            await asyncio.sleep(t)
+    async def _check_speed(self, content_size, task_id=None):
+        """wait for the speed limiter and the bandwidth budget of task_id before using content_size bytes"""
+        if self._limiter:
+            await self._limiter.acquire(content_size)
+        if self.bandwidth:
+            await self.bandwidth.acquire(self.bandwidth_site, task_id, content_size)
@@ -1,7 +1,11 @@
 import asyncio
 import re
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+import time
+from typing import Union, Dict, List, Set, AsyncIterator, Optional, Tuple, Callable, Awaitable
 import aiofiles
 import httpx
 import os
@@ -9,9 +13,200 @@ import m3u8
 from Crypto.Cipher import AES
 from m3u8 import Segment
 from bilix._handle import Handler
+from bilix.client_pool import media_extensions
 from bilix.download.base_downloader import BaseDownloader
+from bilix.download.journal import SegmentJournal
 from bilix.utils import req_retry, merge_files, path_check
 
+# AES decryption of all m3u8 downloaders runs here to keep the event loop free
+decrypt_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='bilix-decrypt')
+
+
+class SegmentDecoder:
+    PNG_HEADER_END = b'\x47\x40'
+
+    def __init__(self, png: bool = False, cipher=None):
+        """
+        Incremental version of stripping the fake png header and AES-CBC decryption of a segment, memory is constant
+        no matter how large the segment is
+
+        :param png: the segment is disguised as png, data before the first PNG_HEADER_END (included) is dropped
+        :param cipher: AES-CBC cipher of the segment
+        """
+        self.png = png
+        self.cipher = cipher
+        self._head = b''  # png data before the header end is found
+        self._rest = b''  # encrypted data less than a block
+
+    def feed(self, chunk: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        """process a chunk of raw data, return decoded data which may be empty"""
+        if self.png:
+            data = self._head + bytes(chunk)
+            pos = data.find(self.PNG_HEADER_END)
+            if pos < 0:
+                self._head = data[-1:]  # header end may cross chunks
+                return b''
+            self.png, self._head = False, b''
+            chunk = memoryview(data)[pos + len(self.PNG_HEADER_END):]
+        if self.cipher is None:
+            return chunk
+        if self._rest:
+            chunk = memoryview(self._rest + bytes(chunk))
+        mv = memoryview(chunk)
+        n = len(mv) - len(mv) % AES.block_size
+        self._rest = bytes(mv[n:])
+        return self.cipher.decrypt(mv[:n]) if n else b''
+
+    def close(self) -> bytes:
+        """data left at the end of segment"""
+        if self._rest:
+            raise ValueError(f"encrypted data is not aligned to block size, {len(self._rest)} bytes left")
+        return b''
+
+
+class OrderedSegmentWriter:
+    def __init__(self, f, journal: Optional[SegmentJournal], max_buffer: int):
+        """
+        Append segments to an opened file in playlist order. The next segment is written while it is downloading,
+        others wait in memory, and new segments are held back while more than max_buffer bytes are waiting.
+
+        :param f: async file opened for appending, positioned at journal.size
+        :param journal: next index and size are committed to it, None to write from the start without a journal
+        :param max_buffer: max bytes of the reorder buffer
+        """
+        self.f = f
+        self.journal = journal
+        self.max_buffer = max_buffer
+        self.next_idx = journal.next_idx if journal else 0
+        self.size = journal.size if journal else 0
+        # file size where the next segment starts
+        self.head_start = self.size
+        self.buffer: Dict[int, List[bytes]] = {}
+        self.finished: Set[int] = set()
+        self.buffered = 0
+        self.max_buffered = 0
+        self._cond = asyncio.Condition()
+
+    def _can_start(self, idx: int) -> bool:
+        return self.buffered < self.max_buffer or idx <= self.next_idx
+
+    async def reserve(self, idx: int):
+        """wait until segment idx can be downloaded, the next segment is never held back"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._can_start(idx))
+
+    @asynccontextmanager
+    async def slot(self, idx: int, sema: asyncio.Semaphore):
+        """
+        hold a slot of sema to download segment idx. The buffer is checked when the slot is taken, a held back segment
+        gives its slot up while waiting so the next segment can always start.
+        """
+        while True:
+            await sema.acquire()
+            if self._can_start(idx):
+                break
+            sema.release()
+            await self.reserve(idx)
+        try:
+            yield
+        finally:
+            sema.release()
+
+    async def write(self, idx: int, chunk: Union[bytes, memoryview]):
+        """write a chunk of segment idx, or keep it until the previous segments are written"""
+        if not chunk:
+            return
+        async with self._cond:
+            if idx == self.next_idx:
+                await self.f.write(chunk)
+                self.size += len(chunk)
+            else:
+                self.buffer.setdefault(idx, []).append(bytes(chunk))
+                self.buffered += len(chunk)
+                self.max_buffered = max(self.max_buffered, self.buffered)
+
+    async def finish(self, idx: int):
+        """segment idx is complete, write the buffered segments after it"""
+        async with self._cond:
+            self.finished.add(idx)
+            while self.next_idx in self.finished:
+                self.finished.remove(self.next_idx)
+                self.next_idx += 1
+                self.head_start = self.size
+                # the new next segment catches up
+                for chunk in self.buffer.pop(self.next_idx, []):
+                    await self.f.write(chunk)
+                    self.buffered -= len(chunk)
+                    self.size += len(chunk)
+            await self.f.flush()
+            if self.journal:
+                self.journal.commit(self.next_idx, self.size)
+            self._cond.notify_all()
+
+    async def reset(self, idx: int):
+        """drop what has been written of segment idx to write it again"""
+        async with self._cond:
+            if idx == self.next_idx:
+                await self.f.truncate(self.head_start)
+                await self.f.seek(self.head_start)
+                self.size = self.head_start
+            else:
+                self.buffered -= sum(len(chunk) for chunk in self.buffer.pop(idx, []))
+                self._cond.notify_all()
+
+
+def choose_variant(playlists: List[m3u8.Playlist], bandwidth: float = None, resolution: int = None) -> int:
+    """
+    choose a variant of a master playlist
+
+    :param playlists: variants sorted by bandwidth
+    :param bandwidth: max BANDWIDTH in bit/s, None for no limit
+    :param resolution: max height of RESOLUTION like 720, None for no limit
+    :return: index of the best variant within the limits, the lowest one if none fits
+    """
+    fit = [i for i, p in enumerate(playlists)
+           if (bandwidth is None or (p.stream_info.bandwidth or 0) <= bandwidth) and
+           (resolution is None or (p.stream_info.resolution or (0, 0))[1] <= resolution)]
+    return fit[-1] if fit else 0
+
+
+class VariantSet:
+    def __init__(self, playlists: List[m3u8.Playlist], chosen: int, load: Callable[[str], Awaitable[m3u8.M3U8]]):
+        """
+        Variants of a master playlist. Media playlists of the neighbours of the chosen variant are loaded on demand,
+        their segments stand in for the segments that fail on the chosen one.
+
+        :param playlists: variants sorted by bandwidth
+        :param chosen: index of the chosen variant
+        :param load: coroutine function to load a media playlist by url
+        """
+        self.playlists = playlists
+        self.chosen = chosen
+        self._load = load
+        self._loaded: Dict[int, asyncio.Future] = {}
+
+    async def load(self, i: int) -> m3u8.M3U8:
+        """media playlist of variant i, loaded once"""
+        if i not in self._loaded:
+            self._loaded[i] = asyncio.ensure_future(self._load(self.playlists[i].absolute_uri))
+        return await self._loaded[i]
+
+    async def fallback_segments(self, idx: int) -> List[Segment]:
+        """segments at the same media sequence as segment idx of the chosen variant, lower neighbour first"""
+        chosen = await self.load(self.chosen)
+        seq = (chosen.media_sequence or 0) + idx
+        segs = []
+        for i in (self.chosen - 1, self.chosen + 1):
+            if not 0 <= i < len(self.playlists):
+                continue
+            try:
+                m3u8_info = await self.load(i)
+            except Exception:
+                continue
+            if 0 <= (j := seq - (m3u8_info.media_sequence or 0)) < len(m3u8_info.segments):
+                segs.append(m3u8_info.segments[j])
+        return segs
+
 
 class BaseDownloaderM3u8(BaseDownloader):
     def __init__(
@@ -25,8 +220,19 @@ class BaseDownloaderM3u8(BaseDownloader):
             # unique params
             part_concurrency: int = 10,
             video_concurrency: Union[int, asyncio.Semaphore] = 3,
+            transport_strategy: str = 'shared',
+            media_connections: int = 4,
+            ordered_write: bool = True,
     ):
-        """Base async m3u8 Downloader"""
+        """
+        Base async m3u8 Downloader
+
+        :param transport_strategy: connections of segment streams for clients of client_registry, 'shared' to use the
+            client's connections, 'http1' or 'http2' to spread them among media_connections connections of each host
+        :param media_connections: connection number of each host for http1 or http2 transport_strategy
+        :param ordered_write: append segments to the file in order instead of saving each segment to its own file and
+            merging them at the end, the last written segment is recorded in a journal for resuming
+        """
         super(BaseDownloaderM3u8, self).__init__(
             client=client,
             browser=browser,
@@ -37,30 +243,111 @@ class BaseDownloaderM3u8(BaseDownloader):
         )
         self.v_sema = asyncio.Semaphore(video_concurrency) if isinstance(video_concurrency, int) else video_concurrency
         self.part_concurrency = part_concurrency
-        self.decrypt_cache = {}
+        self.media_extensions = media_extensions(transport_strategy, media_connections)
+        self.ordered_write = ordered_write
+        # key uri -> future of key bytes, least recently used ones are dropped
+        self.decrypt_cache: OrderedDict[str, asyncio.Future] = OrderedDict()
+        # measured throughput of segment downloads in Byte/s, used to choose variants of master playlists
+        self.throughput: Optional[float] = None
+        self._received = 0
+
+    # max bytes of segments waiting for their previous ones in ordered_write mode
+    MAX_REORDER_BUFFER: int = 64 * 1024 * 1024
+    # max keys in decrypt_cache
+    MAX_KEY_CACHE: int = 64
+    # encrypted data is decrypted on decrypt_executor in batches of this size
+    DECRYPT_BATCH_SIZE: int = 512 * 1024
+    # variants are chosen within this fraction of the measured throughput
+    THROUGHPUT_SAFETY: float = 0.8
+    # live recording stops when the playlist can not be reloaded for this long (s)
+    LIVE_RELOAD_TIMEOUT: float = 60.
+    # weight of the latest download in the measured throughput
+    THROUGHPUT_ALPHA: float = 0.5
+
+    def _get_key(self, uri: str) -> asyncio.Future:
+        """future of the key bytes, the key is requested once while it is cached"""
+        if uri in self.decrypt_cache:
+            self.decrypt_cache.move_to_end(uri)
+            return self.decrypt_cache[uri]
 
-    async def _decrypt(self, seg: m3u8.Segment, content: bytearray):
         async def get_key():
-            key_bytes = (await req_retry(self.client, uri)).content
-            iv = bytes.fromhex(seg.key.iv.replace('0x', '')) if seg.key.iv is not None else \
-                seg.custom_parser_values['iv']
-            return AES.new(key_bytes, AES.MODE_CBC, iv)
-
-        uri = seg.key.absolute_uri
-        if uri not in self.decrypt_cache:
-            self.decrypt_cache[uri] = asyncio.ensure_future(get_key())
-            self.decrypt_cache[uri] = await self.decrypt_cache[uri]
-        elif asyncio.isfuture(self.decrypt_cache[uri]):
-            await self.decrypt_cache[uri]
-        cipher = self.decrypt_cache[uri]
-        return cipher.decrypt(content)
-
-    async def get_m3u8_video(self, m3u8_url: str, path: Path = Path("./test.ts")) -> Path:
+            return (await req_retry(self.client, uri)).content
+
+        def on_done(f: asyncio.Future):
+            # failed keys are requested again next time
+            if f.cancelled() or f.exception():
+                if self.decrypt_cache.get(uri) is f:
+                    del self.decrypt_cache[uri]
+
+        fut = self.decrypt_cache[uri] = asyncio.ensure_future(get_key())
+        fut.add_done_callback(on_done)
+        while len(self.decrypt_cache) > self.MAX_KEY_CACHE:
+            self.decrypt_cache.popitem(last=False)
+        return fut
+
+    def _prefetch_keys(self, segments: List[Segment]):
         """
-        download
+        request the keys of segments at once instead of waiting for the first segment of each. Only the first
+        MAX_KEY_CACHE distinct keys are requested, more would push each other out of decrypt_cache before their
+        segments start, with rotating keys the rest are requested when their segments start.
+        """
+        uris = dict.fromkeys(seg.key.absolute_uri for seg in segments if seg.key)
+        for uri in list(uris)[:self.MAX_KEY_CACHE]:
+            self._get_key(uri)
+
+    async def _get_cipher(self, seg: m3u8.Segment):
+        """a new AES-CBC cipher of the segment"""
+        key_bytes = await self._get_key(seg.key.absolute_uri)
+        iv = bytes.fromhex(seg.key.iv.replace('0x', '')) if seg.key.iv is not None else \
+            seg.custom_parser_values['iv']
+        # cipher is stateful, so every segment has its own
+        return AES.new(key_bytes, AES.MODE_CBC, iv)
+
+    async def _load_playlist(self, m3u8_url: str) -> m3u8.M3U8:
+        """load a playlist, uris are relative to its final url"""
+        res = await req_retry(self.client, m3u8_url, follow_redirects=True)
+        m3u8_info = m3u8.loads(res.text, uri=str(res.url))
+        for seq, seg in enumerate(m3u8_info.segments, start=m3u8_info.media_sequence or 0):
+            # without IV the media sequence number is used (RFC 8216 5.2), it equals the segment index only when
+            # EXT-X-MEDIA-SEQUENCE is 0
+            # https://stackoverflow.com/questions/50628791/decrypt-m3u8-playlist-encrypted-with-aes-128-without-iv
+            if seg.key and seg.key.iv is None:
+                seg.custom_parser_values['iv'] = seq.to_bytes(16, 'big')
+        return m3u8_info
+
+    async def _resolve_playlist(self, m3u8_url: str, bandwidth: float = None, resolution: int = None) \
+            -> Tuple[m3u8.M3U8, Optional[VariantSet]]:
+        """
+        load the media playlist of m3u8_url, a variant is chosen if it is a master playlist
 
         :param m3u8_url:
+        :param bandwidth: max BANDWIDTH in bit/s, default to the measured throughput and speed_limit
+        :param resolution: max height of RESOLUTION
+        :return: media playlist and the variants if any
+        """
+        m3u8_info = await self._load_playlist(m3u8_url)
+        if not m3u8_info.is_variant:
+            return m3u8_info, None
+        playlists = sorted(m3u8_info.playlists, key=lambda p: p.stream_info.bandwidth or 0)
+        if bandwidth is None and resolution is None:
+            if rates := [r for r in (self.throughput, self.speed_limit) if r]:
+                bandwidth = min(rates) * 8 * self.THROUGHPUT_SAFETY
+        variants = VariantSet(playlists, choose_variant(playlists, bandwidth, resolution), self._load_playlist)
+        chosen = playlists[variants.chosen]
+        self.logger.debug(f"variant {chosen.stream_info.bandwidth} {chosen.stream_info.resolution} chosen")
+        return await variants.load(variants.chosen), variants
+
+    async def get_m3u8_video(self, m3u8_url: str, path: Path = Path("./test.ts"),
+                             bandwidth: float = None, resolution: int = None,
+                             time_range: Tuple[int, int] = None) -> Path:
+        """
+        download
+
+        :param m3u8_url: media or master playlist
         :param path:
+        :param bandwidth: for master playlist, max BANDWIDTH of the variant in bit/s, default to the measured throughput
+        :param resolution: for master playlist, max height of the variant like 1080
+        :param time_range: (start_time, end_time) to download a clip, only segments overlapping it are downloaded
         :return: downloaded file path
         """
         exist, path = path_check(path)
@@ -69,23 +356,196 @@ class BaseDownloaderM3u8(BaseDownloader):
             return path
         async with self.v_sema:
             task_id = await self.progress.add_task(total=None, description=path.name)
-            res = await req_retry(self.client, m3u8_url, follow_redirects=True)
-            m3u8_info = m3u8.loads(res.text)
-            if not m3u8_info.base_uri:
-                base_uri = re.search(r"(.*)/[^/]*m3u8", m3u8_url).groups()[0]
-                m3u8_info.base_uri = base_uri
-            cors = []
+            m3u8_info, variants = await self._resolve_playlist(m3u8_url, bandwidth, resolution)
             p_sema = asyncio.Semaphore(self.part_concurrency)
-            total_time = 0
-            for idx, seg in enumerate(m3u8_info.segments):
-                total_time += seg.duration
-                # https://stackoverflow.com/questions/50628791/decrypt-m3u8-playlist-encrypted-with-aes-128-without-iv
-                if seg.key and seg.key.iv is None:
-                    seg.custom_parser_values['iv'] = idx.to_bytes(16, 'big')
-                cors.append(self._get_seg(seg, path.with_name(f"{path.stem}-{idx}.ts"), task_id, p_sema))
+            segments, first = m3u8_info.segments, 0
+            if time_range:
+                first, segments, s = self._clip_segments(segments, time_range)
+                if not segments:
+                    raise Exception(f"time range <{time_range[0]}-{time_range[1]}> invalid for <{path.name}>")
+                # segments are saved to an intermediate file, then cut by ffmpeg
+                seg_path = path.with_name(f'{path.stem}-segments{path.suffix}')
+            else:
+                seg_path = path
+            total_time = sum(seg.duration for seg in segments)
+            self._prefetch_keys(segments)
             await self.progress.update(task_id, total_time=total_time)
-            file_list = await asyncio.gather(*cors)
-        await merge_files(file_list, new_path=path)
+            start, received = time.monotonic(), self._received
+            if self.ordered_write:
+                await self._get_segs_ordered(segments, seg_path, task_id, p_sema, variants, first)
+            else:
+                cors = [self._get_seg(first + idx, seg, path.with_name(f"{path.stem}-{first + idx}.ts"), task_id,
+                                      p_sema, variants) for idx, seg in enumerate(segments)]
+                file_list = await asyncio.gather(*cors)
+            if (elapsed := time.monotonic() - start) > 0 and self._received > received:
+                rate = (self._received - received) / elapsed
+                self.throughput = rate if self.throughput is None else \
+                    self.THROUGHPUT_ALPHA * rate + (1 - self.THROUGHPUT_ALPHA) * self.throughput
+        if not self.ordered_write:
+            await merge_files(file_list, new_path=seg_path)
+        if time_range:
+            # fix time range
+            cmd = ['ffmpeg', '-ss', str(s), '-t', str(time_range[1] - time_range[0]), '-i', str(seg_path),
+                   '-codec', 'copy', '-loglevel', 'quiet', '-f', 'mpegts', str(path)]
+            await self.ffmpeg_pool.run(cmd)
+            os.remove(seg_path)
+        self.logger.info(f"[cyan]已完成[/cyan] {path.name}")
+        await self.progress.update(task_id, visible=False)
+        return path
+
+    @staticmethod
+    def _clip_segments(segments: List[Segment], time_range: Tuple[int, int]) -> Tuple[int, List[Segment], float]:
+        """
+        segments overlapping the time range by their EXTINF durations
+
+        :param segments:
+        :param time_range: (start_time, end_time)
+        :return: index of the first overlapping segment, overlapping segments and the start time in them
+        """
+        start_time, end_time = time_range
+        first, clip, s = 0, [], 0.
+        pre_time = 0.
+        for idx, seg in enumerate(segments):
+            if pre_time >= end_time:
+                break
+            if start_time < pre_time + seg.duration:
+                if not clip:
+                    first, s = idx, max(0., start_time - pre_time)
+                clip.append(seg)
+            pre_time += seg.duration
+        return first, clip, s
+
+    async def _get_segs_ordered(self, segments: List[Segment], path: Path, task_id, p_sema: asyncio.Semaphore,
+                                variants: VariantSet = None, first: int = 0):
+        """
+        download segments and append them to path in order, resume from the journal of {name}.tmp if any
+
+        :param segments:
+        :param path:
+        :param task_id:
+        :param p_sema:
+        :param variants: variants to fall back to
+        :param first: index of segments[0] in the playlist
+        :return:
+        """
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        identity = f"{len(segments)} {segments[0].uri if segments else ''}"
+        if journal := SegmentJournal.load(tmp_path, identity):
+            resumed = segments[:journal.next_idx]
+            if resumed:
+                await self._update_task_total(task_id, time_part=sum(seg.duration for seg in resumed),
+                                              update_size=journal.size)
+                await self.progress.update(task_id, advance=journal.size)
+        else:
+            journal = SegmentJournal(tmp_path, identity)
+        async with aiofiles.open(tmp_path, 'r+b' if tmp_path.exists() else 'wb') as f:
+            # drop what has been written after the last commit
+            await f.truncate(journal.size)
+            await f.seek(journal.size)
+            writer = OrderedSegmentWriter(f, journal, self.MAX_REORDER_BUFFER)
+
+            async def get_seg(idx: int, seg: Segment):
+                async with writer.slot(idx, p_sema):
+                    async for chunk in self._stream_seg_fallback(first + idx, seg, task_id, variants):
+                        if chunk is None:
+                            await writer.reset(idx)
+                        else:
+                            await writer.write(idx, chunk)
+                await writer.finish(idx)
+
+            await asyncio.gather(*[get_seg(idx, seg) for idx, seg in enumerate(segments) if idx >= journal.next_idx])
+        journal.remove()
+        os.replace(tmp_path, path)
+
+    async def record_m3u8_live(self, m3u8_url: str, path: Path = Path("./live.ts"), time_limit: float = None,
+                               bandwidth: float = None, resolution: int = None) -> Path:
+        """
+        record a live or EVENT m3u8 playlist, the playlist is reloaded every target duration and new segments are
+        appended to path as they arrive, until EXT-X-ENDLIST or time_limit
+
+        :param m3u8_url: media or master playlist
+        :param path:
+        :param time_limit: seconds to record, None to record until the playlist ends
+        :param bandwidth: for master playlist, max BANDWIDTH of the variant in bit/s, default to the measured throughput
+        :param resolution: for master playlist, max height of the variant like 1080
+        :return: recorded file path
+        """
+        exist, path = path_check(path)
+        if exist:
+            self.logger.info(f"[green]已存在[/green] {path.name}")
+            return path
+        async with self.v_sema:
+            task_id = await self.progress.add_task(total=None, description=path.name)
+            p_sema = asyncio.Semaphore(self.part_concurrency)
+            tmp_path = path.with_name(f'{path.name}.tmp')
+            start = time.monotonic()
+            last_seq, idx, total_time = -1, 0, 0.
+            tasks: Set[asyncio.Task] = set()
+            try:
+                async with aiofiles.open(tmp_path, 'wb') as f:
+                    writer = OrderedSegmentWriter(f, None, self.MAX_REORDER_BUFFER)
+
+                    async def get_seg(i: int, seg: Segment):
+                        try:
+                            async with writer.slot(i, p_sema):
+                                async for chunk in self._stream_seg(seg, task_id):
+                                    await writer.write(i, chunk)
+                        except Exception as e:  # segment may have slid out of the window, the recording goes on
+                            self.logger.warning(f"segment skipped {seg.uri} {e}")
+                            # drop the part of it that has been written
+                            await writer.reset(i)
+                        await writer.finish(i)
+
+                    try:
+                        reload_time = time.monotonic()
+                        m3u8_info, variants = await self._resolve_playlist(m3u8_url, bandwidth, resolution)
+                        loaded_time = reload_time
+                        if variants:  # reload the chosen variant
+                            m3u8_url = variants.playlists[variants.chosen].absolute_uri
+                        while True:
+                            # only segments with new media sequence numbers, none if the reload failed
+                            media_sequence = m3u8_info.media_sequence or 0
+                            new_segs = [(seq, seg) for seq, seg in
+                                        enumerate(m3u8_info.segments, start=media_sequence) if seq > last_seq]
+                            if new_segs:
+                                last_seq = new_segs[-1][0]
+                                total_time += sum(seg.duration for _, seg in new_segs)
+                                await self.progress.update(task_id, total_time=total_time)
+                            self._prefetch_keys([seg for _, seg in new_segs])
+                            for seq, seg in new_segs:
+                                task = asyncio.ensure_future(get_seg(idx, seg))
+                                tasks.add(task)
+                                task.add_done_callback(tasks.discard)
+                                idx += 1
+                            if m3u8_info.is_endlist or (time_limit and time.monotonic() - start >= time_limit):
+                                break
+                            # reload after a target duration, or half of it if the playlist has not changed
+                            interval = (m3u8_info.target_duration or 1) / (1 if new_segs else 2)
+                            if time_limit:
+                                interval = min(interval, start + time_limit - time.monotonic())
+                            await asyncio.sleep(max(0., reload_time + interval - time.monotonic()))
+                            reload_time = time.monotonic()
+                            try:
+                                m3u8_info = await self._load_playlist(m3u8_url)
+                                loaded_time = reload_time
+                            except Exception as e:
+                                if reload_time - loaded_time >= self.LIVE_RELOAD_TIMEOUT:
+                                    self.logger.warning(f"{path.name} 播放列表无法更新，停止录制 {e}")
+                                    break
+                                self.logger.warning(f"{path.name} 播放列表更新失败，稍后重试 {e}")
+                        await asyncio.gather(*tasks)
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+            except BaseException:
+                # keep what has been recorded
+                if tmp_path.exists() and tmp_path.stat().st_size > 0:
+                    os.replace(tmp_path, path)
+                    self.logger.warning(f"录制中断，已保存 {path.name}")
+                else:
+                    tmp_path.unlink(missing_ok=True)
+                raise
+            os.replace(tmp_path, path)
         self.logger.info(f"[cyan]已完成[/cyan] {path.name}")
         await self.progress.update(task_id, visible=False)
         return path
@@ -101,42 +561,94 @@ class BaseDownloaderM3u8(BaseDownloader):
         predicted_total = task.fields['total_time'] * confirmed_b / confirmed_t
         await self.progress.update(task_id, total=predicted_total, confirmed_t=confirmed_t, confirmed_b=confirmed_b)
 
-    async def _get_seg(self, seg: Segment, path: Path, task_id, p_sema: asyncio.Semaphore) -> Path:
+    async def _get_seg(self, idx: int, seg: Segment, path: Path, task_id, p_sema: asyncio.Semaphore,
+                       variants: VariantSet = None) -> Path:
         exists, path = path_check(path)
         if exists:
             downloaded = os.path.getsize(path)
             await self._update_task_total(task_id, time_part=seg.duration, update_size=downloaded)
             await self.progress.update(task_id, advance=downloaded)
             return path
-        seg_url = seg.absolute_uri
+        tmp_path = path.with_name(f'{path.name}.tmp')
         async with p_sema:
-            content = None
-            for times in range(1 + self.stream_retry):
-                content = bytearray()
-                try:
-                    async with self.client.stream("GET", seg_url,
-                                                  follow_redirects=True) as r, self._stream_context(times):
-                        r.raise_for_status()
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in self._stream_seg_fallback(idx, seg, task_id, variants):
+                    if chunk is None:
+                        await f.seek(0)
+                        await f.truncate()
+                    else:
+                        await f.write(chunk)
+        os.replace(tmp_path, path)
+        return path
+
+    async def _stream_seg_fallback(self, idx: int, seg: Segment, task_id, variants: Optional[VariantSet]) \
+            -> AsyncIterator[Optional[Union[bytes, memoryview]]]:
+        """
+        _stream_seg, when the segment fails the same segment of a neighbouring variant is streamed instead, and None is
+        yielded before it to drop what has been yielded
+        """
+        candidates, i = None, 0
+        while True:
+            try:
+                async for chunk in self._stream_seg(seg, task_id):
+                    yield chunk
+                return
+            except Exception as e:
+                if variants is None:
+                    raise
+                if candidates is None:
+                    candidates = await variants.fallback_segments(idx)
+                if i >= len(candidates):
+                    raise
+                seg, i = candidates[i], i + 1
+                self.logger.warning(f"{e} 改用相邻码率的分片 {seg.uri}")
+            yield None
+
+    async def _stream_seg(self, seg: Segment, task_id) -> AsyncIterator[Union[bytes, memoryview]]:
+        """download a segment and yield its decoded data chunk by chunk, a broken stream is resumed by range"""
+        seg_url = seg.absolute_uri
+        decoder = SegmentDecoder(png=bool(re.fullmatch(r'.*\.png', seg_url)),  # in case .png
+                                 cipher=await self._get_cipher(seg) if seg.key else None)  # in case encrypted
+        loop = asyncio.get_running_loop()
+        received, batch = 0, bytearray()
+        for times in range(1 + self.stream_retry):
+            try:
+                headers = {'Range': f'bytes={received}-'} if received else None
+                async with self.client.stream("GET", seg_url, follow_redirects=True, headers=headers,
+                                              extensions=self.media_extensions) as r, self._stream_context(times):
+                    r.raise_for_status()
+                    if not received:
                         await self._update_task_total(
                             task_id, time_part=seg.duration, update_size=int(r.headers['content-length']))
+                    # range is not supported, skip what has been received
+                    skip = received if r.status_code == 200 else 0
+                    try:
                         async for chunk in r.aiter_bytes(chunk_size=self.chunk_size):
-                            content.extend(chunk)
-                            await self.progress.update(task_id, advance=len(chunk))
-                            await self._check_speed(len(chunk))
-                    break
-                except (httpx.HTTPStatusError, httpx.TransportError):
-                    continue
-            else:
-                raise Exception(f"STREAM 超过重复次数 {seg_url}")
-        # in case .png
-        if re.fullmatch(r'.*\.png', seg_url):
-            _, _, content = content.partition(b'\x47\x40')
-        # in case encrypted
-        if seg.key:
-            content = await self._decrypt(seg, content)
-        async with aiofiles.open(path, 'wb') as f:
-            await f.write(content)
-        return path
+                            if skip:
+                                chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                                if not chunk:
+                                    continue
+                            received += len(chunk)
+                            self._received += len(chunk)
+                            await self.progress.advance(task_id, len(chunk))
+                            await self._check_speed(len(chunk), task_id)
+                            if decoder.cipher is None:
+                                yield decoder.feed(chunk)
+                                continue
+                            batch += chunk
+                            if len(batch) >= self.DECRYPT_BATCH_SIZE:
+                                data, batch = batch, bytearray()
+                                yield await loop.run_in_executor(decrypt_executor, decoder.feed, data)
+                    finally:
+                        await self.progress.flush(task_id)
+                break
+            except (httpx.HTTPStatusError, httpx.TransportError):
+                continue
+        else:
+            raise Exception(f"STREAM 超过重复次数 {seg_url}")
+        if batch:
+            yield await loop.run_in_executor(decrypt_executor, decoder.feed, batch)
+        yield decoder.close()
 
 
 @Handler.register(name="m3u8")
@@ -148,3 +660,9 @@ def handle(kwargs):
         for i, key in enumerate(kwargs['keys']):
             cors.append(d.get_m3u8_video(key, kwargs['path'] / f"{i}.ts"))
         return d, asyncio.gather(*cors)
+    if method == 'm3u8_live' or method == 'record_m3u8':
+        d = BaseDownloaderM3u8(**Handler.kwargs_filter(BaseDownloader, kwargs))
+        cors = []
+        for i, key in enumerate(kwargs['keys']):
+            cors.append(d.record_m3u8_live(key, kwargs['path'] / f"live-{i}.ts"))
+        return d, asyncio.gather(*cors)
@@ -1,17 +1,126 @@
 import asyncio
+import time
 from pathlib import Path
-from typing import Union, List, Iterable, Tuple
+from typing import Union, List, Iterable, Tuple, Optional, Set, Dict
+from collections import deque
 import aiofiles
 import httpx
 import uuid
-import random
 import os
 import cgi
-from anyio import run_process
+import subprocess
+from contextlib import asynccontextmanager
+from anyio import open_process, BrokenResourceError
 from pymp4.parser import Box
 from bilix._handle import Handler
+from bilix.client_pool import media_extensions
 from bilix.download.base_downloader import BaseDownloader
-from bilix.utils import req_retry, merge_files, path_check
+from bilix.download.journal import PartJournal
+from bilix.download.media_cache import MediaIndex, media_index_cache
+from bilix.utils import req_retry, merge_files, path_check, preallocate_file, MirrorSelector
+
+
+class PartRange:
+    """byte range [start, end] of the remote file, start moves forward while downloading and end may shrink when
+    the tail is handed over to another stream"""
+    __slots__ = ('start', 'end', 'shift')
+
+    def __init__(self, start: int, end: int, shift: int = 0):
+        self.start = start
+        self.end = end
+        # local file position minus remote position
+        self.shift = shift
+
+    @property
+    def offset(self) -> int:
+        """local file position of start"""
+        return self.start + self.shift
+
+    def __len__(self):
+        return max(0, self.end - self.start + 1)
+
+    def __repr__(self):
+        return f"PartRange({self.start}, {self.end}, shift={self.shift})"
+
+
+class RangeScheduler:
+    def __init__(self, ranges: Iterable[PartRange], min_split: int):
+        """
+        Work-stealing range scheduler. Ranges are handed out in order, once they are used up the largest unfinished
+        range is split and its tail is given to the idle stream, so all streams keep busy until the last byte.
+
+        :param ranges: planned ranges
+        :param min_split: never split a range into pieces smaller than this size
+        """
+        self.pending = deque(ranges)
+        self.active: Set[PartRange] = set()
+        self.min_split = min_split
+        self.splits = 0
+
+    def acquire(self) -> Optional[PartRange]:
+        """get a range to download, None if there is nothing left worth to split"""
+        if self.pending:
+            r = self.pending.popleft()
+        else:
+            victim = max(self.active, key=len, default=None)
+            if victim is None or len(victim) < 2 * self.min_split:
+                return
+            mid = victim.start + len(victim) // 2
+            r = PartRange(mid, victim.end, victim.shift)
+            victim.end = mid - 1
+            self.splits += 1
+        self.active.add(r)
+        return r
+
+    def release(self, r: PartRange):
+        """give back the range, unfinished part will be handed out again"""
+        self.active.discard(r)
+        if len(r) > 0:
+            self.pending.append(r)
+
+    @property
+    def remaining(self) -> int:
+        """bytes not downloaded yet"""
+        return sum(map(len, self.pending)) + sum(map(len, self.active))
+
+
+class AIMDController:
+    # throughput should improve by this ratio to keep adding streams
+    GAIN_RATIO: float = 0.05
+
+    def __init__(self, limit: int, upper: int, interval: float):
+        """
+        Additive-increase/multiplicative-decrease controller for the number of streams of a file.
+
+        :param limit: initial stream number
+        :param upper: max stream number
+        :param interval: throughput sample interval, also the cool down time of decrease
+        """
+        self.limit = max(1, min(limit, upper))
+        self.upper = upper
+        self.interval = interval
+        self.running = 0
+        self._best = 0.
+        self._last_decrease = float('-inf')
+
+    def on_sample(self, throughput: float):
+        """add one stream while the aggregate throughput (Byte/s) keeps improving"""
+        if throughput > self._best * (1 + self.GAIN_RATIO):
+            self._best = throughput
+            if self.limit < self.upper and time.monotonic() - self._last_decrease > self.interval:
+                self.limit += 1
+
+    def on_error(self):
+        """halve the stream number, errors of the same burst only count once"""
+        now = time.monotonic()
+        if now - self._last_decrease > self.interval:
+            self.limit = max(1, self.limit // 2)
+            self._last_decrease = now
+            self._best = 0.
+
+    @property
+    def overloaded(self) -> bool:
+        return self.running > self.limit
 
 
 class BaseDownloaderPart(BaseDownloader):
@@ -25,8 +134,30 @@ class BaseDownloaderPart(BaseDownloader):
             logger=None,
             # unique params
             part_concurrency: int = 10,
+            preallocate: bool = True,
+            adaptive_concurrency: bool = False,
+            pipe_clip: bool = False,
+            index_cache: bool = True,
+            transport_strategy: str = 'shared',
+            media_connections: int = 4,
     ):
-        """Base Async http Content-Range Downloader"""
+        """
+        Base Async http Content-Range Downloader
+
+        :param part_concurrency: number of parts (concurrent range requests) for each file
+        :param preallocate: if True, allocate the whole file once and let each part write at its own offset,
+            progress is recorded in a journal for resuming. Otherwise each part is written to its own file and merged
+            at the end
+        :param adaptive_concurrency: only for preallocate mode, start from part_concurrency and adjust the stream number
+            of each file by measured throughput and errors, the learned value is kept for each host
+        :param pipe_clip: for get_media_clip, feed the downloaded segments to ffmpeg in order while downloading
+            instead of cutting a complete temporary file, no resume in this mode
+        :param index_cache: for get_media_clip, cache sidx and init segment of media in memory and on disk
+        :param transport_strategy: connections of media streams for clients of client_registry, 'shared' to use the
+            client's connections (all streams of a host in one connection with http2), 'http1' or 'http2' to spread
+            them among media_connections connections of each host, API requests always use the client's connections
+        :param media_connections: connection number of each host for http1 or http2 transport_strategy
+        """
         super(BaseDownloaderPart, self).__init__(
             client=client,
             browser=browser,
@@ -36,10 +167,38 @@ class BaseDownloaderPart(BaseDownloader):
             logger=logger
         )
         self.part_concurrency = part_concurrency
+        self.preallocate = preallocate
+        self.adaptive_concurrency = adaptive_concurrency
+        self.pipe_clip = pipe_clip
+        self.index_cache = media_index_cache if index_cache else None
+        self.media_extensions = media_extensions(transport_strategy, media_connections)
+        # learned stream number of each host
+        self._host_concurrency: Dict[str, int] = {}
+
+    # ranges smaller than twice of it will not be split for idle streams
+    MIN_SPLIT_SIZE: int = 1024 * 1024
+    # for adaptive concurrency
+    MAX_PART_CONCURRENCY: int = 32
+    ADAPTIVE_INTERVAL: float = 1.
+    # size of each request in pipe_clip mode, at most part_concurrency of them are kept in memory
+    PIPE_CHUNK_SIZE: int = 4 * 1024 * 1024
 
-    async def _pre_req(self, urls: List[Union[str, httpx.URL]]) -> Tuple[int, str]:
+    @staticmethod
+    def _validators(res: httpx.Response) -> Dict[str, str]:
+        """headers that identify the remote file"""
+        return {k: res.headers[k] for k in ('ETag', 'Last-Modified') if k in res.headers}
+
+    async def _pre_req(self, mirrors: MirrorSelector) -> Tuple[httpx.Response, int, str, Dict[str, str]]:
+        """
+        request the whole file from byte 0 to learn its size, name and identity. The returned response is still
+        streaming, it should be reused as the first range or closed.
+
+        :param mirrors:
+        :return: response, total size, filename, validators
+        """
         # use GET instead of HEAD due to 404 bug https://github.com/HFrost0/bilix/issues/16
-        res = await req_retry(self.client, urls[0], follow_redirects=True, headers={'Range': 'bytes=0-1'})
+        res = await req_retry(self.client, mirrors, follow_redirects=True, headers={'Range': 'bytes=0-'}, stream=True,
+                              extensions=self.media_extensions)
         total = int(res.headers['Content-Range'].split('/')[-1])
         # get filename
         if content_disposition := res.headers.get('Content-Disposition', None):
@@ -47,10 +206,7 @@ class BaseDownloaderPart(BaseDownloader):
             filename = pdict.get('filename', '')
         else:
             filename = ''
-        # change origin url to redirected position to avoid twice redirect
-        if res.history:
-            urls[0] = res.url
-        return total, filename
+        return res, total, filename, self._validators(res)
 
     async def get_media_clip(
             self,
@@ -78,36 +234,33 @@ class BaseDownloaderPart(BaseDownloader):
                 self.logger.info(f'[green]已存在[/green] {path.name}')
             return path
 
-        urls = [url_or_urls] if isinstance(url_or_urls, str) else [url for url in url_or_urls]
+        mirrors = MirrorSelector([url_or_urls] if isinstance(url_or_urls, str) else url_or_urls)
         init_start, init_end = map(int, init_range.split('-'))
         seg_start, seg_end = map(int, seg_range.split('-'))
-        res = await req_retry(self.client, urls[0], follow_redirects=True,
-                              headers={'Range': f'bytes={seg_start}-{seg_end}'})
-        container = Box.parse(res.content)
-        assert container.type == b'sidx'
+        index = await self._get_media_index(mirrors, init_range, seg_range)
+        init_data = index.init_data
         start_time, end_time = time_range
         pre_time, pre_byte = 0, seg_end + 1
         inside = False
         parts = [(init_start, init_end)]
         total = init_end - init_start + 1
         s = 0
-        for idx, ref in enumerate(container.references):
-            if ref.reference_type != "MEDIA":
-                self.logger.debug("not a media", ref)
-                continue
-            seg_duration = ref.segment_duration / container.timescale
+        for segment_duration, referenced_size in index.references:
+            seg_duration = segment_duration / index.timescale
             if not inside and start_time < pre_time + seg_duration:
                 s = start_time - pre_time
                 inside = True
             if inside and end_time < pre_time:
                 break
             if inside:
-                total += ref.referenced_size
-                parts.append((pre_byte, pre_byte + ref.referenced_size - 1))
+                total += referenced_size
+                parts.append((pre_byte, pre_byte + referenced_size - 1))
             pre_time += seg_duration
-            pre_byte += ref.referenced_size
+            pre_byte += referenced_size
         if len(parts) == 1:
             raise Exception(f"time range <{start_time}-{end_time}> invalid for <{path.name}>")
+        # contiguous segments are requested together
+        parts = self._coalesce(parts[1:] if init_data else parts, self.part_concurrency)
 
         if task_id is not None:
             await self.progress.update(
@@ -115,25 +268,157 @@ class BaseDownloaderPart(BaseDownloader):
                 total=self.progress.tasks[task_id].total + total if self.progress.tasks[task_id].total else total)
         else:
             task_id = await self.progress.add_task(description=path.name, total=total)
-        p_sema = asyncio.Semaphore(self.part_concurrency)
+        if self.pipe_clip:
+            await self._pipe_clip(mirrors, parts, init_data, path, task_id,
+                                  ['-ss', str(s), '-t', str(end_time - start_time)])
+            if not upper:
+                await self.progress.update(task_id, visible=False)
+                self.logger.info(f"[cyan]已完成[/cyan] {path.name}")
+            return path
+        if self.preallocate:
+            # parts are written back to back, so the clip file is complete without merging
+            path_tmp = path.with_name(f'{path.name}.tmp')
+            ranges, offset = [], len(init_data) if init_data else 0
+            for start, end in parts:
+                ranges.append(PartRange(start, end, shift=offset - start))
+                offset += end - start + 1
+            await self._get_ranges(mirrors, path_tmp, ranges, task_id, total=total, validators=index.validators,
+                                   prefix=init_data)
+        else:
+            path_tmp = path.with_name(str(uuid.uuid4()))
+            p_sema = asyncio.Semaphore(self.part_concurrency)
 
-        async def get_seg(part_range: Tuple[int, int]):
-            async with p_sema:
-                return await self._get_file_part(urls, path=path, part_range=part_range, task_id=task_id)
+            async def get_seg(part_range: Tuple[int, int]):
+                async with p_sema:
+                    return await self._get_file_part(mirrors, path=path, part_range=part_range, task_id=task_id)
 
-        file_list = await asyncio.gather(*[get_seg(part_range) for part_range in parts])
-        path_tmp = path.with_name(str(uuid.uuid4()))
-        await merge_files(file_list, path_tmp)
+            file_list = []
+            if init_data:
+                init_path = path.with_name(f'{path.name}.{init_start}-{init_end}')
+                async with aiofiles.open(init_path, 'wb') as f:
+                    await f.write(init_data)
+                await self.progress.update(task_id, advance=len(init_data))
+                file_list.append(init_path)
+            file_list.extend(await asyncio.gather(*[get_seg(part_range) for part_range in parts]))
+            await merge_files(file_list, path_tmp)
         # fix time range
         cmd = ['ffmpeg', '-ss', str(s), '-t', str(end_time - start_time), '-i', str(path_tmp),
                '-codec', 'copy', '-loglevel', 'quiet', '-f', 'mp4', str(path)]
-        await run_process(cmd)
+        await self.ffmpeg_pool.run(cmd)
         os.remove(path_tmp)
         if not upper:  # no upstream task
             await self.progress.update(task_id, visible=False)
             self.logger.info(f"[cyan]已完成[/cyan] {path.name}")
         return path
 
+    async def _get_media_index(self, mirrors: MirrorSelector, init_range: str, seg_range: str) -> MediaIndex:
+        """
+        get the parsed sidx and init segment of a DASH media, from index_cache if possible
+
+        :param mirrors:
+        :param init_range: xxx-xxx
+        :param seg_range: xxx-xxx
+        :return:
+        """
+        key = self.index_cache.key(mirrors.urls[0], init_range, seg_range) if self.index_cache else None
+        if key and (index := self.index_cache.get(key)):
+            self.logger.debug(f"media index cache hit {key}")
+            return index
+        init_start, init_end = map(int, init_range.split('-'))
+        seg_start, seg_end = map(int, seg_range.split('-'))
+        if init_end + 1 == seg_start:  # init segment is followed by sidx, get them in one request
+            res = await req_retry(self.client, mirrors, follow_redirects=True,
+                                  headers={'Range': f'bytes={init_start}-{seg_end}'}, extensions=self.media_extensions)
+            init_data, sidx_data = res.content[:init_end - init_start + 1], res.content[init_end - init_start + 1:]
+        else:
+            res = await req_retry(self.client, mirrors, follow_redirects=True,
+                                  headers={'Range': f'bytes={seg_start}-{seg_end}'}, extensions=self.media_extensions)
+            init_data, sidx_data = None, res.content
+        container = Box.parse(sidx_data)
+        assert container.type == b'sidx'
+        references = []
+        for ref in container.references:
+            if ref.reference_type != "MEDIA":
+                self.logger.debug("not a media", ref)
+                continue
+            references.append((ref.segment_duration, ref.referenced_size))
+        index = MediaIndex(container.timescale, references, init_data, self._validators(res))
+        if key:
+            self.index_cache.put(key, index)
+        return index
+
+    async def _pipe_clip(self, mirrors: MirrorSelector, parts: List[Tuple[int, int]], init_data: Optional[bytes],
+                         path: Path, task_id, clip_args: List[str]):
+        """
+        download parts by PIPE_CHUNK_SIZE requests and write them to ffmpeg's stdin in order
+
+        :param mirrors:
+        :param parts: byte ranges of the clip source
+        :param init_data: init segment before parts, if already downloaded
+        :param path: output path
+        :param task_id:
+        :param clip_args: ffmpeg input args to cut the clip
+        :return:
+        """
+        chunks = [(i, min(i + self.PIPE_CHUNK_SIZE - 1, end))
+                  for start, end in parts for i in range(start, end + 1, self.PIPE_CHUNK_SIZE)]
+        # a slot is held from request until the data is written to ffmpeg
+        p_sema = asyncio.Semaphore(self.part_concurrency)
+
+        async def get_chunk(chunk_range: Tuple[int, int]) -> bytes:
+            await p_sema.acquire()
+            res = await req_retry(self.client, mirrors, follow_redirects=True,
+                                  headers={'Range': f'bytes={chunk_range[0]}-{chunk_range[1]}'},
+                                  extensions=self.media_extensions)
+            await self.progress.update(task_id, advance=len(res.content))
+            await self._check_speed(len(res.content), task_id)
+            return res.content
+
+        path_tmp = path.with_name(f'{path.name}.tmp')
+        cmd = ['ffmpeg', *clip_args, '-i', 'pipe:0', '-codec', 'copy', '-loglevel', 'quiet', '-f', 'mp4', '-y',
+               str(path_tmp)]
+        tasks = [asyncio.create_task(get_chunk(c)) for c in chunks]  # created in order to acquire slots in order
+        try:
+            async with self.ffmpeg_pool.slot(), \
+                    await open_process(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as process:
+                try:
+                    if init_data:
+                        await process.stdin.send(init_data)
+                        await self.progress.update(task_id, advance=len(init_data))
+                    for t in tasks:
+                        data = await t
+                        await process.stdin.send(data)
+                        p_sema.release()
+                except BrokenResourceError:  # ffmpeg has got enough data and exited
+                    self.logger.debug(f"{path.name} ffmpeg exited before the end of input")
+                finally:
+                    await process.stdin.aclose()
+                await process.wait()
+        finally:
+            for t in tasks:
+                t.cancel()
+        if process.returncode != 0:
+            if path_tmp.exists():
+                os.remove(path_tmp)
+            raise Exception(f"ffmpeg exited with code {process.returncode} for <{path.name}>")
+        os.replace(path_tmp, path)
+
+    @staticmethod
+    def _coalesce(parts: List[Tuple[int, int]], n: int) -> List[Tuple[int, int]]:
+        """merge byte-contiguous parts and cut them into about n ranges of similar size"""
+        spans = []
+        for start, end in parts:
+            if spans and spans[-1][1] + 1 == start:
+                spans[-1][1] = end
+            else:
+                spans.append([start, end])
+        size = max(1, -(-sum(end - start + 1 for start, end in spans) // n))
+        res = []
+        for start, end in spans:
+            for i in range(start, end + 1, size):
+                res.append((i, min(i + size - 1, end)))
+        return res
+
     async def get_file(self, url_or_urls: Union[str, Iterable[str]], path: Path,
                        url_name: bool = True, task_id=None) -> Path:
         """
@@ -144,7 +429,7 @@ class BaseDownloaderPart(BaseDownloader):
         :param task_id: if not provided, a new progress task will be created
         :return: downloaded file path
         """
-        urls = [url_or_urls] if isinstance(url_or_urls, str) else [url for url in url_or_urls]
+        mirrors = MirrorSelector([url_or_urls] if isinstance(url_or_urls, str) else url_or_urls)
         upper = task_id is not None and self.progress.tasks[task_id].fields.get('upper', None)
 
         if not url_name:
@@ -154,65 +439,249 @@ class BaseDownloaderPart(BaseDownloader):
                     self.logger.info(f'[green]已存在[/green] {path.name}')
                 return path
 
-        total, req_filename = await self._pre_req(urls)
+        # the probe response keeps streaming the file from byte 0 and serves as the first part
+        probe, total, req_filename, validators = await self._pre_req(mirrors)
+        try:
+            if url_name:
+                file_name = req_filename if req_filename else str(mirrors.urls[0]).split('/')[-1].split('?')[0]
+                path /= file_name
+                exist, path = path_check(path)
+                if exist:
+                    if not upper:
+                        self.logger.info(f'[green]已存在[/green] {path.name}')
+                    return path
 
-        if url_name:
-            file_name = req_filename if req_filename else str(urls[0]).split('/')[-1].split('?')[0]
-            path /= file_name
-            exist, path = path_check(path)
-            if exist:
-                if not upper:
-                    self.logger.info(f'[green]已存在[/green] {path.name}')
-                return path
-
-        if task_id is not None:
-            await self.progress.update(
-                task_id,
-                total=self.progress.tasks[task_id].total + total if self.progress.tasks[task_id].total else total)
-        else:
-            task_id = await self.progress.add_task(description=path.name, total=total)
-        part_length = total // self.part_concurrency
-        cors = []
-        for i in range(self.part_concurrency):
-            start = i * part_length
-            end = (i + 1) * part_length - 1 if i < self.part_concurrency - 1 else total - 1
-            cors.append(self._get_file_part(urls, path=path, part_range=(start, end), task_id=task_id))
-        file_list = await asyncio.gather(*cors)
-        await merge_files(file_list, new_path=path)
+            if task_id is not None:
+                await self.progress.update(
+                    task_id,
+                    total=self.progress.tasks[task_id].total + total if self.progress.tasks[task_id].total else total)
+            else:
+                task_id = await self.progress.add_task(description=path.name, total=total)
+            part_length = total // self.part_concurrency
+            part_ranges = []
+            for i in range(self.part_concurrency):
+                start = i * part_length
+                end = (i + 1) * part_length - 1 if i < self.part_concurrency - 1 else total - 1
+                part_ranges.append((start, end))
+            if self.preallocate:
+                tmp_path = path.with_name(f'{path.name}.tmp')
+                await self._get_ranges(mirrors, tmp_path, [PartRange(start, end) for start, end in part_ranges],
+                                       task_id, total=total, validators=validators, probe=probe)
+                os.replace(tmp_path, path)
+            else:
+                cors = [self._get_file_part(mirrors, path=path, part_range=part_range, task_id=task_id,
+                                            response=probe if i == 0 else None)
+                        for i, part_range in enumerate(part_ranges)]
+                file_list = await asyncio.gather(*cors)
+                await merge_files(file_list, new_path=path)
+        finally:
+            await probe.aclose()  # in case it is not used
         if not upper:
             await self.progress.update(task_id, visible=False)
             self.logger.info(f"[cyan]已完成[/cyan] {path.name}")
         return path
 
-    async def _get_file_part(self, urls: List[Union[str, httpx.URL]], path: Path, part_range: Tuple[int, int],
-                             task_id) -> Path:
-        start, end = part_range
-        part_path = path.with_name(f'{path.name}.{part_range[0]}{part_range[1]}')
-        exist, part_path = path_check(part_path)
-        if exist:
-            downloaded = os.path.getsize(part_path)
-            start += downloaded
-            await self.progress.update(task_id, advance=downloaded)
-        if start > end:
-            return part_path  # skip already finished
-        url_idx = random.randint(0, len(urls) - 1)
+    async def _get_ranges(self, mirrors: MirrorSelector, path: Path, ranges: List[PartRange], task_id,
+                          total: int, validators: Dict[str, str], probe: httpx.Response = None,
+                          prefix: bytes = None):
+        """
+        download ranges into the preallocated file path by part_concurrency work-stealing streams,
+        resume from the journal of path if the remote file is unchanged
+
+        :param mirrors:
+        :param path: the file to preallocate
+        :param ranges: ranges to download, their local positions should be inside the file
+        :param task_id:
+        :param total: file size
+        :param validators: remote file identity
+        :param probe: a streaming response from byte 0, used by the range starting at 0
+        :param prefix: data already in memory for the beginning of the file
+        :return:
+        """
+        if journal := PartJournal.load(path, total, validators):
+            ranges = [PartRange(start - r.shift, end - r.shift, r.shift)
+                      for r in ranges for start, end in journal.missing(r.offset, r.offset + len(r) - 1)]
+            await self.progress.update(task_id, advance=journal.committed)
+            self.logger.debug(f"{path.name} resume from journal, {journal.committed} bytes committed")
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, preallocate_file, path, total)
+            journal = PartJournal(path, total, validators)
+            journal.save()
+        if prefix and journal.missing(0, len(prefix) - 1):
+            async with aiofiles.open(path, 'r+b') as f:
+                await f.write(prefix)
+            journal.commit(0, len(prefix) - 1)
+            await self.progress.update(task_id, advance=len(prefix))
+        probes = [probe] if probe else []
+        if probe and not any(r.start == 0 for r in ranges):  # resumed, do not hold the connection till the end
+            await probe.aclose()
+            probes = []
+        scheduler = RangeScheduler(ranges, min_split=self.MIN_SPLIT_SIZE)
+        if not self.adaptive_concurrency:
+            async def worker():
+                while (r := scheduler.acquire()) is not None:
+                    try:
+                        await self._get_file_part(mirrors, path=path, part_range=r, task_id=task_id, journal=journal,
+                                                  response=self._take_probe(r, probes))
+                    finally:
+                        scheduler.release(r)
+
+            await asyncio.gather(*[worker() for _ in range(self.part_concurrency)])
+        else:
+            host = httpx.URL(str(mirrors.urls[0])).host
+            controller = AIMDController(self._host_concurrency.get(host, self.part_concurrency),
+                                        upper=self.MAX_PART_CONCURRENCY, interval=self.ADAPTIVE_INTERVAL)
+            await self._get_ranges_adaptive(mirrors, path, scheduler, controller, task_id, journal, probes)
+            self._host_concurrency[host] = controller.limit
+            self.logger.debug(f"{path.name} learned part concurrency {controller.limit} for {host}")
+        journal.remove()
+        self.logger.debug(f"{path.name} finished with {scheduler.splits} range splits")
+
+    async def _get_ranges_adaptive(self, mirrors: MirrorSelector, path: Path, scheduler: RangeScheduler,
+                                   controller: AIMDController, task_id, journal: PartJournal,
+                                   probes: List[httpx.Response]):
+        async def worker():
+            try:
+                while (r := scheduler.acquire()) is not None:
+                    try:
+                        await self._get_file_part(mirrors, path=path, part_range=r, task_id=task_id,
+                                                  controller=controller, journal=journal,
+                                                  response=self._take_probe(r, probes))
+                    finally:
+                        scheduler.release(r)
+                    if controller.overloaded:
+                        break
+            finally:
+                controller.running -= 1
+
+        tasks = []
 
+        def spawn():
+            while controller.running < controller.limit and scheduler.remaining > 0:
+                controller.running += 1
+                tasks.append(asyncio.create_task(worker()))
+
+        async def monitor():
+            pre_remaining = scheduler.remaining
+            while True:
+                await asyncio.sleep(controller.interval)
+                remaining = scheduler.remaining
+                controller.on_sample((pre_remaining - remaining) / controller.interval)
+                pre_remaining = remaining
+                spawn()
+
+        spawn()
+        monitor_task = asyncio.create_task(monitor())
+        try:
+            while alive := [t for t in tasks if not t.done()]:
+                done, _ = await asyncio.wait(alive, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    t.result()  # raise exception if any
+                spawn()  # in case of ranges given back by retired streams
+        finally:
+            monitor_task.cancel()
+            for t in tasks:
+                t.cancel()
+
+    @staticmethod
+    def _take_probe(r: PartRange, probes: List[httpx.Response]) -> Optional[httpx.Response]:
+        """the probe response streaming from byte 0 can only be used once by the range starting at 0"""
+        if r.start == 0 and probes:
+            return probes.pop()
+
+    @staticmethod
+    @asynccontextmanager
+    async def _opened(res: httpx.Response):
+        try:
+            yield res
+        finally:
+            await res.aclose()
+
+    async def _get_file_part(self, mirrors: MirrorSelector, path: Path,
+                             part_range: Union[Tuple[int, int], PartRange], task_id,
+                             controller: AIMDController = None, journal: PartJournal = None,
+                             response: httpx.Response = None) -> Path:
+        """
+        download a byte range of the remote file
+
+        :param mirrors: file url with backups
+        :param path: target file path
+        :param part_range: (start, end) byte range of the remote file which is written to a standalone part file
+            next to path, or a PartRange which is written into the preallocated file path at its offset
+        :param task_id:
+        :param controller: adaptive concurrency controller, the stream gives up the rest of part_range on error
+            if there are too many streams
+        :param journal: the journal of the preallocated file to commit written bytes
+        :param response: a streaming response from byte 0 which is used by the first try if part_range starts at 0,
+            it will be closed
+        :return: the file that the range has been written to
+        """
+        if isinstance(part_range, PartRange):
+            r, part_path, mode = part_range, path, 'r+b'
+        else:
+            r, mode = PartRange(*part_range), 'ab'
+            part_path = path.with_name(f'{path.name}.{part_range[0]}-{part_range[1]}')
+            exist, part_path = path_check(part_path)
+            if exist:
+                downloaded = os.path.getsize(part_path)
+                r.start += downloaded
+                await self.progress.update(task_id, advance=downloaded)
+        if response is not None and (len(r) == 0 or r.start != 0):
+            await response.aclose()
+            response = None
+        if len(r) == 0:
+            return part_path  # skip already finished
         for times in range(1 + self.stream_retry):
+            a = time.monotonic()
+            stream_start = r.start
+            if response is not None:  # reuse, it has been reported to mirrors by req_retry
+                url_idx, stream, response = None, self._opened(response), None
+            else:
+                url_idx = mirrors.choose()
+                stream = self.client.stream("GET", mirrors.urls[url_idx], follow_redirects=True,
+                                            headers={'Range': f'bytes={r.start}-{r.end}'},
+                                            extensions=self.media_extensions)
             try:
-                async with \
-                        self.client.stream("GET", urls[url_idx], follow_redirects=True,
-                                           headers={'Range': f'bytes={start}-{end}'}) as r, \
-                        self._stream_context(times), \
-                        aiofiles.open(part_path, 'ab') as f:
-                    r.raise_for_status()
-                    if r.history:  # avoid twice redirect
-                        urls[url_idx] = r.url
-                    async for chunk in r.aiter_bytes(chunk_size=self.chunk_size):
-                        await f.write(chunk)
-                        await self.progress.update(task_id, advance=len(chunk))
-                        await self._check_speed(len(chunk))
+                async with stream as res, self._stream_context(times), aiofiles.open(part_path, mode) as f:
+                    res.raise_for_status()
+                    ttfb = time.monotonic() - a
+                    if res.history and url_idx is not None:  # avoid twice redirect
+                        mirrors.urls[url_idx] = res.url
+                    if mode == 'r+b':
+                        await f.seek(r.offset)
+                    committed, commit_time = r.offset, time.monotonic()
+                    try:
+                        async for chunk in res.aiter_bytes(chunk_size=self.chunk_size):
+                            # end may have been cut by the scheduler
+                            size = min(len(chunk), len(r))
+                            # move start before writing to keep the scheduler from splitting inside the chunk
+                            r.start += size
+                            await f.write(chunk[:size] if size < len(chunk) else chunk)
+                            await self.progress.advance(task_id, size)
+                            await self._check_speed(size, task_id)
+                            if journal and time.monotonic() - commit_time > journal.SAVE_INTERVAL:
+                                await f.flush()
+                                journal.commit(committed, r.offset - 1)
+                                committed, commit_time = r.offset, time.monotonic()
+                            if len(r) == 0:
+                                break
+                    finally:
+                        await self.progress.flush(task_id)
+                        # commit what has been written even if the stream is broken
+                        if journal and r.offset > committed:
+                            await f.flush()
+                            journal.commit(committed, r.offset - 1)
+                if url_idx is not None:
+                    mirrors.report(url_idx, ttfb=ttfb, size=r.start - stream_start,
+                                   elapsed=time.monotonic() - a - ttfb)
                 break
             except (httpx.HTTPStatusError, httpx.TransportError):
+                if url_idx is not None:
+                    mirrors.report_error(url_idx)
+                if controller:
+                    controller.on_error()
+                    if controller.overloaded:
+                        return part_path
                 continue
         else:
             raise Exception(f"STREAM 超过重复次数 {part_path.name}")
@@ -1,15 +1,17 @@
 import asyncio
 import functools
 from pathlib import Path
-from typing import Union, Sequence, Tuple, List
+from typing import Union, Sequence, Tuple, List, Set
 import aiofiles
 import httpx
 from datetime import datetime, timedelta
 import os
-from anyio import run_process
+from bilix.client_pool import client_registry
 import bilix.api.bilibili as api
 from bilix._handle import Handler
 from bilix.download.base_downloader_part import BaseDownloaderPart
+from bilix.download.mp4_mux import mux_dash, MuxError
+from bilix.download.info_cache import video_info_cache
 from bilix._process import SingletonPPE
 from bilix.utils import legal_title, req_retry, cors_slice, parse_bilibili_url, valid_sess_data, t2s, json2srt, \
     path_check
@@ -29,10 +31,18 @@ class DownloaderBilibili(BaseDownloaderPart):
             progress=None,
             logger=None,
             part_concurrency: int = 10,
+            preallocate: bool = True,
+            adaptive_concurrency: bool = False,
+            pipe_clip: bool = False,
+            index_cache: bool = True,
+            transport_strategy: str = 'shared',
+            media_connections: int = 4,
             # unique params
             sess_data: str = None,
             video_concurrency: Union[int, asyncio.Semaphore] = 3,
             hierarchy: bool = True,
+            native_mux: bool = False,
+            info_cache: bool = True,
     ):
         """
 
@@ -44,10 +54,21 @@ class DownloaderBilibili(BaseDownloaderPart):
         :param logger:
         :param sess_data: bilibili SESSDATA cookie
         :param part_concurrency: 媒体分段并发数
+        :param preallocate: 是否预分配媒体文件并由各分段直接写入对应位置（无需合并分段文件），下载进度记录在进度文件中用于断点续传
+        :param adaptive_concurrency: 是否根据实际速度及错误自动调整分段并发数（仅preallocate模式下生效）
+        :param pipe_clip: 下载切片时是否边下载边将数据按顺序传给ffmpeg（不支持断点续传）
+        :param index_cache: 下载切片时是否在内存和磁盘中缓存媒体的索引（sidx）和初始化片段，同一视频的多次切片无需重复请求
+        :param transport_strategy: 媒体流的连接方式，'shared'与API请求共用连接（http2时所有分段复用同一连接），
+            'http1'或'http2'则将媒体流分散到每个域名media_connections个连接上，在高延迟或丢包的网络下可以提高速度
+        :param media_connections: 'http1'或'http2'方式下每个域名的连接数
         :param video_concurrency: 视频并发数
         :param hierarchy: 是否使用层级目录
+        :param native_mux: 是否不经过ffmpeg直接合并音视频（flac、杜比音频及切片仍使用ffmpeg），输出为分段MP4（fragmented MP4），
+            由文件末尾的mfra索引用于跳转，而ffmpeg输出为普通MP4
+        :param info_cache: 是否在内存和磁盘中缓存视频信息，重复解析同一视频时无需再次请求（视频流地址的缓存时间较短，
+            被拒绝（403/404）时重新获取一次）
         """
-        client = client or httpx.AsyncClient(**api.dft_client_settings)
+        client = client or client_registry.client(**api.dft_client_settings)
         super(DownloaderBilibili, self).__init__(
             client=client,
             browser=browser,
@@ -56,6 +77,12 @@ class DownloaderBilibili(BaseDownloaderPart):
             progress=progress,
             logger=logger,
             part_concurrency=part_concurrency,
+            preallocate=preallocate,
+            adaptive_concurrency=adaptive_concurrency,
+            pipe_clip=pipe_clip,
+            index_cache=index_cache,
+            transport_strategy=transport_strategy,
+            media_connections=media_connections,
         )
         client.cookies.set('SESSDATA', valid_sess_data(sess_data))
         self._cate_meta = None
@@ -63,6 +90,26 @@ class DownloaderBilibili(BaseDownloaderPart):
         self.api_sema = asyncio.Semaphore(video_concurrency)
         self.hierarchy = hierarchy
         self.title_overflow = 50
+        self.native_mux = native_mux
+        self.info_cache = video_info_cache if info_cache else None
+        # urls whose video info is requested again after their cached stream urls were refused
+        self._refreshing: Set[str] = set()
+
+    async def _get_video_info(self, url: str, streams: bool = True, refresh: bool = False) -> api.VideoInfo:
+        """
+        get video info from info_cache if possible
+
+        :param url:
+        :param streams: whether the stream urls are used, expired ones are fine if not
+        :param refresh: drop the cached one and request again, like when its stream urls are refused
+        :return:
+        """
+        if not self.info_cache:
+            return await api.get_video_info(self.client, url)
+        user = next((c.value for c in self.client.cookies.jar if c.name == 'SESSDATA'), '')
+        if refresh:
+            await self.info_cache.invalidate(url, user)
+        return await self.info_cache.resolve(url, lambda: api.get_video_info(self.client, url), user, streams)
 
     async def get_collect_or_list(self, url, path: Path = Path('.'),
                                   quality=0, image=False, subtitle=False, dm=False, only_audio=False, codec: str = ''):
@@ -279,7 +326,7 @@ class DownloaderBilibili(BaseDownloaderPart):
         """
         try:
             async with self.api_sema:
-                video_info = await api.get_video_info(self.client, url)
+                video_info = await self._get_video_info(url)
         except (APIResourceError, APIUnsupportedError) as e:
             return self.logger.warning(e)
         if self.hierarchy and len(video_info.pages) > 1:
@@ -315,7 +362,7 @@ class DownloaderBilibili(BaseDownloaderPart):
         async with self.v_sema:
             if not video_info:
                 try:
-                    video_info = await api.get_video_info(self.client, url)
+                    video_info = await self._get_video_info(url)
                 except (APIResourceError, APIUnsupportedError) as e:
                     return self.logger.warning(e)
             p_name = legal_title(video_info.pages[video_info.p].p_name)
@@ -402,32 +449,73 @@ class DownloaderBilibili(BaseDownloaderPart):
                     width, height = (video.width, video.height) if video_info.dash else (1920, 1080)
                     add_cors.append(self.get_dm(
                         url, path=extra_path, convert_func=self._dm2ass_factory(width, height), video_info=video_info))
-            path_lst, _ = await asyncio.gather(asyncio.gather(*media_cors), asyncio.gather(*add_cors))
+            media_tasks = [asyncio.ensure_future(cor) for cor in media_cors]
+            add_tasks = [asyncio.ensure_future(cor) for cor in add_cors]
+            try:
+                path_lst, _ = await asyncio.gather(asyncio.gather(*media_tasks), asyncio.gather(*add_tasks))
+            except httpx.HTTPStatusError as e:
+                # stream urls of a cached video info may be refused before their deadline, request it once again
+                if not self.info_cache or e.response.status_code not in (403, 404) or url in self._refreshing:
+                    raise
+                for t in media_tasks + add_tasks:
+                    t.cancel()
+                await asyncio.gather(*media_tasks, *add_tasks, return_exceptions=True)
+                self.logger.warning(f"{task_name} 视频流地址已失效，重新获取视频信息 {e.response.status_code}")
+                await self.progress.update(task_id, visible=False)
+                stale = True
+            else:
+                stale = False
+        if stale:
+            self._refreshing.add(url)
+            try:
+                try:
+                    video_info = await self._get_video_info(url, refresh=True)
+                except (APIResourceError, APIUnsupportedError) as e:
+                    return self.logger.warning(e)
+                return await self.get_video(url, path, quality=quality, image=image, subtitle=subtitle, dm=dm,
+                                            only_audio=only_audio, codec=codec, time_range=time_range,
+                                            video_info=video_info)
+            finally:
+                self._refreshing.discard(url)
 
         upper = self.progress.tasks[task_id].fields.get('upper', None)
         if upper:
-            cmd = ['ffmpeg']
-            if upper == 'concat':
-                tmp_file = media_path.with_suffix('.txt')
-                with open(tmp_file, 'w') as f:
+            # clips cut by ffmpeg are not fragmented, so they are muxed by ffmpeg too
+            if not (upper == 'va' and not time_range and await self._native_mux(path_lst, media_path, audio)):
+                cmd = ['ffmpeg']
+                if upper == 'concat':
+                    tmp_file = media_path.with_suffix('.txt')
+                    with open(tmp_file, 'w') as f:
+                        for sub in path_lst:
+                            f.write(f"file {sub.name}\n")
+                    cmd.extend(('-f', 'concat', '-safe', '0', '-i', str(tmp_file)))
+                    path_lst.append(tmp_file)
+                else:
                     for sub in path_lst:
-                        f.write(f"file {sub.name}\n")
-                cmd.extend(('-f', 'concat', '-safe', '0', '-i', str(tmp_file)))
-                path_lst.append(tmp_file)
-            else:
-                for sub in path_lst:
-                    cmd.extend(['-i', str(sub)])
-            cmd.extend(['-codec', 'copy', '-loglevel', 'quiet'])
-            # ffmpeg: flac in MP4 support is experimental, add '-strict -2' if you want to use it.
-            if upper == 'va' and audio.codec == 'fLaC':
-                cmd.extend(['-strict', '-2'])
-            cmd.append(str(media_path))
-            await run_process(cmd)
+                        cmd.extend(['-i', str(sub)])
+                cmd.extend(['-codec', 'copy', '-loglevel', 'quiet'])
+                # ffmpeg: flac in MP4 support is experimental, add '-strict -2' if you want to use it.
+                if upper == 'va' and audio.codec == 'fLaC':
+                    cmd.extend(['-strict', '-2'])
+                cmd.append(str(media_path))
+                await self.ffmpeg_pool.run(cmd)
             for f in path_lst:
                 os.remove(f)
             self.logger.info(f'[cyan]已完成[/cyan] {media_path.name}')
         await self.progress.update(task_id, visible=False)
 
+    async def _native_mux(self, path_lst: List[Path], media_path: Path, audio: api.Media) -> bool:
+        """mux the downloaded video and audio in process, False if ffmpeg is needed"""
+        if not self.native_mux or audio.suffix in ('.flac', '.eac3'):
+            return False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, mux_dash, path_lst[0], path_lst[1], media_path)
+        except (MuxError, OSError) as e:
+            media_path.with_name(f'{media_path.name}.tmp').unlink(missing_ok=True)
+            self.logger.debug(f"{media_path.name} 无法直接合并，使用ffmpeg {e}")
+            return False
+        return True
+
     @staticmethod
     def _dm2ass_factory(width: int, height: int):
         async def dm2ass(protobuf_bytes: bytes) -> bytes:
@@ -449,7 +537,7 @@ class DownloaderBilibili(BaseDownloaderPart):
         :return:
         """
         if not video_info:
-            video_info = await api.get_video_info(self.client, url)
+            video_info = await self._get_video_info(url, streams=False)
         aid, cid = video_info.aid, video_info.cid
         file_type = '.' + ('pb' if not convert_func else convert_func.__name__.split('2')[-1])
         p_name = video_info.pages[video_info.p].p_name
@@ -486,7 +574,7 @@ class DownloaderBilibili(BaseDownloaderPart):
         :return:
         """
         if not video_info:
-            video_info = await api.get_video_info(self.client, url)
+            video_info = await self._get_video_info(url, streams=False)
         p, cid = video_info.p, video_info.cid
         p_name = video_info.pages[p].p_name
         try:
@@ -1,12 +1,14 @@
 import asyncio
 from pathlib import Path
-from typing import Union
+from typing import Union, Tuple
 import httpx
 
+from bilix.client_pool import client_registry
 import bilix.api.cctv as api
 from bilix._handle import Handler
 from bilix.download.base_downloader_m3u8 import BaseDownloaderM3u8
 from bilix.exception import HandleMethodError
+from bilix.utils import legal_title, t2s
 
 
 class DownloaderCctv(BaseDownloaderM3u8):
@@ -23,7 +25,7 @@ class DownloaderCctv(BaseDownloaderM3u8):
             # unique params
             hierarchy: bool = True,
     ):
-        client = client or httpx.AsyncClient(**api.dft_client_settings)
+        client = client or client_registry.client(**api.dft_client_settings)
         super(DownloaderCctv, self).__init__(
             client=client,
             browser=browser,
@@ -36,25 +38,26 @@ class DownloaderCctv(BaseDownloaderM3u8):
         )
         self.hierarchy = hierarchy
 
-    async def get_series(self, url: str, path: Path = Path('.'), quality=0):
+    async def get_series(self, url: str, path: Path = Path('.'), quality=0, time_range: Tuple[int, int] = None):
         pid, vide, vida = await api.get_id(self.client, url)
         if vida is None:  # 单个视频
-            await self.get_video(pid, quality=quality)
+            await self.get_video(pid, quality=quality, time_range=time_range)
         else:  # 剧集
             title, pids = await api.get_series_info(self.client, vide, vida)
             if self.hierarchy:
                 path /= title
                 path.mkdir(parents=True, exist_ok=True)
-            await asyncio.gather(*[self.get_video(pid, path, quality) for pid in pids])
+            await asyncio.gather(*[self.get_video(pid, path, quality, time_range) for pid in pids])
 
-    async def get_video(self, url_or_pid: str, path: Path = Path('.'), quality=0):
+    async def get_video(self, url_or_pid: str, path: Path = Path('.'), quality=0, time_range: Tuple[int, int] = None):
         if url_or_pid.startswith('http'):
             pid, _, _ = await api.get_id(self.client, url_or_pid)
         else:
             pid = url_or_pid
         title, m3u8_urls = await api.get_media_info(self.client, pid)
         m3u8_url = m3u8_urls[min(quality, len(m3u8_urls) - 1)]
-        file_path = await self.get_m3u8_video(m3u8_url,  path / f"{title}.ts")
+        name = legal_title(title, *map(t2s, time_range)) if time_range else title
+        file_path = await self.get_m3u8_video(m3u8_url, path / f"{name}.ts", time_range=time_range)
         return file_path
 
 
@@ -1,12 +1,14 @@
 import asyncio
 from pathlib import Path
-from typing import Union
+from typing import Union, Tuple
 import httpx
+from bilix.client_pool import client_registry
 import bilix.api.hanime1 as api
 from bilix._handle import Handler
 from bilix.download.base_downloader_part import BaseDownloaderPart
 from bilix.download.base_downloader_m3u8 import BaseDownloaderM3u8
 from bilix.exception import HandleMethodError
+from bilix.utils import legal_title, t2s
 
 
 class DownloaderHanime1:
@@ -21,7 +23,7 @@ class DownloaderHanime1:
             part_concurrency: int = 10,
             video_concurrency: Union[int, asyncio.Semaphore] = 3,
     ):
-        self.client = client or httpx.AsyncClient(**api.dft_client_settings)
+        self.client = client or client_registry.client(**api.dft_client_settings)
         self.m3u8_dl = BaseDownloaderM3u8(
             client=self.client,
             browser=browser,
@@ -42,11 +44,14 @@ class DownloaderHanime1:
             part_concurrency=part_concurrency,
         )
 
-    async def get_video(self, url: str, path: Path = Path('.'), image=False):
+    async def get_video(self, url: str, path: Path = Path('.'), image=False, time_range: Tuple[int, int] = None):
         video_info = await api.get_video_info(self.client, url)
         video_url = video_info.video_url
+        # time_range only works for m3u8
+        name = legal_title(video_info.title, *map(t2s, time_range)) if time_range else video_info.title
         cors = [
-            self.m3u8_dl.get_m3u8_video(video_url, path=path / f'{video_info.title}.ts') if '.m3u8' in video_url else
+            self.m3u8_dl.get_m3u8_video(video_url, path=path / f'{name}.ts', time_range=time_range)
+            if '.m3u8' in video_url else
             self.file_dl.get_file(video_url, path=path / f'{video_info.title}.mp4', url_name=False)]
         if image:
             cors.append(self.file_dl.get_static(video_info.img_url, path=path / video_info.title))
@@ -1,12 +1,14 @@
 import asyncio
 import re
 from pathlib import Path
-from typing import Union
+from typing import Union, Tuple
 import httpx
+from bilix.client_pool import client_registry
 import bilix.api.jable as api
 from bilix._handle import Handler
 from bilix.download.base_downloader_m3u8 import BaseDownloaderM3u8
 from bilix.exception import HandleMethodError
+from bilix.utils import legal_title, t2s
 
 
 class DownloaderJable(BaseDownloaderM3u8):
@@ -23,7 +25,7 @@ class DownloaderJable(BaseDownloaderM3u8):
             # unique params
             hierarchy: bool = True,
     ):
-        client = client or httpx.AsyncClient(**api.dft_client_settings)
+        client = client or client_registry.client(**api.dft_client_settings)
         super(DownloaderJable, self).__init__(
             client=client,
             browser=browser,
@@ -50,12 +52,13 @@ class DownloaderJable(BaseDownloaderM3u8):
             path.mkdir(parents=True, exist_ok=True)
         await asyncio.gather(*[self.get_video(url, path, image) for url in data['urls']])
 
-    async def get_video(self, url: str, path: Path = Path("."), image=True):
+    async def get_video(self, url: str, path: Path = Path("."), image=True, time_range: Tuple[int, int] = None):
         video_info = await api.get_video_info(self.client, url)
         if self.hierarchy:
             path /= f"{video_info.avid} {video_info.model_name}"
             path.mkdir(parents=True, exist_ok=True)
-        cors = [self.get_m3u8_video(m3u8_url=video_info.m3u8_url, path=path / f"{video_info.title}.ts", )]
+        name = legal_title(video_info.title, *map(t2s, time_range)) if time_range else video_info.title
+        cors = [self.get_m3u8_video(m3u8_url=video_info.m3u8_url, path=path / f"{name}.ts", time_range=time_range)]
         if image:
             cors.append(self.get_static(video_info.img_url, path=path / video_info.title, ))
         await asyncio.gather(*cors)
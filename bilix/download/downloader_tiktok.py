@@ -3,6 +3,7 @@ from pathlib import Path
 from typing import Union
 import httpx
 
+from bilix.client_pool import client_registry
 import bilix.api.tiktok as api
 from bilix._handle import Handler
 from bilix.download.base_downloader_part import BaseDownloaderPart
@@ -21,7 +22,7 @@ class DownloaderTikTok(BaseDownloaderPart):
             logger=None,
             part_concurrency: int = 10,
     ):
-        client = client or httpx.AsyncClient(**api.dft_client_settings)
+        client = client or client_registry.client(**api.dft_client_settings)
         super(DownloaderTikTok, self).__init__(
             client=client,
             browser=browser,
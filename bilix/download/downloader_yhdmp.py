@@ -1,11 +1,12 @@
 import asyncio
 from pathlib import Path
 import httpx
-from typing import Sequence, Union
+from typing import Sequence, Union, Tuple
 
+from bilix.client_pool import client_registry
 import bilix.api.yhdmp as api
 from bilix._handle import Handler
-from bilix.utils import legal_title, cors_slice
+from bilix.utils import legal_title, cors_slice, t2s
 from bilix.download.base_downloader_m3u8 import BaseDownloaderM3u8
 from bilix.exception import HandleMethodError
 
@@ -35,7 +36,7 @@ class DownloaderYhdmp(BaseDownloaderM3u8):
             part_concurrency=part_concurrency,
             video_concurrency=video_concurrency,
         )
-        self.api_client = api_client or httpx.AsyncClient(**api.dft_client_settings)
+        self.api_client = api_client or client_registry.client(**api.dft_client_settings)
         self.hierarchy = hierarchy
 
     async def get_series(self, url: str, path: Path = Path('.'), p_range: Sequence[int] = None):
@@ -63,10 +64,10 @@ class DownloaderYhdmp(BaseDownloaderM3u8):
             cors = cors_slice(cors, p_range)
         await asyncio.gather(*cors)
 
-    async def get_video(self, url: str, path: Path = Path('.')):
+    async def get_video(self, url: str, path: Path = Path('.'), time_range: Tuple[int, int] = None):
         video_info = await api.get_video_info(self.api_client, url)
-        name = legal_title(video_info.title, video_info.sub_title)
-        await self.get_m3u8_video(m3u8_url=video_info.m3u8_url, path=path / f'{name}.ts')
+        name = legal_title(video_info.title, video_info.sub_title, *map(t2s, time_range or ()))
+        await self.get_m3u8_video(m3u8_url=video_info.m3u8_url, path=path / f'{name}.ts', time_range=time_range)
 
 
 @Handler.register(name='樱花动漫P')
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager
+from subprocess import CompletedProcess
+from typing import List, Optional
+from anyio import run_process
+from bilix.log import logger
+
+
+class FFmpegPool:
+    def __init__(self, workers: Optional[int] = None):
+        """
+        Bounded pool of ffmpeg processes shared by downloaders of the process. Muxing waits for a free worker, so
+        transfers of the next videos go on while at most workers ffmpeg run.
+
+        :param workers: max ffmpeg processes, default to half of the cpu count
+        """
+        self._workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.running = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.
+        self._conds: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Condition]' = \
+            weakref.WeakKeyDictionary()
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers: int):
+        assert workers > 0
+        self._workers = workers
+        for loop, cond in list(self._conds.items()):  # more processes may start now
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda c=cond: asyncio.ensure_future(self._notify(c)))
+
+    @staticmethod
+    async def _notify(cond: asyncio.Condition):
+        async with cond:
+            cond.notify_all()
+
+    def _cond(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if loop not in self._conds:
+            self._conds[loop] = asyncio.Condition()
+        return self._conds[loop]
+
+    @asynccontextmanager
+    async def slot(self):
+        """hold a worker while an ffmpeg process runs in the context"""
+        cond = self._cond()
+        a = time.monotonic()
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            async with cond:
+                await cond.wait_for(lambda: self.running < self._workers)
+                self.running += 1
+        finally:
+            self.queued -= 1
+        wait = time.monotonic() - a
+        self.wait_time += wait
+        if wait > 1:
+            logger.debug(f"ffmpeg waited {wait:.1f}s for a worker, {self.queued} in queue")
+        try:
+            yield
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+        finally:
+            self.running -= 1
+            async with cond:
+                cond.notify()
+
+    async def run(self, cmd: List[str], **kwargs) -> CompletedProcess:
+        """
+        run ffmpeg in a worker
+
+        :param cmd: command like ['ffmpeg', '-i', ...]
+        :param kwargs: kwargs of anyio.run_process
+        :return:
+        """
+        async with self.slot():
+            return await run_process(cmd, **kwargs)
+
+    def stats(self) -> dict:
+        done = self.completed + self.failed
+        return {
+            'workers': self._workers,
+            'running': self.running,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait': self.wait_time / done if done else 0.,
+        }
+
+
+# bounds the ffmpeg processes of all downloaders together, not of each one
+ffmpeg_pool = FFmpegPool()
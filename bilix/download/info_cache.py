@@ -0,0 +1,254 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Dict, Union, Callable, Awaitable, Set
+from urllib.parse import urlsplit, parse_qs
+from bilix.api.bilibili import VideoInfo
+from bilix.log import logger
+from bilix.utils import cache_dir
+
+
+@dataclass
+class _Entry:
+    info: VideoInfo
+    fetched: float
+    # deadline of the stream urls given by the site, 0 if unknown
+    deadline: float = 0.
+
+
+def _stream_deadline(info: VideoInfo) -> float:
+    medias = (info.dash.videos + info.dash.audios) if info.dash else (info.other or [])
+    for m in medias:
+        if deadline := parse_qs(urlsplit(m.base_url).query).get('deadline'):
+            try:
+                return float(deadline[0])
+            except ValueError:
+                pass
+    return 0.
+
+
+class VideoInfoCache:
+    # stream urls are not used this close to their deadline
+    DEADLINE_MARGIN = 120.
+
+    def __init__(self, db_path: Union[str, Path, None] = None, max_memory: int = 256, max_disk: int = 4096,
+                 meta_ttl: float = 24 * 3600, stream_ttl: float = 30 * 60):
+        """
+        LRU cache of parsed VideoInfo in memory and in a sqlite database on disk. Metadata like title and pages
+        expire after meta_ttl, stream urls (dash and other) expire after stream_ttl or at their deadline. Concurrent
+        resolutions of the same key share one request. In async methods the database is used on a thread of its own.
+
+        :param db_path: sqlite database file, default $XDG_CACHE_HOME/bilix/video_info.sqlite3
+        :param max_memory: max entries in memory
+        :param max_disk: max entries on disk, the least recently used ones are removed
+        :param meta_ttl: seconds before metadata expire
+        :param stream_ttl: seconds before stream urls expire
+        """
+        self.db_path = Path(db_path) if db_path else cache_dir() / 'video_info.sqlite3'
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.meta_ttl = meta_ttl
+        self.stream_ttl = stream_ttl
+        self._memory: OrderedDict[str, _Entry] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_failed = False
+        self._inflight: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]' = \
+            weakref.WeakKeyDictionary()
+        # one thread so the connection is opened once and used in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bilix-info-cache')
+
+    @staticmethod
+    def key(url: str, user: str = '') -> str:
+        """
+        video identity of a url, stream urls depend on the login so user (like SESSDATA) is a part of it
+
+        :param url:
+        :param user:
+        :return:
+        """
+        if m := re.search(r'/video/(BV\w+|av\d+)', url, re.I):
+            p = parse_qs(urlsplit(url).query).get('p', ['1'])[0]
+            key = f"{m.group(1)}?p={p}"
+        elif m := re.search(r'/bangumi/play/(ep|ss)\d+', url):
+            key = m.group(0)
+        else:
+            key = url
+        if user:
+            key = f"{hashlib.sha1(user.encode()).hexdigest()[:16]}:{key}"
+        return key
+
+    def _conn(self) -> Optional[sqlite3.Connection]:
+        if self._db is None and not self._db_failed:
+            try:
+                self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+                self._db.execute("CREATE TABLE IF NOT EXISTS video_info (key TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                                 "fetched REAL NOT NULL, deadline REAL NOT NULL, used REAL NOT NULL)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS video_info_used ON video_info (used)")
+            except (OSError, sqlite3.Error) as e:
+                logger.debug(f"video info cache is memory only, failed to open {self.db_path} {e}")
+                self._db, self._db_failed = None, True
+        return self._db
+
+    def _fresh(self, entry: _Entry, streams: bool) -> bool:
+        now = time.time()
+        if now >= entry.fetched + self.meta_ttl:
+            return False
+        if streams:
+            if now >= entry.fetched + self.stream_ttl:
+                return False
+            if entry.deadline and now >= entry.deadline - self.DEADLINE_MARGIN:
+                return False
+        return True
+
+    def get(self, key: str, streams: bool = True) -> Optional[VideoInfo]:
+        """
+        cached VideoInfo of key
+
+        :param key:
+        :param streams: whether stream urls of the VideoInfo are used, stale ones are accepted if not
+        :return:
+        """
+        if key in self._memory:
+            return self._get_memory(key, streams)
+        return self._load(key, self._read(key), streams)
+
+    async def aget(self, key: str, streams: bool = True) -> Optional[VideoInfo]:
+        """get without blocking the event loop on the database"""
+        if key in self._memory:
+            return self._get_memory(key, streams)
+        entry = await asyncio.get_running_loop().run_in_executor(self._executor, self._read, key)
+        return self._load(key, entry, streams)
+
+    def _get_memory(self, key: str, streams: bool) -> Optional[VideoInfo]:
+        self._memory.move_to_end(key)
+        entry = self._memory[key]
+        return entry.info if self._fresh(entry, streams) else None
+
+    def _load(self, key: str, entry: Optional[_Entry], streams: bool) -> Optional[VideoInfo]:
+        """keep an entry read from the database in memory"""
+        if entry is None:
+            return
+        self._put_memory(key, entry)
+        return entry.info if self._fresh(entry, streams) else None
+
+    def _read(self, key: str) -> Optional[_Entry]:
+        if not (db := self._conn()):
+            return
+        try:
+            row = db.execute("SELECT data, fetched, deadline FROM video_info WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            entry = _Entry(VideoInfo.parse_raw(row[0]), row[1], row[2])
+            db.execute("UPDATE video_info SET used = ? WHERE key = ?", (time.time(), key))
+        except (sqlite3.Error, ValueError) as e:
+            logger.debug(f"failed to read video info cache {e}")
+            return
+        return entry
+
+    def put(self, key: str, info: VideoInfo, user: str = ''):
+        self._write(*self._put_all(key, info, user))
+
+    async def aput(self, key: str, info: VideoInfo, user: str = ''):
+        """put without blocking the event loop on the database"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, *self._put_all(key, info, user))
+
+    def _put_all(self, key: str, info: VideoInfo, user: str):
+        """keep info in memory under all of its keys"""
+        # a video is often requested by another url, like its page url in the series
+        keys = {key, self.key(info.pages[info.p].p_url, user)} if info.pages else {key}
+        entry = _Entry(info, time.time(), _stream_deadline(info))
+        for k in keys:
+            self._put_memory(k, entry)
+        return keys, entry
+
+    def _write(self, keys: Set[str], entry: _Entry):
+        if not (db := self._conn()):
+            return
+        try:
+            data = entry.info.json(exclude_none=True)  # unset fields are None
+            db.executemany("INSERT OR REPLACE INTO video_info VALUES (?, ?, ?, ?, ?)",
+                           [(k, data, entry.fetched, entry.deadline, entry.fetched) for k in keys])
+            db.execute("DELETE FROM video_info WHERE key IN (SELECT key FROM video_info ORDER BY used DESC "
+                       "LIMIT -1 OFFSET ?)", (self.max_disk,))
+        except sqlite3.Error as e:
+            logger.debug(f"failed to write video info cache {e}")
+
+    async def invalidate(self, url: str, user: str = ''):
+        """
+        drop the cached VideoInfo of url, like when its stream urls are refused before their deadline
+
+        :param url:
+        :param user: login of the client, like SESSDATA
+        :return:
+        """
+        key = self.key(url, user)
+        keys = {key}
+        if (entry := self._memory.get(key)) and entry.info.pages:
+            keys.add(self.key(entry.info.pages[entry.info.p].p_url, user))
+        for k in keys:
+            self._memory.pop(k, None)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._delete, keys)
+
+    def _delete(self, keys: Set[str]):
+        if not (db := self._conn()):
+            return
+        try:
+            db.executemany("DELETE FROM video_info WHERE key = ?", [(k,) for k in keys])
+        except sqlite3.Error as e:
+            logger.debug(f"failed to delete video info cache {e}")
+
+    def _put_memory(self, key: str, entry: _Entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    async def resolve(self, url: str, fetch: Callable[[], Awaitable[VideoInfo]], user: str = '',
+                      streams: bool = True) -> VideoInfo:
+        """
+        cached VideoInfo of url, or the result of fetch which is shared by concurrent callers of the same video
+
+        :param url:
+        :param fetch: function to get the VideoInfo from the site
+        :param user: login of the client, like SESSDATA
+        :param streams: whether stream urls of the VideoInfo are used
+        :return:
+        """
+        key = self.key(url, user)
+        if info := await self.aget(key, streams):
+            return info
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.setdefault(loop, {})
+        if key not in inflight:
+            inflight[key] = loop.create_task(self._fetch(inflight, key, fetch, user))
+        # one caller cancelled should not cancel the others
+        return await asyncio.shield(inflight[key])
+
+    async def _fetch(self, inflight: Dict[str, asyncio.Future], key: str,
+                     fetch: Callable[[], Awaitable[VideoInfo]], user: str) -> VideoInfo:
+        try:
+            info = await fetch()
+            await self.aput(key, info, user)
+            return info
+        finally:
+            inflight.pop(key, None)
+
+    def clear(self):
+        self._memory.clear()
+        if db := self._conn():
+            try:
+                db.execute("DELETE FROM video_info")
+            except sqlite3.Error as e:
+                logger.debug(f"failed to clear video info cache {e}")
+
+
+# DownloaderBilibili instances of a process and later runs reuse the info resolved by each other
+video_info_cache = VideoInfoCache()
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Optional, Dict, Tuple
+from bilix.log import logger
+
+
+class PartJournal:
+    # min seconds between two saves
+    SAVE_INTERVAL: float = 1.
+
+    def __init__(self, path: Path, total: int, validators: Dict[str, str], extents: List[List[int]] = None):
+        """
+        Resume journal of a preallocated file, records the file identity and the committed byte extents
+        (in local file position, end included). It lives next to the file as {name}.journal
+
+        :param path: the preallocated file
+        :param total: file size
+        :param validators: remote file identity like etag and last-modified
+        :param extents: committed extents
+        """
+        self.path = path
+        self.journal_path = path.with_name(f'{path.name}.journal')
+        self.total = total
+        self.validators = validators
+        self.extents = extents or []
+        self._last_save = 0.
+
+    @classmethod
+    def load(cls, path: Path, total: int, validators: Dict[str, str]) -> Optional['PartJournal']:
+        """load the journal of path, None if there is no journal or the remote file has changed"""
+        journal_path = path.with_name(f'{path.name}.journal')
+        if not journal_path.exists() or not path.exists():
+            return
+        try:
+            with open(journal_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"invalid journal {journal_path.name} {e}")
+            return
+        if data.get('total') != total or data.get('validators') != validators:
+            logger.debug(f"remote file changed since last download, journal {journal_path.name} discarded")
+            return
+        return cls(path, total, validators, data.get('extents', []))
+
+    @property
+    def committed(self) -> int:
+        """committed bytes"""
+        return sum(e - s + 1 for s, e in self.extents)
+
+    def add(self, start: int, end: int):
+        """mark [start, end] committed"""
+        extents = []
+        for s, e in self.extents:
+            if e + 1 < start or end + 1 < s:
+                extents.append([s, e])
+            else:  # overlap or adjacent
+                start, end = min(s, start), max(e, end)
+        extents.append([start, end])
+        extents.sort()
+        self.extents = extents
+
+    def commit(self, start: int, end: int):
+        """mark [start, end] committed, the data should have been flushed, save the journal at most once per
+        SAVE_INTERVAL"""
+        self.add(start, end)
+        if time.monotonic() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def missing(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """uncommitted sub ranges of [start, end]"""
+        res = []
+        for s, e in self.extents:
+            if e < start:
+                continue
+            if s > end:
+                break
+            if s > start:
+                res.append((start, s - 1))
+            start = e + 1
+            if start > end:
+                break
+        if start <= end:
+            res.append((start, end))
+        return res
+
+    def save(self):
+        """atomically replace the journal file"""
+        tmp = self.journal_path.with_name(f'{self.journal_path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'total': self.total, 'validators': self.validators, 'extents': self.extents}, f)
+        os.replace(tmp, self.journal_path)
+        self._last_save = time.monotonic()
+
+    def remove(self):
+        if self.journal_path.exists():
+            os.remove(self.journal_path)
+
+
+class SegmentJournal:
+    # min seconds between two saves
+    SAVE_INTERVAL: float = 1.
+
+    def __init__(self, path: Path, identity: str, next_idx: int = 0, size: int = 0):
+        """
+        Resume journal of a file that segments are appended to in order, records the index of the next segment and
+        the file size when it was committed. It lives next to the file as {name}.journal
+
+        :param path: the file segments are appended to
+        :param identity: identity of the segment list like its length and first uri
+        :param next_idx: index of the next segment to append
+        :param size: file size before the next segment
+        """
+        self.path = path
+        self.journal_path = path.with_name(f'{path.name}.journal')
+        self.identity = identity
+        self.next_idx = next_idx
+        self.size = size
+        self._last_save = 0.
+
+    @classmethod
+    def load(cls, path: Path, identity: str) -> Optional['SegmentJournal']:
+        """load the journal of path, None if there is no journal or the segment list has changed"""
+        journal_path = path.with_name(f'{path.name}.journal')
+        if not journal_path.exists() or not path.exists():
+            return
+        try:
+            with open(journal_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"invalid journal {journal_path.name} {e}")
+            return
+        if data.get('identity') != identity or os.path.getsize(path) < data.get('size', 0):
+            logger.debug(f"segments changed since last download, journal {journal_path.name} discarded")
+            return
+        return cls(path, identity, data['next'], data['size'])
+
+    def commit(self, next_idx: int, size: int):
+        """segments before next_idx have been flushed and the file size is size, save at most once per SAVE_INTERVAL"""
+        self.next_idx, self.size = next_idx, size
+        if time.monotonic() - self._last_save > self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """atomically replace the journal file"""
+        tmp = self.journal_path.with_name(f'{self.journal_path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'identity': self.identity, 'next': self.next_idx, 'size': self.size}, f)
+        os.replace(tmp, self.journal_path)
+        self._last_save = time.monotonic()
+
+    def remove(self):
+        if self.journal_path.exists():
+            os.remove(self.journal_path)
@@ -0,0 +1,194 @@
+import asyncio
+import math
+import time
+from typing import Optional, Dict, Hashable, Tuple
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        """
+        Token bucket rate limiter shared by concurrent streams. Tokens are bytes, they are refilled at rate and at most
+        burst of them are stored. A stream takes its tokens at once and sleeps off the debt, so streams are served in
+        order and the total rate holds regardless of the stream number.
+
+        :param rate: Byte/s
+        :param burst: max bytes that can be sent without waiting after idle
+        """
+        assert rate > 0 and burst > 0
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, size: int) -> float:
+        """take size tokens, return the seconds to wait before using them"""
+        self._refill()
+        self._tokens -= size
+        return -self._tokens / self.rate if self._tokens < 0 else 0.
+
+    async def acquire(self, size: int):
+        """wait until size bytes are allowed"""
+        if (t := self.reserve(size)) > 0:
+            await asyncio.sleep(t)
+
+
+class _BudgetNode:
+    __slots__ = ('rate', 'weight', 'children', 'bucket', 'used', 'since', 'last_active', 'waiting')
+
+    def __init__(self, rate: Optional[float] = None, weight: float = 1.):
+        # cap of the node, None for no cap
+        self.rate = rate
+        self.weight = weight
+        # sites of the root or tasks of a site
+        self.children: Dict[Hashable, '_BudgetNode'] = {}
+        # for tasks, bytes used since the last rebalance
+        self.bucket: Optional[TokenBucket] = None
+        self.used = 0
+        self.since = 0.
+        self.last_active = float('-inf')
+        # streams waiting for the bucket, the task is throttled (busy) if there is any
+        self.waiting = 0
+
+
+class BandwidthManager:
+    # rates are reassigned at most once per interval
+    REBALANCE_INTERVAL: float = 0.2
+    # a task is idle if it has not downloaded for this long, idle tasks give up their share
+    ACTIVE_WINDOW: float = 1.
+    # a task that is not throttled is given what it uses with HEADROOM, at least MIN_DEMAND
+    HEADROOM: float = 1.5
+    MIN_DEMAND: float = 64 * 1024
+    BURST_TIME: float = 0.1
+
+    def __init__(self, rate: Optional[float] = None):
+        """
+        Hierarchical bandwidth budget shared by downloaders of the process: a global cap, caps and weights of sites
+        (one site for each downloader class) and weights of tasks in a site. The rate is split among active sites by
+        weight, then among active tasks of each site by weight, within the caps. Share that a site or a task can not
+        use goes to the busy ones.
+
+        :param rate: global cap in Byte/s, None for no cap
+        """
+        assert rate is None or rate > 0
+        self.root = _BudgetNode(rate)
+        self._last_rebalance = float('-inf')
+
+    def attach(self, downloader, site: str = None):
+        """
+        let the downloader share the budget
+
+        :param downloader: BaseDownloader
+        :param site: site of the downloader, default to its class name
+        """
+        downloader.bandwidth = self
+        downloader.bandwidth_site = site or downloader.__class__.__name__
+
+    def set_site(self, site: str, rate: Optional[float] = None, weight: float = 1.):
+        """
+        set the cap and weight of a site
+
+        :param site: name of the site, which is the class name of its downloaders like DownloaderBilibili
+        :param rate: cap in Byte/s, None for no cap
+        :param weight:
+        """
+        assert rate is None or rate > 0
+        node = self.root.children.setdefault(site, _BudgetNode())
+        node.rate, node.weight = rate, weight
+        self._last_rebalance = float('-inf')
+
+    def set_task_weight(self, site: str, task_id, weight: float):
+        """set the weight of a task among the tasks of its site"""
+        self._task(site, task_id).weight = weight
+        self._last_rebalance = float('-inf')
+
+    def _task(self, site: str, task_id) -> _BudgetNode:
+        site_node = self.root.children.setdefault(site, _BudgetNode())
+        return site_node.children.setdefault(task_id, _BudgetNode())
+
+    async def acquire(self, site: str, task_id, size: int):
+        """wait until size bytes of the task are allowed"""
+        task = self._task(site, task_id)
+        now = time.monotonic()
+        if task.last_active < now - self.ACTIVE_WINDOW:  # a task (re)joins, reassign the rates before it goes
+            task.used, task.since = 0, now
+            self._last_rebalance = float('-inf')
+        task.last_active = now
+        task.used += size
+        if now - self._last_rebalance > self.REBALANCE_INTERVAL:
+            self._rebalance(now)
+        if task.bucket and (t := task.bucket.reserve(size)) > 0:
+            task.waiting += 1
+            try:
+                await asyncio.sleep(t)
+            finally:
+                task.waiting -= 1
+
+    def _demand(self, node: _BudgetNode, depth: int, now: float) -> float:
+        """rate the node can use, inf if unknown or busy"""
+        if depth == 2:  # task
+            if node.last_active < now - self.ACTIVE_WINDOW:
+                return 0.
+            if node.waiting or now - node.since < self.REBALANCE_INTERVAL:
+                return math.inf
+            return max(node.used / (now - node.since) * self.HEADROOM, self.MIN_DEMAND)
+        demand = sum(self._demand(c, depth + 1, now) for c in node.children.values())
+        return min(demand, node.rate) if node.rate else demand
+
+    @staticmethod
+    def _water_fill(budget: float, demands: Dict[Hashable, Tuple[float, float]]) -> Dict[Hashable, float]:
+        """
+        weighted max-min fair split of budget
+
+        :param budget:
+        :param demands: key -> (weight, demand), zero demand is not allocated
+        :return: key -> allocated rate
+        """
+        demands = {k: v for k, v in demands.items() if v[1] > 0}
+        alloc, left = {}, dict(demands)
+        while left:
+            total_weight = sum(w for w, _ in left.values())
+            satisfied = {k: d for k, (w, d) in left.items() if d <= budget * w / total_weight}
+            if not satisfied:
+                for k, (w, _) in left.items():
+                    alloc[k] = budget * w / total_weight
+                return alloc
+            for k, d in satisfied.items():
+                alloc[k] = d
+                budget -= d
+                del left[k]
+        # everyone is satisfied, share the rest by weight for them to grow
+        total_weight = sum(w for w, _ in demands.values())
+        return {k: a + budget * demands[k][0] / total_weight for k, a in alloc.items()}
+
+    def _allocate(self, node: _BudgetNode, depth: int, budget: float, now: float):
+        if node.rate:
+            budget = min(budget, node.rate)
+        if depth == 2:
+            if math.isinf(budget):
+                node.bucket = None
+            elif node.bucket:
+                node.bucket.rate, node.bucket.burst = budget, budget * self.BURST_TIME
+            else:
+                node.bucket = TokenBucket(budget, budget * self.BURST_TIME)
+            node.used, node.since = 0, now
+            return
+        demands = {k: (c.weight, self._demand(c, depth + 1, now)) for k, c in node.children.items()}
+        if math.isinf(budget):
+            alloc = {k: math.inf for k, (_, d) in demands.items() if d > 0}
+        else:
+            alloc = self._water_fill(budget, demands)
+        for k, c in list(node.children.items()):
+            if k in alloc:
+                self._allocate(c, depth + 1, alloc[k], now)
+            elif depth == 1 and c.weight == 1. and c.last_active < now - self.ACTIVE_WINDOW * 10:
+                del node.children[k]  # forget long idle tasks
+            # idle ones are reassigned when they come back
+
+    def _rebalance(self, now: float):
+        self._last_rebalance = now
+        self._allocate(self.root, 0, math.inf, now)
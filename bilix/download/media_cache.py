@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional, Dict, Tuple, Union
+from urllib.parse import urlsplit
+from bilix.log import logger
+from bilix.utils import cache_dir as default_cache_dir
+
+
+@dataclass
+class MediaIndex:
+    """parsed sidx reference table of a DASH media and its init segment"""
+    timescale: int
+    # (segment_duration, referenced_size) of each media reference
+    references: List[Tuple[int, int]]
+    # None if init segment is not adjacent to sidx and was not downloaded
+    init_data: Optional[bytes] = None
+    validators: Dict[str, str] = field(default_factory=dict)
+
+    def to_json(self) -> dict:
+        return {'timescale': self.timescale, 'references': self.references,
+                'init_data': base64.b64encode(self.init_data).decode() if self.init_data is not None else None,
+                'validators': self.validators}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'MediaIndex':
+        init_data = base64.b64decode(data['init_data']) if data['init_data'] is not None else None
+        return cls(data['timescale'], [tuple(r) for r in data['references']], init_data, data['validators'])
+
+
+class MediaIndexCache:
+    def __init__(self, cache_dir: Union[str, Path, None] = None, max_memory: int = 64, max_disk: int = 1024):
+        """
+        LRU cache of MediaIndex in memory and on disk, so clips cut from the same media in this or later runs
+        need not request and parse sidx again.
+
+        :param cache_dir: directory of cached entries, default $XDG_CACHE_HOME/bilix/media_index
+        :param max_memory: max entries in memory
+        :param max_disk: max entries on disk, the least recently used ones are removed
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir() / 'media_index'
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self._memory: OrderedDict[str, MediaIndex] = OrderedDict()
+
+    @staticmethod
+    def key(url: str, init_range: str, seg_range: str) -> str:
+        """media identity, host and query are ignored since mirrors and signatures vary between requests"""
+        return f"{urlsplit(str(url)).path}#{init_range}#{seg_range}"
+
+    def _file(self, key: str) -> Path:
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    def get(self, key: str) -> Optional[MediaIndex]:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        file = self._file(key)
+        try:
+            with open(file) as f:
+                data = json.load(f)
+            if data.get('key') != key:
+                return
+            index = MediaIndex.from_json(data)
+            os.utime(file)  # mtime is the last use time
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self._put_memory(key, index)
+        return index
+
+    def put(self, key: str, index: MediaIndex):
+        self._put_memory(key, index)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            file = self._file(key)
+            tmp = file.with_name(f'{file.name}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, **index.to_json()}, f)
+            os.replace(tmp, file)
+            self._evict_disk()
+        except OSError as e:
+            logger.debug(f"failed to write media index cache {e}")
+
+    def _put_memory(self, key: str, index: MediaIndex):
+        self._memory[key] = index
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        files = list(self.cache_dir.glob('*.json'))
+        if len(files) <= self.max_disk:
+            return
+        files.sort(key=lambda f: f.stat().st_mtime)
+        for f in files[:len(files) - self.max_disk]:
+            f.unlink(missing_ok=True)
+
+    def clear(self):
+        self._memory.clear()
+        for f in self.cache_dir.glob('*.json'):
+            f.unlink(missing_ok=True)
+
+
+# clips of the same media reuse its index, in this run and in later ones
+media_index_cache = MediaIndexCache()
@@ -0,0 +1,276 @@
+import os
+import struct
+from pathlib import Path
+from typing import Iterator, Tuple, List, Dict, BinaryIO
+from bilix.utils import append_file
+
+# tfhd flag, base_data_offset is an absolute file offset
+BASE_DATA_OFFSET_PRESENT = 0x000001
+
+
+class MuxError(Exception):
+    """the tracks can not be muxed in process, ffmpeg should be used instead"""
+
+
+def _iter_boxes(data: bytes, start: int = 0, end: int = None) -> Iterator[Tuple[bytes, int, int, int]]:
+    """(type, offset, header size, size) of boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size, header = struct.unpack_from('>Q', data, pos + 8)[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise MuxError(f"broken box {box_type} at {pos}")
+        yield box_type, pos, header, size
+        pos += size
+
+
+def _iter_file_boxes(f: BinaryIO) -> Iterator[Tuple[bytes, int, int]]:
+    """(type, offset, size) of top level boxes of a file"""
+    end = os.fstat(f.fileno()).st_size
+    pos = 0
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+        elif size == 0:
+            size = end - pos
+        if size < 8 or pos + size > end:
+            raise MuxError(f"broken or incomplete box {box_type} at {pos}")
+        yield box_type, pos, size
+        pos += size
+
+
+def _child(data: bytes, start: int, end: int, box_type: bytes) -> Tuple[int, int, int]:
+    """(offset, header size, size) of the first child box_type in data[start:end]"""
+    for t, pos, header, size in _iter_boxes(data, start, end):
+        if t == box_type:
+            return pos, header, size
+    raise MuxError(f"no {box_type} box")
+
+
+def _path(data: bytes, box_types: List[bytes]) -> Tuple[int, int, int]:
+    """(offset, header size, size) of a box by its path like [b'mdia', b'mdhd'] in the children of data"""
+    pos, header, size = -8, 8, len(data) + 8
+    for t in box_types:
+        pos, header, size = _child(data, pos + header, pos + size, t)
+    return pos, header, size
+
+
+def _full_box_version(data: bytes, pos: int, header: int) -> int:
+    return data[pos + header]
+
+
+def _read_uint(data: bytes, offset: int, long: bool) -> int:
+    return struct.unpack_from('>Q' if long else '>I', data, offset)[0]
+
+
+def _write_uint(data: bytearray, offset: int, long: bool, value: int):
+    struct.pack_into('>Q' if long else '>I', data, offset, value)
+
+
+class _Track:
+    def __init__(self, f: BinaryIO):
+        """a fragmented mp4 file of a single track"""
+        self.f = f
+        self.ftyp = b''
+        self.moov = b''
+        # (moof offset, moof size, end of its data)
+        self.fragments: List[Tuple[int, int, int]] = []
+        for box_type, pos, size in _iter_file_boxes(f):
+            if box_type == b'ftyp':
+                f.seek(pos)
+                self.ftyp = f.read(size)
+            elif box_type == b'moov':
+                f.seek(pos)
+                self.moov = f.read(size)
+            elif box_type == b'moof':
+                self.fragments.append((pos, size, pos + size))
+            elif box_type == b'mdat' and self.fragments:
+                moof, moof_size, _ = self.fragments[-1]
+                self.fragments[-1] = (moof, moof_size, pos + size)
+        if not self.moov or not self.fragments:
+            raise MuxError("not a fragmented mp4")
+        # children of moov without the 8 bytes header
+        moov = self.moov[8:]
+        traks = [b for b in _iter_boxes(moov) if b[0] == b'trak']
+        if len(traks) != 1:
+            raise MuxError(f"{len(traks)} tracks in moov")
+        pos, header, _ = _path(moov, [b'mvhd'])
+        v1 = _full_box_version(moov, pos, header) == 1
+        self.movie_timescale = _read_uint(moov, pos + header + (20 if v1 else 12), False)
+        pos, header, _ = _path(moov, [b'trak', b'mdia', b'mdhd'])
+        v1 = _full_box_version(moov, pos, header) == 1
+        self.timescale = _read_uint(moov, pos + header + (20 if v1 else 12), False)
+
+    @staticmethod
+    def base_media_decode_time(moof: bytes) -> int:
+        """start time of a fragment in the track timescale"""
+        pos, header, _ = _path(moof[8:], [b'traf', b'tfdt'])
+        pos += 8
+        v1 = _full_box_version(moof, pos, header) == 1
+        return _read_uint(moof, pos + header + 4, v1)
+
+    def decode_time(self, moof: bytes) -> float:
+        """start time in seconds of a fragment"""
+        return self.base_media_decode_time(moof) / self.timescale
+
+
+def _rescale_trak(trak: bytearray, track_id: int, scale: float):
+    """set track_ID of a trak box and rescale its durations in movie timescale"""
+    body = bytes(trak[8:])
+    pos, header, _ = _path(body, [b'tkhd'])
+    pos += 8
+    v1 = _full_box_version(trak, pos, header) == 1
+    field = pos + header + 4 + (16 if v1 else 8)
+    _write_uint(trak, field, False, track_id)
+    duration = field + 8
+    _write_uint(trak, duration, v1, round(_read_uint(trak, duration, v1) * scale))
+    try:
+        pos, header, _ = _path(body, [b'edts', b'elst'])
+    except MuxError:
+        return
+    pos += 8
+    v1 = _full_box_version(trak, pos, header) == 1
+    count = _read_uint(trak, pos + header + 4, False)
+    entry = pos + header + 8
+    for _ in range(count):
+        _write_uint(trak, entry, v1, round(_read_uint(trak, entry, v1) * scale))
+        entry += 20 if v1 else 12
+
+
+def _build_moov(video: _Track, audio: _Track) -> bytes:
+    """moov of video with the trak of audio added as track 2"""
+    scale = video.movie_timescale / audio.movie_timescale
+    v_body, a_body = video.moov[8:], audio.moov[8:]
+    a_trak = None
+    for box_type, pos, header, size in _iter_boxes(a_body):
+        if box_type == b'trak':
+            a_trak = bytearray(a_body[pos:pos + size])
+            _rescale_trak(a_trak, 2, scale)
+    pos, _, size = _path(a_body, [b'mvex', b'trex'])
+    a_trex = bytearray(a_body[pos:pos + size])
+    _write_uint(a_trex, 12, False, 2)
+    pos, header, _ = _path(a_body, [b'mvhd'])
+    v1 = _full_box_version(a_body, pos, header) == 1
+    a_duration = round(_read_uint(a_body, pos + header + (24 if v1 else 16), v1) * scale)
+
+    children = []
+    for box_type, pos, header, size in _iter_boxes(v_body):
+        box = bytearray(v_body[pos:pos + size])
+        if box_type == b'mvhd':
+            v1 = box[header] == 1
+            duration = header + (24 if v1 else 16)
+            _write_uint(box, duration, v1, max(_read_uint(box, duration, v1), a_duration))
+            _write_uint(box, size - 4, False, 3)  # next_track_ID
+            children.append(box)
+        elif box_type == b'trak':
+            _rescale_trak(box, 1, 1.)
+            children.extend((box, a_trak))
+        elif box_type == b'mvex':
+            mvex = []
+            for t, p, h, s in _iter_boxes(box, header):
+                child = bytearray(box[p:p + s])
+                if t == b'trex':
+                    _write_uint(child, 12, False, 1)
+                elif t == b'mehd':
+                    v1 = child[8] == 1
+                    # mehd of audio in video movie timescale
+                    try:
+                        ap, ah, _ = _path(a_body, [b'mvex', b'mehd'])
+                        a_v1 = _full_box_version(a_body, ap, ah) == 1
+                        a_frag = round(_read_uint(a_body, ap + ah + 4, a_v1) * scale)
+                    except MuxError:
+                        a_frag = 0
+                    _write_uint(child, 12, v1, max(_read_uint(child, 12, v1), a_frag))
+                mvex.append(child)
+            mvex.append(a_trex)
+            body = b''.join(mvex)
+            children.append(struct.pack('>I4s', 8 + len(body), b'mvex') + body)
+        else:
+            children.append(box)
+    body = b''.join(children)
+    return struct.pack('>I4s', 8 + len(body), b'moov') + body
+
+
+def _patch_moof(moof: bytearray, sequence: int, track_id: int, shift: int):
+    """set the sequence number and track_ID of a moof, shift absolute base data offsets"""
+    body = bytes(moof[8:])
+    pos, header, _ = _path(body, [b'mfhd'])
+    _write_uint(moof, 8 + pos + header + 4, False, sequence)
+    for box_type, traf, traf_header, traf_size in _iter_boxes(body):
+        if box_type != b'traf':
+            continue
+        pos, header, _ = _child(body, traf + traf_header, traf + traf_size, b'tfhd')
+        pos += 8
+        flags = int.from_bytes(moof[pos + header + 1:pos + header + 4], 'big')
+        _write_uint(moof, pos + header + 4, False, track_id)
+        if flags & BASE_DATA_OFFSET_PRESENT:
+            offset = pos + header + 8
+            _write_uint(moof, offset, True, _read_uint(moof, offset, True) + shift)
+
+
+def _build_mfra(entries: Dict[int, List[Tuple[int, int]]]) -> bytes:
+    """
+    mfra with a tfra of each track, players seek by it instead of scanning the moofs
+
+    :param entries: track_ID -> (base media decode time, moof offset) of its fragments
+    :return:
+    """
+    tfras = []
+    for track_id, fragments in entries.items():
+        # version 1, 1 byte traf, trun and sample numbers, each fragment starts at its first sample
+        body = struct.pack('>III', 0x01000000, track_id, 0) + struct.pack('>I', len(fragments)) + \
+            b''.join(struct.pack('>QQBBB', t, offset, 1, 1, 1) for t, offset in fragments)
+        tfras.append(struct.pack('>I4s', 8 + len(body), b'tfra') + body)
+    size = 8 + sum(len(t) for t in tfras) + 16
+    return struct.pack('>I4s', size, b'mfra') + b''.join(tfras) + struct.pack('>I4sII', 16, b'mfro', 0, size)
+
+
+def mux_dash(video_path: Path, audio_path: Path, path: Path):
+    """
+    mux a video and an audio fragmented mp4 (DASH) into a fragmented mp4 without ffmpeg. Fragments are interleaved
+    by decode time and their media data are copied by the kernel. The output stays fragmented (moov without samples,
+    then moof and mdat pairs), sidx of the inputs are dropped and an mfra at the end indexes the fragments for
+    seeking. The file is written to {name}.tmp first.
+
+    :param video_path:
+    :param audio_path:
+    :param path:
+    :return:
+    """
+    path_tmp = path.with_name(f'{path.name}.tmp')
+    with open(video_path, 'rb') as vf, open(audio_path, 'rb') as af:
+        tracks: Dict[int, _Track] = {1: _Track(vf), 2: _Track(af)}
+        fragments = []
+        for track_id, track in tracks.items():
+            for moof, moof_size, end in track.fragments:
+                track.f.seek(moof)
+                moof_data = track.f.read(moof_size)
+                fragments.append((track.decode_time(moof_data), track_id, moof, moof_size, end,
+                                  track.base_media_decode_time(moof_data)))
+        fragments.sort(key=lambda x: (x[0], x[1]))
+        mfra_entries: Dict[int, List[Tuple[int, int]]] = {track_id: [] for track_id in tracks}
+        try:
+            with open(path_tmp, 'wb') as f:
+                f.write(tracks[1].ftyp)
+                f.write(_build_moov(tracks[1], tracks[2]))
+                for sequence, (_, track_id, moof, moof_size, end, decode_time) in enumerate(fragments, start=1):
+                    src = tracks[track_id].f
+                    src.seek(moof)
+                    moof_data = bytearray(src.read(moof_size))
+                    mfra_entries[track_id].append((decode_time, f.tell()))
+                    _patch_moof(moof_data, sequence, track_id, f.tell() - moof)
+                    f.write(moof_data)
+                    append_file(f, src, moof + moof_size, end - moof - moof_size)
+                f.write(_build_mfra(mfra_entries))
+        except BaseException:
+            path_tmp.unlink(missing_ok=True)
+            raise
+    os.replace(path_tmp, path)
@@ -1,7 +1,7 @@
 import asyncio
-import httpx
 from rich.tree import Tree
 
+from bilix.client_pool import client_registry
 import bilix.api.bilibili as api
 from bilix._handle import Handler
 from bilix.info.base_informer import BaseInformer
@@ -14,7 +14,7 @@ __all__ = ['InformerBilibili']
 class InformerBilibili(BaseInformer):
     def __init__(self, sess_data: str = '', browser: str = None):
         self.domain = "bilibili.com"
-        client = httpx.AsyncClient(**api.dft_client_settings)
+        client = client_registry.client(**api.dft_client_settings)
         client.cookies.set('SESSDATA', valid_sess_data(sess_data))
         super().__init__(client, browser=browser)
         self.type_map = {
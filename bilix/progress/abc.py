@@ -1,9 +1,18 @@
+import time
 from abc import ABC, abstractmethod
-from typing import Optional, Any
+from typing import Optional, Any, Dict, List
 
 
 class Progress(ABC):
     """Abstract Class for bilix download progress, checkout to design your own progress"""
+    # pending advance of a task is flushed by update when it is older than FLUSH_INTERVAL (s) or larger than
+    # FLUSH_BYTES
+    FLUSH_INTERVAL: float = 0.1
+    FLUSH_BYTES: int = 4 * 1024 * 1024
+
+    def _pending_advance(self) -> Dict[Any, List]:
+        """task_id -> [pending bytes, last flush time], created lazily since subclasses may not call __init__"""
+        return self.__dict__.setdefault('_pending', {})
 
     @classmethod
     @abstractmethod
@@ -49,3 +58,35 @@ class Progress(ABC):
             **fields: Any
     ):
         """async update a task status"""
+
+    async def advance(self, task_id, size: int) -> int:
+        """
+        batched version of update(task_id, advance=size) for hot loops. Bytes are accumulated and flushed by update
+        on FLUSH_INTERVAL or FLUSH_BYTES, so tasks may lag behind by that much until flush is called. Callers
+        should call flush when their stream ends.
+
+        :param task_id:
+        :param size: downloaded bytes
+        :return: flushed bytes, 0 if still pending
+        """
+        now = time.monotonic()
+        pending = self._pending_advance().setdefault(task_id, [0, now])
+        pending[0] += size
+        if pending[0] >= self.FLUSH_BYTES or now - pending[1] >= self.FLUSH_INTERVAL:
+            size, pending[0], pending[1] = pending[0], 0, now
+            await self.update(task_id, advance=size)
+            return size
+        return 0
+
+    async def flush(self, task_id) -> int:
+        """
+        update the pending advance of task_id immediately
+
+        :param task_id:
+        :return: flushed bytes
+        """
+        pending = self._pending_advance().pop(task_id, None)
+        if pending and pending[0]:
+            await self.update(task_id, advance=pending[0])
+            return pending[0]
+        return 0
@@ -39,6 +39,7 @@ class CLIProgress(Progress):
     )
 
     def __init__(self):
+        super().__init__()
         self._active_ids: Set[TaskID] = set()
 
     @classmethod
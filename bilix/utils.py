@@ -3,12 +3,12 @@ import html
 import json
 import os
 import re
-import random
 import errno
+import struct
+import sys
 from pathlib import Path
 from urllib.parse import quote_plus
 from typing import Union, Sequence, Coroutine, List, Tuple, Optional
-import aiofiles
 import browser_cookie3
 import httpx
 import time
@@ -24,43 +24,297 @@ def cors_slice(cors: Sequence[Coroutine], p_range: Sequence[int]):
     return cors
 
 
-async def req_retry(client: httpx.AsyncClient, url_or_urls: Union[str, Sequence[str]], method='GET',
-                    follow_redirects=False, retry=5, **kwargs) -> httpx.Response:
-    """Client request with multiple backup urls and retry"""
+class MirrorSelector:
+    # the size used to estimate the time cost of a request by ttfb and throughput
+    SCORE_SIZE: int = 1024 * 1024
+    # drop a mirror after these consecutive errors
+    MAX_ERRORS: int = 3
+    # weight of the new sample in moving average
+    ALPHA: float = 0.3
+
+    def __init__(self, urls: Sequence[Union[str, httpx.URL]]):
+        """
+        Live scoring of a resource's mirror urls (like base_url and backup_url of a media) by throughput, ttfb
+        and error rate. Requests go to the fastest healthy mirror, a failing mirror is dropped.
+
+        :param urls: mirror urls, the first one is preferred before any measurement
+        """
+        self.urls = list(urls)
+        n = len(self.urls)
+        self.throughput: List[Optional[float]] = [None] * n  # Byte/s
+        self.ttfb: List[Optional[float]] = [None] * n  # s
+        self.requests = [0] * n
+        self.errors = [0] * n
+        self.active = [0] * n
+        self._consecutive_errors = [0] * n
+        self.dropped = [False] * n
+
+    def __len__(self):
+        return len(self.urls)
+
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        return new if old is None else old + self.ALPHA * (new - old)
+
+    def score(self, idx: int) -> float:
+        """estimated speed (Byte/s) of a SCORE_SIZE request, weighted by success rate"""
+        throughput, ttfb = self.throughput[idx], self.ttfb[idx] or 0.
+        if throughput is None:  # only ttfb is known, assume it transfers as fast as the others
+            known = [t for t in self.throughput if t]
+            throughput = sum(known) / len(known) if known else None
+        cost = ttfb + (self.SCORE_SIZE / throughput if throughput else 0.)
+        success = 1 - self.errors[idx] / self.requests[idx] if self.requests[idx] else 1.
+        if cost == 0:  # no measurement yet
+            return float('inf') if success > 0 else 0.
+        return success * self.SCORE_SIZE / cost
+
+    def choose(self) -> int:
+        """index of the mirror to use for the next request"""
+        candidates = [i for i in range(len(self.urls)) if not self.dropped[i]]
+        # try unmeasured mirrors first, but only one request at a time
+        for i in candidates:
+            if self.requests[i] == 0 and self.active[i] == 0:
+                break
+        else:
+            measured = [i for i in candidates if self.requests[i] > 0]
+            if measured:
+                i = max(measured, key=self.score)
+            else:
+                i = min(candidates, key=lambda x: self.active[x])
+        self.active[i] += 1
+        self.requests[i] += 1
+        return i
+
+    def report(self, idx: int, ttfb: float = None, size: int = 0, elapsed: float = 0.):
+        """report a successful request to mirror idx"""
+        self.active[idx] -= 1
+        self._consecutive_errors[idx] = 0
+        if ttfb is not None:
+            self.ttfb[idx] = self._ewma(self.ttfb[idx], ttfb)
+        if size > 0 and elapsed > 0:
+            self.throughput[idx] = self._ewma(self.throughput[idx], size / elapsed)
+
+    def report_error(self, idx: int):
+        """report a failed request to mirror idx, drop it after MAX_ERRORS consecutive errors if there are others"""
+        self.active[idx] -= 1
+        self.errors[idx] += 1
+        self._consecutive_errors[idx] += 1
+        if self._consecutive_errors[idx] >= self.MAX_ERRORS and not self.dropped[idx] and \
+                sum(not d for d in self.dropped) > 1:
+            self.dropped[idx] = True
+            logger.debug(f"mirror dropped due to {self.errors[idx]} errors: {self.urls[idx]}")
+
+
+async def req_retry(client: httpx.AsyncClient, url_or_urls: Union[str, Sequence[str], MirrorSelector], method='GET',
+                    follow_redirects=False, retry=5, stream=False, **kwargs) -> httpx.Response:
+    """
+    Client request with multiple backup urls and retry, backup urls are chosen by MirrorSelector
+
+    :param stream: if True, return once the headers arrive, the caller should read and close the response
+    """
     pre_exc = None  # predefine to avoid warning
+    mirrors = None if isinstance(url_or_urls, (str, httpx.URL)) else \
+        url_or_urls if isinstance(url_or_urls, MirrorSelector) else MirrorSelector(url_or_urls)
     for times in range(1 + retry):
-        url = url_or_urls if type(url_or_urls) is str else random.choice(url_or_urls)
+        if mirrors is None:
+            url = url_or_urls
+        else:
+            idx = mirrors.choose()
+            url = mirrors.urls[idx]
         try:
-            res = await client.request(method, url, follow_redirects=follow_redirects, **kwargs)
+            a = time.monotonic()
+            if stream:
+                res = await client.send(client.build_request(method, url, **kwargs),
+                                        stream=True, follow_redirects=follow_redirects)
+            else:
+                res = await client.request(method, url, follow_redirects=follow_redirects, **kwargs)
             res.raise_for_status()
         except httpx.TransportError as e:
             msg = f'{method} {e.__class__.__name__} url: {url}'
             logger.warning(msg) if times > 0 else logger.debug(msg)
             pre_exc = e
+            if mirrors is not None:
+                mirrors.report_error(idx)
             await asyncio.sleep(.1 * (times + 1))
         except httpx.HTTPStatusError as e:
             logger.warning(f'{method} {e.response.status_code} {url}')
             pre_exc = e
+            if stream:
+                await e.response.aclose()
+            if mirrors is not None:
+                mirrors.report_error(idx)
             await asyncio.sleep(1. * (times + 1))
         except Exception as e:
             logger.warning(f'{method} {e.__class__.__name__} 未知异常 url: {url}')
             raise e
         else:
+            if mirrors is not None:
+                if stream:  # the body is not read yet
+                    mirrors.report(idx, ttfb=time.monotonic() - a)
+                else:
+                    elapsed = time.monotonic() - a
+                    mirrors.report(idx, ttfb=elapsed, size=len(res.content), elapsed=elapsed)
+                if res.history:  # avoid twice redirect
+                    mirrors.urls[idx] = res.url
             return res
     logger.error(f"{method} 超过重复次数 {url_or_urls}")
     raise pre_exc
 
 
-async def merge_files(file_list: List[Path], new_path: Path):
+# linux ioctl to share extents of another file, see ioctl_ficlonerange(2)
+FICLONERANGE = 0x4020940d
+# buffer size of the chunked copy when the kernel can not copy
+COPY_CHUNK_SIZE = 1024 * 1024
+# copy methods that failed with an unsupported error, they are not tried again
+_unsupported_copy = set()
+
+
+def _copy_unsupported(method: str, e: OSError) -> bool:
+    if e.errno in (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOTSOCK, errno.EXDEV, errno.EINVAL,
+                   errno.EBADF):
+        logger.debug(f"{method} is not supported: {e}")
+        if e.errno in (errno.ENOSYS, errno.ENOTTY, errno.ENOTSOCK):  # not available at all
+            _unsupported_copy.add(method)
+        return True
+    return False
+
+
+def append_file(dst, src, src_offset: int = 0, count: int = None) -> str:
+    """
+    append the content of src to the end of dst without passing it through python. Extents are shared (reflink) if
+    the filesystem supports it and the end of dst is block aligned, otherwise the kernel copies them by
+    copy_file_range or sendfile (linux only), otherwise they are copied in COPY_CHUNK_SIZE chunks.
+
+    :param dst: file object opened for writing without O_APPEND, which the kernel copies refuse
+    :param src: file object opened for reading
+    :param src_offset: where to start in src
+    :param count: bytes to append, None for all the rest of src
+    :return: method used, reflink, copy_file_range, sendfile or chunked
+    :raise OSError: src ends before count bytes are appended
+    """
+    dst.flush()
+    dst_fd, src_fd = dst.fileno(), src.fileno()
+    size = os.fstat(src_fd).st_size - src_offset if count is None else count
+    offset = os.fstat(dst_fd).st_size
+    if size <= 0:
+        return 'chunked'
+    # only whole files are cloned, ranges would have to be block aligned
+    if 'reflink' not in _unsupported_copy and src_offset == 0 and count is None and \
+            offset % os.fstat(dst_fd).st_blksize == 0 and sys.platform == 'linux':
+        try:
+            import fcntl
+            # length 0 clones to the end of src
+            fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack('qQQQ', src_fd, 0, 0, offset))
+            dst.seek(0, os.SEEK_END)
+            return 'reflink'
+        except OSError as e:
+            if not _copy_unsupported('reflink', e):
+                raise
+    for method in ('copy_file_range', 'sendfile'):
+        if method in _unsupported_copy or not hasattr(os, method):
+            continue
+        if method == 'sendfile' and sys.platform != 'linux':  # only sockets are supported as output elsewhere
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dst_fd, size - copied, src_offset + copied, offset + copied)
+                else:
+                    os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+                    n = os.sendfile(dst_fd, src_fd, src_offset + copied, size - copied)
+                if n == 0:  # src is shorter than expected
+                    break
+                copied += n
+        except OSError as e:
+            if copied:
+                raise
+            # nothing is copied yet, the next method may work
+            if not _copy_unsupported(method, e):
+                logger.debug(f"{method} failed before copying: {e}")
+            continue
+        dst.seek(0, os.SEEK_END)
+        _check_copied(src, copied, size)
+        return method
+    dst.seek(0, os.SEEK_END)
+    src.seek(src_offset)
+    copied = 0
+    while copied < size and (chunk := src.read(min(size - copied, COPY_CHUNK_SIZE))):
+        dst.write(chunk)
+        copied += len(chunk)
+    dst.flush()
+    _check_copied(src, copied, size)
+    return 'chunked'
+
+
+def _check_copied(src, copied: int, size: int):
+    if copied < size:
+        raise OSError(f"{getattr(src, 'name', src)} ended after {copied} of {size} bytes")
+
+
+def _merge_files(file_list: List[Path], new_path: Path):
     first_file = file_list[0]
-    async with aiofiles.open(first_file, 'ab') as f:
-        for idx in range(1, len(file_list)):
-            async with aiofiles.open(file_list[idx], 'rb') as fa:
-                await f.write(await fa.read())
-            os.remove(file_list[idx])
+    with open(first_file, 'r+b') as f:
+        for file in file_list[1:]:
+            with open(file, 'rb') as fa:
+                method = append_file(f, fa)
+            logger.debug(f"{file.name} merged by {method}")
+            os.remove(file)
     os.rename(first_file, new_path)
 
 
+async def merge_files(file_list: List[Path], new_path: Path):
+    """
+    append the files to the first one by append_file and rename it to new_path, others are removed
+
+    :param file_list:
+    :param new_path:
+    :return:
+    """
+    await asyncio.get_running_loop().run_in_executor(None, _merge_files, file_list, new_path)
+
+
+def _fallocate(fd: int, size: int) -> bool:
+    """
+    reserve size bytes for fd natively, False if the filesystem or platform does not support it. glibc's
+    posix_fallocate is not used on linux since it falls back to writing the whole file.
+    """
+    try:
+        if sys.platform == 'linux':
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+            if libc.fallocate(fd, 0, 0, size) != 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+        elif hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            return False
+        return True
+    except AttributeError:  # libc without fallocate
+        return False
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise  # like ENOSPC
+        logger.debug(f"fallocate not supported: {e}")
+        return False
+
+
+def preallocate_file(path: Path, size: int):
+    """
+    create (or truncate) path and reserve size bytes for it, so that several streams can write at their own offsets.
+    The file is sparse where native preallocation is not supported. It may block, run it in an executor.
+
+    :param path: file to allocate
+    :param size: file size in bytes
+    :return:
+    """
+    with open(path, 'wb') as f:
+        if size > 0 and _fallocate(f.fileno(), size):
+            return
+        f.truncate(size)
+
+
 def legal_title(*parts: str, join_str: str = '-'):
     """
     join several string parts to os illegal file/dir name (no illegal character and not too long).
@@ -216,3 +470,8 @@ def path_check(path: Path, retry: int = 100) -> Tuple[bool, Path]:
             else:
                 raise e
     raise OSError(f"filename too long for os {path.name}")
+
+
+def cache_dir() -> Path:
+    """cache directory of bilix, $XDG_CACHE_HOME/bilix or ~/.cache/bilix"""
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'bilix'
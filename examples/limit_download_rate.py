@@ -4,6 +4,7 @@ limit download rate is simple
 """
 import asyncio
 from bilix import DownloaderBilibili, DownloaderCctv
+from bilix.download.limiter import BandwidthManager
 
 
 async def main():
@@ -21,5 +22,19 @@ async def main2():
         )
 
 
+async def main3():
+    # 多个downloader共享带宽预算：总共不超过4MB/s，cctv权重为2但最多1MB/s，用不完的带宽会分给其他downloader
+    # Downloaders share a bandwidth budget: 4MB/s in total, cctv weighs 2 but at most 1MB/s, unused share goes to others
+    bandwidth = BandwidthManager(rate=4e6)
+    bandwidth.set_site('DownloaderCctv', rate=1e6, weight=2)
+    async with DownloaderBilibili() as bili_d, DownloaderCctv() as cctv_d:
+        bandwidth.attach(bili_d)
+        bandwidth.attach(cctv_d)
+        await asyncio.gather(
+            bili_d.get_series('https://www.bilibili.com/video/BV1cd4y1Z7EG'),
+            cctv_d.get_series('https://www.douyin.com/video/7132430286415252773')
+        )
+
+
 if __name__ == '__main__':
     asyncio.run(main())
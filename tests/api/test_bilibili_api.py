@@ -1,3 +1,4 @@
+import json
 import httpx
 import pytest
 import asyncio
@@ -125,3 +126,116 @@ async def test_get_dm_info():
                                     "https://www.bilibili.com/bangumi/play/ss33343?theme=movie&spm_id_from=333.337.0.0")
     data = await api.get_dm_urls(client, data.aid, data.cid)
     assert len(data) > 0
+
+
+PLAY_INFO = {'code': 0, 'data': {
+    'support_formats': [{'quality': 80, 'new_description': '1080P 高清'}, {'quality': 64, 'new_description': '720P 高清'}],
+    'dash': {
+        'duration': 10,
+        'video': [{'id': 80, 'base_url': 'https://upos/80.m4s', 'backup_url': [], 'codecs': 'avc1.640032',
+                   'width': 1920, 'height': 1080},
+                  {'id': 64, 'base_url': 'https://upos/64.m4s', 'backup_url': [], 'codecs': 'avc1.640028',
+                   'width': 1280, 'height': 720}],
+        'audio': [{'id': 30280, 'base_url': 'https://upos/a.m4s', 'backup_url': [], 'codecs': 'mp4a.40.2'}],
+        'dolby': {'type': 0, 'audio': None}, 'flac': None,
+    }}}
+VIEW = {'code': 0, 'data': {
+    'bvid': 'BV1jK4y1N7ST', 'aid': 2, 'title': 'a/b', 'pic': 'http://i0.hdslb.com/cover.jpg',
+    'stat': {'view': 1, 'danmaku': 2, 'reply': 3, 'favorite': 4, 'coin': 5, 'share': 6, 'like': 7},
+    'pages': [{'cid': 10, 'page': 1, 'part': 'first'}, {'cid': 11, 'page': 2, 'part': 'second'}]}}
+SEASON = {'code': 0, 'result': {
+    'season_title': '天气之子', 'cover': '//i0.hdslb.com/season.jpg',
+    'stat': {'views': 1, 'danmakus': 2, 'coins': 3, 'likes': 4, 'reply': 5, 'favorite': 6, 'favorites': 7,
+             'share': 8},
+    'episodes': [{'id': 100, 'aid': 3, 'cid': 20, 'bvid': 'BV1', 'title': '1', 'show_title': '第1话',
+                  'link': 'https://www.bilibili.com/bangumi/play/ep100'},
+                 {'id': 101, 'aid': 4, 'cid': 21, 'bvid': 'BV2', 'title': '2', 'show_title': '第2话',
+                  'link': 'https://www.bilibili.com/bangumi/play/ep101'}]}}
+
+
+def mock_client(routes: dict, requested: list) -> httpx.AsyncClient:
+    def handler(request: httpx.Request):
+        requested.append(request.url.path)
+        return httpx.Response(200, json=routes[request.url.path])
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+async def test_get_video_info_api():
+    requested = []
+    routes = {'/x/web-interface/view': VIEW, '/x/player/playurl': PLAY_INFO,
+              '/pgc/view/web/season': SEASON, '/pgc/player/web/playurl': {'code': 0, 'result': PLAY_INFO['data']}}
+    async with mock_client(routes, requested) as c:
+        data = await api.get_video_info(c, "https://www.bilibili.com/video/BV1jK4y1N7ST?p=2")
+        assert requested == ['/x/web-interface/view', '/x/player/playurl']
+        assert (data.title, data.h1_title, data.aid, data.cid, data.p) == ('ab', 'ab', 2, 11, 1)
+        assert [p.p_name for p in data.pages] == ['P1-first', 'P2-second']
+        assert data.pages[1].p_url == 'https://www.bilibili.com/video/BV1jK4y1N7ST?p=2'
+        assert data.status.like == 7
+        video, audio = data.dash.choose_quality('720P')
+        assert video.base_url == 'https://upos/64.m4s' and audio.suffix == '.aac'
+
+        data = await api.get_video_info_api(c, "https://www.bilibili.com/bangumi/play/ep101")
+        assert (data.title, data.h1_title, data.cid, data.p) == ('天气之子', '天气之子-第2话', 21, 1)
+        assert data.status.follow == 7
+        assert data.img_url == 'http://i0.hdslb.com/season.jpg'
+        assert data.dash.choose_quality(0)[0].base_url == 'https://upos/80.m4s'
+
+
+@pytest.mark.asyncio
+async def test_get_video_info_fallback():
+    init_info = {'videoData': VIEW['data'], 'bvid': 'BV1jK4y1N7ST', 'aid': 2,
+                 'cidMap': {'BV1jK4y1N7ST': {'cids': {'1': 10}}}}
+    html = ('<h1 title="a/b">a/b</h1><meta property="og:image" content="//i0.hdslb.com/cover.jpg@100w">'
+            f'<script>window.__INITIAL_STATE__={json.dumps(init_info)};(function</script>'
+            f'<script>window.__playinfo__={json.dumps(PLAY_INFO)}</script><script>')
+    requested = []
+    routes = {'/x/web-interface/view': {'code': -352, 'message': '风控校验失败'}}
+
+    def handler(request: httpx.Request):
+        requested.append(request.url.path)
+        if request.url.path.startswith('/video/'):
+            return httpx.Response(200, text=html)
+        return httpx.Response(200, json=routes[request.url.path])
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as c:
+        data = await api.get_video_info(c, "https://www.bilibili.com/video/BV1jK4y1N7ST")
+        assert requested == ['/x/web-interface/view', '/video/BV1jK4y1N7ST']
+        assert (data.title, data.cid, data.p, data.img_url) == ('ab', 10, 0, 'http://i0.hdslb.com/cover.jpg')
+        assert data.dash.choose_quality(0)[0].base_url == 'https://upos/80.m4s'
+
+        routes['/x/web-interface/view'] = {'code': -404, 'message': '啥都木有'}
+        with pytest.raises(api.APIResourceError):
+            await api.get_video_info(c, "https://www.bilibili.com/video/BV1jK4y1N7ST")
+
+
+@pytest.mark.asyncio
+async def test_get_video_info_bangumi_page():
+    # file names of 动漫，电视剧，电影 come from og:title and h1 of the page
+    init_info = {'mediaInfo': {'stat': SEASON['result']['stat']},
+                 'epInfo': {'aid': 4, 'cid': 21, 'i': 1},
+                 'initEpList': [{'title': ep['title'], 'link': ep['link']} for ep in SEASON['result']['episodes']]}
+    html = ('<meta property="og:title" content="天气之子"><meta property="og:image" content="//i0.hdslb.com/s.jpg">'
+            '<h1 title="天气之子：第2话">天气之子：第2话</h1>'
+            f'<script>window.__INITIAL_STATE__={json.dumps(init_info)};(function</script>')
+    view = {'code': 0, 'data': {**VIEW['data'], 'redirect_url': 'https://www.bilibili.com/bangumi/play/ep101'}}
+    requested = []
+
+    def handler(request: httpx.Request):
+        requested.append(request.url.path)
+        if request.url.path == '/x/web-interface/view':
+            return httpx.Response(200, json=view)
+        if request.url.path == '/bangumi/play/ep101':
+            return httpx.Response(200, text=html)
+        return httpx.Response(302, headers={'Location': 'https://www.bilibili.com/bangumi/play/ep101'})
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as c:
+        data = await api.get_video_info(c, "https://www.bilibili.com/bangumi/play/ep101")
+        assert requested == ['/bangumi/play/ep101']
+        assert (data.title, data.h1_title, data.cid, data.p) == ('天气之子', '天气之子：第2话', 21, 1)
+        assert [p.p_name for p in data.pages] == ['1', '2']
+        # bv of a bangumi redirects to its page as well
+        requested.clear()
+        assert await api.get_video_info(c, "https://www.bilibili.com/video/BV2") == data
+        assert requested == ['/x/web-interface/view', '/video/BV2', '/bangumi/play/ep101']
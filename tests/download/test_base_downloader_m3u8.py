@@ -0,0 +1,393 @@
+import asyncio
+import os
+import random
+import httpx
+import m3u8
+import pytest
+from Crypto.Cipher import AES
+from bilix.download import BaseDownloaderM3u8
+import bilix.download.base_downloader_m3u8 as m3u8_module
+from bilix.download.base_downloader_m3u8 import SegmentDecoder, choose_variant
+from bilix.download.journal import SegmentJournal
+
+SEGS = [os.urandom(random.randint(1000, 5000)) for _ in range(20)]
+M3U8_URL = 'https://example.com/video/index.m3u8'
+PLAYLIST = '#EXTM3U\n#EXT-X-TARGETDURATION:2\n' + \
+           ''.join(f'#EXTINF:2.0,\nseg-{i}.ts\n' for i in range(len(SEGS))) + '#EXT-X-ENDLIST\n'
+
+
+def mock_client(requested: list = None):
+    async def delayed(content: bytes):
+        await asyncio.sleep(random.random() * 0.02)  # complete out of order
+        yield content
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text=PLAYLIST)
+        idx = int(name[4:-3])
+        if requested is not None:
+            requested.append(idx)
+        return httpx.Response(200, content=delayed(SEGS[idx]), headers={'Content-Length': str(len(SEGS[idx]))})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('ordered_write', [False, True])
+async def test_get_m3u8_video(tmp_path, ordered_write):
+    d = BaseDownloaderM3u8(client=mock_client(), part_concurrency=5, ordered_write=ordered_write)
+    d.MAX_REORDER_BUFFER = 8000
+    async with d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(SEGS)
+    assert os.listdir(tmp_path) == ['test.ts']
+
+
+@pytest.mark.asyncio
+async def test_get_m3u8_video_reorder_buffer(tmp_path, monkeypatch):
+    segs = [os.urandom(100_000) for _ in range(40)]
+    playlist = '#EXTM3U\n#EXT-X-TARGETDURATION:2\n' + \
+               ''.join(f'#EXTINF:2.0,\nseg-{i}.ts\n' for i in range(len(segs))) + '#EXT-X-ENDLIST\n'
+
+    async def stream(idx: int):
+        if idx == 0:  # the head segment stalls
+            await asyncio.sleep(0.3)
+        for i in range(0, len(segs[idx]), 10_000):
+            yield segs[idx][i:i + 10_000]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text=playlist)
+        idx = int(name[4:-3])
+        return httpx.Response(200, content=stream(idx), headers={'Content-Length': str(len(segs[idx]))})
+
+    writers = []
+
+    class Writer(m3u8_module.OrderedSegmentWriter):
+        def __init__(self, *args):
+            super().__init__(*args)
+            writers.append(self)
+
+    monkeypatch.setattr(m3u8_module, 'OrderedSegmentWriter', Writer)
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), part_concurrency=4,
+                           ordered_write=True)
+    d.MAX_REORDER_BUFFER = 200_000
+    async with d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(segs)
+    # segments already started may finish, no more
+    assert writers[0].max_buffered <= d.MAX_REORDER_BUFFER + 4 * 100_000
+
+
+@pytest.mark.asyncio
+async def test_get_m3u8_video_resume(tmp_path):
+    tmp = tmp_path / 'test.ts.tmp'
+    size = len(b''.join(SEGS[:5]))
+    tmp.write_bytes(b''.join(SEGS[:6])[:size + 100])  # a broken write after the commit
+    journal = SegmentJournal(tmp, f"{len(SEGS)} seg-0.ts", next_idx=5, size=size)
+    journal.save()
+    requested = []
+    async with BaseDownloaderM3u8(client=mock_client(requested)) as d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(SEGS)
+    assert sorted(requested) == list(range(5, len(SEGS)))
+    assert os.listdir(tmp_path) == ['test.ts']
+
+
+def test_segment_decoder():
+    key, iv = os.urandom(16), os.urandom(16)
+    data = os.urandom(1000 * 16)
+    raw = b'\x89PNG fake header\x47' + b'\x40' + AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+    decoder = SegmentDecoder(png=True, cipher=AES.new(key, AES.MODE_CBC, iv))
+    out = bytearray()
+    for i in range(0, len(raw), 17):  # header end and blocks cross chunks
+        out += decoder.feed(memoryview(raw)[i:i + 17])
+    out += decoder.close()
+    assert out == data
+
+
+@pytest.mark.asyncio
+async def test_get_m3u8_video_encrypted(tmp_path):
+    key, iv = os.urandom(16), os.urandom(16)
+    segs = [os.urandom(16 * random.randint(100, 300)) for _ in range(5)]
+    playlist = f'#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x{iv.hex()}\n' + \
+               ''.join(f'#EXTINF:2.0,\nseg-{i}.png\n' for i in range(len(segs))) + '#EXT-X-ENDLIST\n'
+    bodies = [b'\x89PNG\x47\x40' + AES.new(key, AES.MODE_CBC, iv).encrypt(seg) for seg in segs]
+    broken, key_requests = set(), []
+
+    async def stream(content: bytes):
+        for i in range(0, len(content), 1000):
+            yield content[i:i + 1000]
+
+    async def broken_stream(content: bytes):
+        yield content[:1000]
+        raise httpx.ReadError("connection reset")
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text=playlist)
+        if name == 'key.bin':
+            key_requests.append(request.url)
+            return httpx.Response(200, content=key)
+        idx = int(name[4:-4])
+        body = bodies[idx]
+        if 'Range' in request.headers:
+            start = int(request.headers['Range'][6:-1])
+            return httpx.Response(206, content=stream(body[start:]), headers={'Content-Length': str(len(body) - start)})
+        if idx not in broken:  # the first stream of each segment is broken
+            broken.add(idx)
+            return httpx.Response(200, content=broken_stream(body), headers={'Content-Length': str(len(body))})
+        return httpx.Response(200, content=stream(body), headers={'Content-Length': str(len(body))})
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), part_concurrency=3)
+    d.DECRYPT_BATCH_SIZE = 1000
+    async with d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(segs)
+    assert len(key_requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_m3u8_video_implicit_iv(tmp_path):
+    # without IV attribute the IV is the media sequence number of the segment (RFC 8216 5.2), not its index
+    key, sequence = os.urandom(16), 5
+    segs = [os.urandom(16 * random.randint(1, 10)) for _ in range(3)]
+    playlist = f'#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:{sequence}\n' \
+               '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"\n' + \
+               ''.join(f'#EXTINF:2.0,\nseg-{i}.ts\n' for i in range(len(segs))) + '#EXT-X-ENDLIST\n'
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text=playlist)
+        if name == 'key.bin':
+            return httpx.Response(200, content=key)
+        idx = int(name[4:-3])
+        body = AES.new(key, AES.MODE_CBC, (sequence + idx).to_bytes(16, 'big')).encrypt(segs[idx])
+        return httpx.Response(200, content=body, headers={'Content-Length': str(len(body))})
+
+    async with BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler))) as d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(segs)
+
+
+@pytest.mark.asyncio
+async def test_get_key():
+    requested = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(request.url.path)
+        return httpx.Response(200, content=request.url.path.encode())
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    d.MAX_KEY_CACHE = 2
+    async with d:
+        names = [0, 1, 0, 1, 2]
+        keys = await asyncio.gather(*[d._get_key(f'https://example.com/{i}.key') for i in names])
+        assert keys == [f'/{i}.key'.encode() for i in names]
+        # the least recently used one is dropped
+        assert list(d.decrypt_cache) == ['https://example.com/1.key', 'https://example.com/2.key']
+    assert sorted(requested) == ['/0.key', '/1.key', '/2.key']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('ordered_write', [False, True])
+async def test_get_m3u8_video_rotating_keys(tmp_path, ordered_write):
+    # every segment has its own key, more than MAX_KEY_CACHE of them
+    keys, iv = [os.urandom(16) for _ in range(100)], os.urandom(16)
+    segs = [os.urandom(16 * random.randint(1, 10)) for _ in range(len(keys))]
+    playlist = '#EXTM3U\n#EXT-X-TARGETDURATION:2\n' + \
+               ''.join(f'#EXT-X-KEY:METHOD=AES-128,URI="key-{i}.bin",IV=0x{iv.hex()}\n#EXTINF:2.0,\nseg-{i}.ts\n'
+                       for i in range(len(segs))) + '#EXT-X-ENDLIST\n'
+    key_requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text=playlist)
+        if name.startswith('key-'):
+            key_requests.append(name)
+            return httpx.Response(200, content=keys[int(name[4:-4])])
+        idx = int(name[4:-3])
+        body = AES.new(keys[idx], AES.MODE_CBC, iv).encrypt(segs[idx])
+        return httpx.Response(200, content=body, headers={'Content-Length': str(len(body))})
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), part_concurrency=4,
+                           ordered_write=ordered_write)
+    async with d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts')
+    assert path.read_bytes() == b''.join(segs)
+    # each key is requested exactly once
+    assert sorted(key_requests) == sorted(f'key-{i}.bin' for i in range(len(keys)))
+
+
+@pytest.mark.asyncio
+async def test_record_m3u8_live(tmp_path):
+    reloads, requested = 0, []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal reloads
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            # a sliding window of 4 segments which moves 3 segments forward each reload
+            end = min(4 + 3 * reloads, 10)
+            reloads += 1
+            playlist = f'#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:{end - 4}\n' + \
+                       ''.join(f'#EXTINF:1.0,\nseg-{i}.ts\n' for i in range(end - 4, end)) + \
+                       ('#EXT-X-ENDLIST\n' if end == 10 else '')
+            return httpx.Response(200, text=playlist)
+        idx = int(name[4:-3])
+        requested.append(idx)
+        return httpx.Response(200, content=SEGS[idx], headers={'Content-Length': str(len(SEGS[idx]))})
+
+    async with BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler))) as d:
+        path = await d.record_m3u8_live(M3U8_URL, path=tmp_path / 'live.ts')
+    assert reloads == 3
+    assert sorted(requested) == list(range(10))
+    assert path.read_bytes() == b''.join(SEGS[:10])
+    assert os.listdir(tmp_path) == ['live.ts']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('timeout', [60., 0.])
+async def test_record_m3u8_live_reload_error(tmp_path, timeout):
+    reloads, loads = 0, 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal reloads
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            end = min(4 + 3 * reloads, 10)
+            reloads += 1
+            playlist = f'#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:{end - 4}\n' + \
+                       ''.join(f'#EXTINF:0.1,\nseg-{i}.ts\n' for i in range(end - 4, end)) + \
+                       ('#EXT-X-ENDLIST\n' if end == 10 else '')
+            return httpx.Response(200, text=playlist)
+        idx = int(name[4:-3])
+        return httpx.Response(200, content=SEGS[idx], headers={'Content-Length': str(len(SEGS[idx]))})
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    d.LIVE_RELOAD_TIMEOUT = timeout
+    load_playlist = d._load_playlist
+
+    async def flaky_load_playlist(url: str):
+        nonlocal loads
+        loads += 1
+        if loads in (2, 3):  # the second and third reload fail after retries
+            raise httpx.ConnectError("connection refused")
+        return await load_playlist(url)
+
+    d._load_playlist = flaky_load_playlist
+    async with d:
+        path = await d.record_m3u8_live(M3U8_URL, path=tmp_path / 'live.ts')
+    if timeout:  # the recording goes on after the failed reloads
+        assert path.read_bytes() == b''.join(SEGS[:10])
+    else:  # what has been recorded is kept
+        assert path.read_bytes() == b''.join(SEGS[:4])
+    assert os.listdir(tmp_path) == ['live.ts']
+
+
+@pytest.mark.asyncio
+async def test_record_m3u8_live_broken_segment(tmp_path):
+    async def broken_stream(content: bytes):
+        yield content[:100]
+        raise httpx.ReadError("connection reset")
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':
+            return httpx.Response(200, text='#EXTM3U\n#EXT-X-TARGETDURATION:1\n' +
+                                             ''.join(f'#EXTINF:1.0,\nseg-{i}.ts\n' for i in range(4)) +
+                                             '#EXT-X-ENDLIST\n')
+        idx = int(name[4:-3])
+        if idx == 1:  # always breaks in the middle
+            return httpx.Response(200, content=broken_stream(SEGS[idx]),
+                                  headers={'Content-Length': str(len(SEGS[idx]))})
+        return httpx.Response(200, content=SEGS[idx], headers={'Content-Length': str(len(SEGS[idx]))})
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), stream_retry=1,
+                           part_concurrency=1)
+    async with d:
+        path = await d.record_m3u8_live(M3U8_URL, path=tmp_path / 'live.ts')
+    # no torn segment is left in the recording
+    assert path.read_bytes() == SEGS[0] + SEGS[2] + SEGS[3]
+
+
+@pytest.mark.asyncio
+async def test_record_m3u8_live_cancel(tmp_path):
+    def handler(request: httpx.Request) -> httpx.Response:
+        name = request.url.path.split('/')[-1]
+        if name == 'index.m3u8':  # never ends
+            return httpx.Response(200, text='#EXTM3U\n#EXT-X-TARGETDURATION:1\n' +
+                                             ''.join(f'#EXTINF:1.0,\nseg-{i}.ts\n' for i in range(3)))
+        idx = int(name[4:-3])
+        return httpx.Response(200, content=SEGS[idx], headers={'Content-Length': str(len(SEGS[idx]))})
+
+    async with BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler))) as d:
+        task = asyncio.create_task(d.record_m3u8_live(M3U8_URL, path=tmp_path / 'live.ts'))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert (tmp_path / 'live.ts').read_bytes() == b''.join(SEGS[:3])
+    assert os.listdir(tmp_path) == ['live.ts']
+
+
+MASTER = '#EXTM3U\n' + ''.join(f'#EXT-X-STREAM-INF:BANDWIDTH={bw},RESOLUTION={w}x{h}\n{bw}/index.m3u8\n'
+                                for bw, w, h in [(2000000, 1280, 720), (500000, 640, 360), (1000000, 854, 480)])
+
+
+def test_choose_variant():
+    playlists = sorted(m3u8.loads(MASTER, uri=M3U8_URL).playlists, key=lambda p: p.stream_info.bandwidth)
+    assert choose_variant(playlists) == 2
+    assert choose_variant(playlists, bandwidth=1500000) == 1
+    assert choose_variant(playlists, resolution=480) == 1
+    assert choose_variant(playlists, bandwidth=100) == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('ordered_write', [False, True])
+async def test_get_m3u8_video_variant_fallback(tmp_path, ordered_write):
+    requested = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        parts = request.url.path.split('/')
+        if parts[-1] == 'index.m3u8':
+            return httpx.Response(200, text=MASTER if parts[-2] == 'video' else PLAYLIST)
+        bw, idx = int(parts[-2]), int(parts[-1][4:-3])
+        requested.append((bw, idx))
+        if bw == 1000000 and idx == 3:  # cdn of the chosen variant fails
+            return httpx.Response(503)
+        return httpx.Response(200, content=SEGS[idx], headers={'Content-Length': str(len(SEGS[idx]))})
+
+    d = BaseDownloaderM3u8(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                           stream_retry=1, ordered_write=ordered_write)
+    async with d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'test.ts', bandwidth=1500000)
+    assert path.read_bytes() == b''.join(SEGS)
+    assert {bw for bw, _ in requested} == {1000000, 500000}
+    assert (500000, 3) in requested
+    assert d.throughput > 0
+
+
+@pytest.mark.asyncio
+async def test_get_m3u8_video_clip(tmp_path, monkeypatch):
+    # a fake ffmpeg copying the input file to the output file
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'ffmpeg').write_text('#!/bin/sh\nwhile [ "$1" != "-i" ]; do shift; done\n'
+                                    'src=$2\nfor a; do out=$a; done\ncat "$src" > "$out"\n')
+    (bin_dir / 'ffmpeg').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    requested = []
+    async with BaseDownloaderM3u8(client=mock_client(requested)) as d:
+        path = await d.get_m3u8_video(M3U8_URL, path=tmp_path / 'clip.ts', time_range=(5, 9))
+    # segments of 2s overlapping 5s-9s, the clip starts 1s into them
+    assert sorted(requested) == [2, 3, 4]
+    first, segs, s = BaseDownloaderM3u8._clip_segments(m3u8.loads(PLAYLIST).segments, (5, 9))
+    assert (first, [seg.uri for seg in segs], s) == (2, ['seg-2.ts', 'seg-3.ts', 'seg-4.ts'], 1.)
+    assert path.read_bytes() == b''.join(SEGS[2:5])
+    assert sorted(os.listdir(tmp_path)) == ['bin', 'clip.ts']
@@ -0,0 +1,264 @@
+import asyncio
+import os
+import re
+import struct
+import time
+import httpx
+import pytest
+from bilix.download import BaseDownloaderPart
+from bilix.download.base_downloader_part import PartRange, RangeScheduler, AIMDController
+from bilix.download.journal import PartJournal
+from bilix.download.media_cache import MediaIndexCache
+from bilix.utils import MirrorSelector
+
+DATA = os.urandom(1024 * 1024 + 7)
+URL = 'https://example.com/video/test.mp4'
+
+
+def range_handler(request: httpx.Request) -> httpx.Response:
+    start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers['Range']).groups()
+    start, end = int(start), min(int(end) if end else len(DATA) - 1, len(DATA) - 1)
+    return httpx.Response(206, content=DATA[start:end + 1],
+                          headers={'Content-Range': f'bytes {start}-{end}/{len(DATA)}'})
+
+
+def mock_client():
+    return httpx.AsyncClient(transport=httpx.MockTransport(range_handler))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('preallocate', [False, True])
+async def test_get_file(tmp_path, preallocate):
+    async with BaseDownloaderPart(client=mock_client(), part_concurrency=4, preallocate=preallocate) as d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.name == 'test.mp4'
+    assert path.read_bytes() == DATA
+    assert os.listdir(tmp_path) == ['test.mp4']
+
+
+def test_range_scheduler():
+    scheduler = RangeScheduler([PartRange(0, 99), PartRange(100, 199)], min_split=10)
+    a, b = scheduler.acquire(), scheduler.acquire()
+    a.start = 90  # almost finished
+    c = scheduler.acquire()  # steal the tail of b
+    assert (b.start, b.end, c.start, c.end) == (100, 149, 150, 199)
+    a.start = 100
+    scheduler.release(a)
+    b.start, c.start = 140, 190
+    assert scheduler.acquire() is None  # remaining ranges are too small to split
+    assert scheduler.splits == 1
+
+
+@pytest.mark.asyncio
+async def test_get_file_work_stealing(tmp_path):
+    async def slow_stream(content: bytes):
+        for i in range(0, len(content), 4096):
+            await asyncio.sleep(0.01)
+            yield content[i:i + 4096]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        res = range_handler(request)
+        if request.headers['Range'].startswith('bytes=0-'):  # the first stream is slow
+            return httpx.Response(206, content=slow_stream(res.content), headers=res.headers)
+        return res
+
+    d = BaseDownloaderPart(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                           part_concurrency=4, preallocate=True)
+    d.MIN_SPLIT_SIZE = 16 * 1024
+    async with d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.read_bytes() == DATA
+
+
+def test_aimd_controller():
+    c = AIMDController(4, upper=6, interval=0.)
+    c.on_sample(100.)
+    c.on_sample(200.)
+    assert c.limit == 6
+    c.on_sample(300.)
+    assert c.limit == 6  # upper bound
+    c.on_error()
+    assert c.limit == 3
+    c.running = 4
+    assert c.overloaded
+    c.on_sample(100.)
+    c.on_sample(101.)  # no obvious improvement
+    assert c.limit == 4
+
+
+@pytest.mark.asyncio
+async def test_get_file_adaptive(tmp_path):
+    req_num = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal req_num
+        req_num += 1
+        if 1 < req_num <= 5:  # a burst of errors after the first request
+            raise httpx.ConnectError("too many connections", request=request)
+        return range_handler(request)
+
+    d = BaseDownloaderPart(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                           part_concurrency=8, preallocate=True, adaptive_concurrency=True)
+    d.ADAPTIVE_INTERVAL = 10.
+    async with d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.read_bytes() == DATA
+    assert d._host_concurrency['example.com'] == 4
+
+
+def test_part_journal(tmp_path):
+    path = tmp_path / 'test.mp4.tmp'
+    path.touch()
+    journal = PartJournal(path, 100, {'ETag': 'a'})
+    journal.add(0, 9)
+    journal.add(20, 29)
+    journal.add(10, 14)
+    assert journal.extents == [[0, 14], [20, 29]]
+    assert journal.missing(5, 99) == [(15, 19), (30, 99)]
+    assert journal.committed == 25
+    journal.save()
+    assert PartJournal.load(path, 100, {'ETag': 'a'}).extents == journal.extents
+    assert PartJournal.load(path, 100, {'ETag': 'b'}) is None
+    journal.remove()
+    assert PartJournal.load(path, 100, {'ETag': 'a'}) is None
+
+
+@pytest.mark.asyncio
+async def test_get_file_resume(tmp_path):
+    requested = 0
+
+    async def stream(content: bytes):
+        nonlocal requested
+        for i in range(0, len(content), 4096):
+            requested += len(content[i:i + 4096])
+            yield content[i:i + 4096]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        res = range_handler(request)
+        return httpx.Response(206, content=stream(res.content), headers=res.headers)
+
+    # a half finished download
+    tmp = tmp_path / 'test.mp4.tmp'
+    tmp.write_bytes(DATA[:len(DATA) // 2] + bytes(len(DATA) - len(DATA) // 2))
+    journal = PartJournal(tmp, len(DATA), {})
+    journal.add(0, len(DATA) // 2 - 1)
+    journal.save()
+    async with BaseDownloaderPart(client=httpx.AsyncClient(transport=httpx.MockTransport(handler))) as d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.read_bytes() == DATA
+    assert requested < len(DATA) // 2 + 10 * 4096
+    assert os.listdir(tmp_path) == ['test.mp4']
+
+
+@pytest.mark.asyncio
+async def test_get_file_resume_close_probe(tmp_path):
+    probe_closed, closed_at_request = False, []
+
+    class ProbeStream(httpx.AsyncByteStream):
+        def __init__(self, content: bytes):
+            self.content = content
+
+        async def __aiter__(self):
+            yield self.content
+
+        async def aclose(self):
+            nonlocal probe_closed
+            probe_closed = True
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        res = range_handler(request)
+        if request.headers['Range'] == 'bytes=0-':
+            return httpx.Response(206, stream=ProbeStream(res.content), headers=res.headers)
+        closed_at_request.append(probe_closed)
+        return res
+
+    # byte 0 is already downloaded
+    tmp = tmp_path / 'test.mp4.tmp'
+    tmp.write_bytes(DATA[:len(DATA) // 2] + bytes(len(DATA) - len(DATA) // 2))
+    journal = PartJournal(tmp, len(DATA), {})
+    journal.add(0, len(DATA) // 2 - 1)
+    journal.save()
+    async with BaseDownloaderPart(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                                  part_concurrency=4) as d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.read_bytes() == DATA
+    assert closed_at_request and all(closed_at_request)
+
+
+@pytest.mark.asyncio
+async def test_get_file_reuse_probe(tmp_path):
+    ranges = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        ranges.append(request.headers['Range'])
+        return range_handler(request)
+
+    async with BaseDownloaderPart(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                                  part_concurrency=4) as d:
+        path = await d.get_file(URL, path=tmp_path)
+    assert path.read_bytes() == DATA
+    # the probe is the first part
+    assert len(ranges) == 4 and ranges[0] == 'bytes=0-'
+
+
+def test_coalesce():
+    parts = [(0, 99), (200, 299), (300, 399), (400, 499), (500, 599)]
+    assert BaseDownloaderPart._coalesce(parts, 1) == [(0, 99), (200, 599)]
+    assert BaseDownloaderPart._coalesce(parts, 5) == [(0, 99), (200, 299), (300, 399), (400, 499), (500, 599)]
+    assert BaseDownloaderPart._coalesce(parts[1:], 3) == [(200, 333), (334, 467), (468, 599)]
+
+
+@pytest.mark.asyncio
+async def test_pipe_clip(tmp_path, monkeypatch):
+    # a fake ffmpeg copying stdin to the output file
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'ffmpeg').write_text('#!/bin/sh\nfor a; do out=$a; done\ncat > "$out"\n')
+    (bin_dir / 'ffmpeg').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    d = BaseDownloaderPart(client=mock_client(), part_concurrency=2)
+    d.PIPE_CHUNK_SIZE = 100 * 1024
+    path = tmp_path / 'clip.mp4'
+    async with d:
+        task_id = await d.progress.add_task(description='clip', total=len(DATA))
+        await d._pipe_clip(MirrorSelector([URL]),
+                           [(1000, len(DATA) - 1)], DATA[:1000], path, task_id, [])
+    assert path.read_bytes() == DATA
+
+
+@pytest.mark.asyncio
+async def test_media_index_cache(tmp_path):
+    n = 3
+    body = struct.pack('>B3sIIIIHH', 0, b'\0\0\0', 1, 1000, 0, 0, 0, n) + \
+        b''.join(struct.pack('>III', 100, 2000, 0x90000000) for _ in range(n))
+    sidx = struct.pack('>I4s', 8 + len(body), b'sidx') + body
+    init = b'init' * 10
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url)
+        return httpx.Response(206, content=init + sidx)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    init_range, seg_range = f'0-{len(init) - 1}', f'{len(init)}-{len(init) + len(sidx) - 1}'
+    for i in range(2):
+        d = BaseDownloaderPart(client=client)
+        d.index_cache = MediaIndexCache(tmp_path)  # a new run with empty memory
+        index = await d._get_media_index(MirrorSelector([f'{URL}?sign={i}']), init_range, seg_range)
+        assert index.init_data == init
+        assert index.timescale == 1000 and index.references == [(2000, 100)] * n
+        index = await d._get_media_index(MirrorSelector([f'{URL}?sign={i}']), init_range, seg_range)
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_speed_limit(tmp_path):
+    speed_limit = 500 * 1024
+    async with BaseDownloaderPart(client=mock_client(), part_concurrency=50, speed_limit=speed_limit) as d:
+        a = time.monotonic()
+        path = await d.get_file(URL, path=tmp_path)
+        elapsed = time.monotonic() - a
+    assert path.read_bytes() == DATA
+    # the initial burst is free
+    speed = (len(DATA) - speed_limit * d.BURST_TIME) / elapsed
+    assert abs(speed / speed_limit - 1) < 0.05
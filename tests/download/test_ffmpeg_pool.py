@@ -0,0 +1,47 @@
+import asyncio
+import sys
+import pytest
+from bilix.download.ffmpeg_pool import FFmpegPool
+
+
+@pytest.mark.asyncio
+async def test_ffmpeg_pool():
+    pool = FFmpegPool(workers=2)
+    running, max_running = 0, 0
+
+    async def job():
+        nonlocal running, max_running
+        async with pool.slot():
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*[job() for _ in range(10)])
+    assert max_running == 2
+    res = await pool.run([sys.executable, '-c', 'print("ok")'])
+    assert res.stdout.strip() == b'ok'
+    with pytest.raises(Exception):
+        await pool.run([sys.executable, '-c', 'exit(1)'])
+    stats = pool.stats()
+    assert (stats['running'], stats['queued'], stats['completed'], stats['failed']) == (0, 0, 11, 1)
+    assert stats['max_queued'] == 8  # 2 of 10 started at once
+
+
+@pytest.mark.asyncio
+async def test_ffmpeg_pool_resize():
+    pool = FFmpegPool(workers=1)
+    started = []
+
+    async def job(i):
+        async with pool.slot():
+            started.append(i)
+            await asyncio.sleep(1 if i == 0 else 0)
+
+    tasks = [asyncio.create_task(job(i)) for i in range(3)]
+    await asyncio.sleep(0.1)
+    assert started == [0]
+    pool.workers = 3  # waiting jobs start without waiting for the first one
+    await asyncio.sleep(0.1)
+    assert sorted(started) == [0, 1, 2]
+    await asyncio.gather(*tasks)
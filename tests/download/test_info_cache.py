@@ -0,0 +1,159 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import httpx
+import pytest
+import bilix.api.bilibili as api
+from bilix.api.bilibili import VideoInfo, Dash, Media, Status, Page
+from bilix.download import DownloaderBilibili
+from bilix.download.info_cache import VideoInfoCache
+
+
+def video_info(bvid='BV1jK4y1N7ST', p=1, deadline: float = None, host='upos') -> VideoInfo:
+    query = f'?deadline={int(deadline)}' if deadline else ''
+    media = Media(base_url=f'https://{host}/v.m4s{query}', codec='avc1', quality='1080P')
+    audio = Media(base_url=f'https://{host}/a.m4s{query}', codec='mp4a.40.2', quality='192K', suffix='.aac')
+    dash = Dash(duration=1, videos=[media], audios=[audio], video_formats={'1080P': {'avc1': media}},
+                audio_formats={'192K': audio})
+    pages = [Page(p_name=f'P{i + 1}', p_url=f'https://www.bilibili.com/video/{bvid}?p={i + 1}') for i in range(2)]
+    return VideoInfo(title='t', h1_title='t', aid=1, cid=10 + p, p=p, pages=pages, img_url='http://i0/a.jpg',
+                     status=Status(view=1, danmaku=0, coin=0, like=0, reply=0, favorite=0, share=0),
+                     bvid=bvid, dash=dash)
+
+
+def test_key():
+    assert VideoInfoCache.key('https://www.bilibili.com/video/BV1jK4y1N7ST?spm_id_from=333') == 'BV1jK4y1N7ST?p=1'
+    assert VideoInfoCache.key('https://www.bilibili.com/video/BV1jK4y1N7ST?p=2') == 'BV1jK4y1N7ST?p=2'
+    assert VideoInfoCache.key('https://www.bilibili.com/bangumi/play/ep100?from=1') == '/bangumi/play/ep100'
+    assert VideoInfoCache.key('https://b23.tv/abc') == 'https://b23.tv/abc'
+    assert VideoInfoCache.key('https://b23.tv/abc', 'a') != VideoInfoCache.key('https://b23.tv/abc', 'b')
+
+
+@pytest.mark.asyncio
+async def test_resolve(tmp_path):
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3')
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return video_info()
+
+    url = 'https://www.bilibili.com/video/BV1jK4y1N7ST?p=2'
+    infos = await asyncio.gather(*[cache.resolve(url, fetch) for _ in range(5)])
+    assert calls == 1 and all(i is infos[0] for i in infos)
+    # the page url of the series is cached as well
+    assert await cache.resolve('https://www.bilibili.com/video/BV1jK4y1N7ST?p=2&spm_id_from=1', fetch) is infos[0]
+    assert calls == 1
+    # another user
+    await cache.resolve(url, fetch, user='sess')
+    assert calls == 2
+
+    # on disk
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3')
+    info = await cache.resolve(url, fetch)
+    assert calls == 2 and info.cid == 11 and info.dash.videos[0].base_url == 'https://upos/v.m4s'
+
+    async def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await asyncio.gather(*[cache.resolve('https://www.bilibili.com/video/BV2', fail) for _ in range(2)])
+    assert cache.get(cache.key('https://www.bilibili.com/video/BV2')) is None
+
+
+def test_ttl(tmp_path):
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3', stream_ttl=60)
+    key = cache.key('https://www.bilibili.com/video/BV1jK4y1N7ST?p=2')
+    cache.put(key, video_info())
+    assert cache.get(key)
+    cache.stream_ttl = 0
+    assert cache.get(key) is None
+    assert cache.get(key, streams=False)  # metadata still fresh
+    cache.meta_ttl = 0
+    assert cache.get(key, streams=False) is None
+
+    # deadline of the stream urls
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3')
+    cache.put(key, video_info(deadline=time.time() + cache.DEADLINE_MARGIN / 2))
+    assert cache.get(key) is None and cache.get(key, streams=False)
+    cache.put(key, video_info(deadline=time.time() + 3600))
+    assert cache.get(key)
+
+
+def test_evict(tmp_path):
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3', max_memory=2, max_disk=4)
+    for i in range(5):
+        # each video is stored under its url and its page url
+        cache.put(f'https://www.bilibili.com/video/BV{i}?p=1', video_info(f'BV{i}'))
+    assert len(cache._memory) == 2
+    with sqlite3.connect(tmp_path / 'info.sqlite3') as db:
+        assert db.execute("SELECT COUNT(*) FROM video_info").fetchone()[0] == 4
+    cache.clear()
+    assert cache.get('BV4?p=2') is None
+
+
+@pytest.mark.asyncio
+async def test_database_thread(tmp_path, monkeypatch):
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3')
+    threads = []
+    for name in ('_read', '_write', '_delete'):
+        def wrapper(*args, _f=getattr(cache, name)):
+            threads.append(threading.current_thread())
+            return _f(*args)
+
+        monkeypatch.setattr(cache, name, wrapper)
+
+    async def fetch():
+        return video_info()
+
+    url = 'https://www.bilibili.com/video/BV1jK4y1N7ST?p=2'
+    await cache.resolve(url, fetch)
+    await cache.invalidate(url)
+    # the database is only used off the event loop
+    assert len(threads) == 3 and threading.current_thread() not in threads
+    assert not cache._memory and await cache.aget(cache.key(url)) is None
+
+
+@pytest.mark.asyncio
+async def test_refetch_refused_streams(tmp_path, monkeypatch):
+    data = b'audio' * 1000
+    requested, fetches = [], 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested.append(request.url.host)
+        if request.url.host == 'old':  # revoked before its deadline
+            return httpx.Response(403)
+        start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers['Range']).groups()
+        start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+        return httpx.Response(206, content=data[start:end + 1],
+                              headers={'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+    async def get_video_info(client, url):
+        nonlocal fetches
+        fetches += 1
+        return video_info(p=0, host='new')
+
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay, result=None: sleep(0, result))  # no backoff between retries
+    monkeypatch.setattr(api, 'get_video_info', get_video_info)
+    url = 'https://www.bilibili.com/video/BV1jK4y1N7ST'
+    cache = VideoInfoCache(tmp_path / 'info.sqlite3')
+    cache.put(cache.key(url), video_info(p=0, host='old'))
+    async with DownloaderBilibili(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+                                  part_concurrency=2) as d:
+        d.info_cache = cache
+        await d.get_video(url, path=tmp_path, only_audio=True)
+        assert fetches == 1 and 'old' in requested
+        assert cache.get(cache.key(url)).dash.audios[0].base_url == 'https://new/a.m4s'
+        assert (tmp_path / 't-P1.aac').read_bytes() == data
+
+        # refused again after the refetch, it is an error
+        fetches = 0
+        cache.put(cache.key(url), video_info(p=0, host='old'))
+        monkeypatch.setattr(api, 'get_video_info', lambda client, url: asyncio.sleep(0, video_info(p=0, host='old')))
+        with pytest.raises(httpx.HTTPStatusError):
+            await d.get_video(url, path=tmp_path / 'again', only_audio=True)
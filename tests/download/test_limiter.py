@@ -0,0 +1,53 @@
+import asyncio
+import time
+import pytest
+from bilix.download.limiter import BandwidthManager
+
+
+async def run_streams(manager: BandwidthManager, tasks, duration: float, chunk: int = 16 * 1024):
+    """run 5 streams for each (site, task_id) and return the bytes of each"""
+    used = {t: 0 for t in tasks}
+    end = time.monotonic() + duration
+
+    async def stream(t):
+        while time.monotonic() < end:
+            await manager.acquire(*t, chunk)
+            if time.monotonic() < end:  # not a reservation after the end
+                used[t] += chunk
+
+    await asyncio.gather(*[stream(t) for t in tasks for _ in range(5)])
+    return used
+
+
+def test_water_fill():
+    alloc = BandwidthManager._water_fill(300, {'a': (2, float('inf')), 'b': (1, float('inf')), 'c': (1, 0)})
+    assert alloc == {'a': 200, 'b': 100}
+    alloc = BandwidthManager._water_fill(300, {'a': (1, float('inf')), 'b': (1, 50)})
+    assert alloc == {'a': 250, 'b': 50}
+    alloc = BandwidthManager._water_fill(300, {'a': (1, 50), 'b': (1, 50)})
+    assert alloc == {'a': 150, 'b': 150}
+
+
+@pytest.mark.asyncio
+async def test_bandwidth_weights():
+    rate = 1024 * 1024
+    manager = BandwidthManager(rate)
+    manager.set_site('a', weight=2)
+    used = await run_streams(manager, [('a', 0), ('b', 0)], duration=2.)
+    total = sum(used.values())
+    assert abs(total / (rate * 2) - 1) < 0.1
+    assert 1.6 < used[('a', 0)] / used[('b', 0)] < 2.4
+
+
+@pytest.mark.asyncio
+async def test_bandwidth_redistribution():
+    rate = 1024 * 1024
+    manager = BandwidthManager(rate)
+    manager.set_site('b', rate=rate / 4)
+    manager.set_task_weight('a', 1, 3)
+    used = await run_streams(manager, [('a', 0), ('a', 1), ('b', 0)], duration=2.)
+    total = sum(used.values())
+    assert abs(total / (rate * 2) - 1) < 0.1
+    # b is capped at 1/4, the rest goes to a and is split 1:3
+    assert abs(used[('b', 0)] / total - 0.25) < 0.05
+    assert 2.4 < used[('a', 1)] / used[('a', 0)] < 3.6
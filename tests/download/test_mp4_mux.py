@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import struct
+import subprocess
+import pytest
+from pymp4.parser import Box
+import bilix.download.mp4_mux
+from bilix.api.bilibili import Media
+from bilix.download import DownloaderBilibili
+from bilix.download.mp4_mux import mux_dash, _iter_boxes, _path
+
+
+def box(box_type: bytes, *children: bytes) -> bytes:
+    body = b''.join(children)
+    return struct.pack('>I4s', 8 + len(body), box_type) + body
+
+
+def full_box(box_type: bytes, flags: int, body: bytes) -> bytes:
+    return box(box_type, struct.pack('>I', flags), body)
+
+
+def fmp4(track_id: int, movie_timescale: int, duration: int, timescale: int, fragments, base_offset=False) -> bytes:
+    mvhd = full_box(b'mvhd', 0, struct.pack('>IIIIIH10x36x24xI', 0, 0, movie_timescale, duration,
+                                             0x10000, 0x100, track_id + 1))
+    tkhd = full_box(b'tkhd', 3, struct.pack('>IIIII8xHHHH36xII', 0, 0, track_id, 0, duration, 0, 0, 0, 0, 0, 0))
+    elst = full_box(b'elst', 0, struct.pack('>IIiI', 1, duration, 0, 0x10000))
+    mdhd = full_box(b'mdhd', 0, struct.pack('>IIIIHH', 0, 0, timescale, 0, 0x55c4, 0))
+    trak = box(b'trak', tkhd, box(b'edts', elst), box(b'mdia', mdhd))
+    mvex = box(b'mvex', full_box(b'mehd', 0, struct.pack('>I', duration)),
+               full_box(b'trex', 0, struct.pack('>IIIII', track_id, 1, 0, 0, 0)))
+    data = box(b'ftyp', b'iso5', struct.pack('>I', 0), b'iso6mp41') + box(b'moov', mvhd, trak, mvex)
+    data += box(b'sidx', b'\0' * 24)
+    for i, (decode_time, payload) in enumerate(fragments):
+        flags = 0x1 if base_offset else 0x20000
+        tfhd = full_box(b'tfhd', flags, struct.pack('>IQ', track_id, len(data)) if base_offset else
+                        struct.pack('>I', track_id))
+        traf = box(b'traf', tfhd, box(b'tfdt', struct.pack('>I', 0x01000000), struct.pack('>Q', decode_time)))
+        data += box(b'moof', full_box(b'mfhd', 0, struct.pack('>I', i + 1)), traf) + box(b'mdat', payload)
+    return data
+
+
+def test_mux_dash(tmp_path):
+    video = fmp4(1, 1000, 6000, 90000, [(0, b'v0'), (180000, b'v1'), (360000, b'v2')])
+    audio = fmp4(1, 500, 5000, 48000, [(0, b'a0' * 1000), (144000, b'a1')], base_offset=True)
+    (tmp_path / 'v').write_bytes(video)
+    (tmp_path / 'a').write_bytes(audio)
+    mux_dash(tmp_path / 'v', tmp_path / 'a', tmp_path / 'out.mp4')
+    data = (tmp_path / 'out.mp4').read_bytes()
+    boxes = list(_iter_boxes(data))
+    assert [b[0] for b in boxes] == [b'ftyp', b'moov'] + [b'moof', b'mdat'] * 5 + [b'mfra']
+    moov = data[boxes[1][1]:boxes[1][1] + boxes[1][3]]
+    parsed = Box.parse(moov)
+    assert [b.track_ID for b in parsed.children if b.type == b'trak' for b in b.children if b.type == b'tkhd'] \
+           == [1, 2]
+    mvhd = next(b for b in parsed.children if b.type == b'mvhd')
+    assert mvhd.next_track_ID == 3 and mvhd.duration == 10000  # audio duration in video movie timescale
+    # elst of audio is rescaled too
+    a_trak = [moov[8 + pos:8 + pos + size] for t, pos, _, size in _iter_boxes(moov[8:]) if t == b'trak'][1]
+    pos, header, _ = _path(a_trak[8:], [b'edts', b'elst'])
+    assert struct.unpack_from('>I', a_trak, 8 + pos + header + 8)[0] == 10000
+    assert [b.track_ID for b in next(b for b in parsed.children if b.type == b'mvex').children
+            if b.type == b'trex'] == [1, 2]
+    # interleaved by decode time
+    mdats, track_ids = [], []
+    for i, (box_type, pos, header, size) in enumerate(boxes[2:-1]):
+        if box_type == b'mdat':
+            mdats.append(data[pos + header:pos + size])
+        else:
+            moof = Box.parse(data[pos:pos + size])
+            assert moof.children[0].sequence_number == i // 2 + 1
+            tfhd = moof.children[1].children[0]
+            track_ids.append(tfhd.track_ID)
+            if tfhd.track_ID == 2:  # absolute offsets point to the new place of the moof
+                assert tfhd.base_data_offset == pos
+    assert mdats == [b'v0', b'a0' * 1000, b'v1', b'a1', b'v2']
+    assert track_ids == [1, 2, 1, 2, 1]
+    # mfra indexes the moofs of each track, mfro at the end gives its size
+    _, mfra, _, mfra_size = boxes[-1]
+    assert struct.unpack_from('>I', data, len(data) - 4)[0] == mfra_size
+    moofs = [pos for box_type, pos, _, _ in boxes if box_type == b'moof']
+    tfras = {}
+    for box_type, pos, header, size in _iter_boxes(data, mfra + 8, mfra + mfra_size):
+        if box_type == b'tfra':
+            track_id, _, count = struct.unpack_from('>III', data, pos + header + 4)
+            tfras[track_id] = [struct.unpack_from('>QQ', data, pos + header + 16 + 19 * i) for i in range(count)]
+    assert tfras == {1: [(0, moofs[0]), (180000, moofs[2]), (360000, moofs[4])],
+                     2: [(0, moofs[1]), (144000, moofs[3])]}
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg') or not shutil.which('ffprobe'), reason='ffmpeg is not installed')
+def test_mux_dash_ffprobe(tmp_path):
+    def dash(name: str, *args):
+        # a single track fragmented mp4 like the DASH streams of the site
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', *args, '-movflags',
+                        'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', str(tmp_path / name)], check=True)
+
+    dash('v', '-i', 'testsrc=duration=4:size=64x64:rate=25', '-c:v', 'mpeg4', '-g', '25')
+    dash('a', '-i', 'sine=duration=4', '-c:a', 'aac', '-frag_duration', '1000000')
+    mux_dash(tmp_path / 'v', tmp_path / 'a', tmp_path / 'out.mp4')
+    out = subprocess.run(['ffprobe', '-v', 'error', '-count_packets', '-show_streams', '-show_format', '-of', 'json',
+                          str(tmp_path / 'out.mp4')], check=True, capture_output=True).stdout
+    probe = json.loads(out)
+    streams = {s['codec_type']: s for s in probe['streams']}
+    assert streams.keys() == {'video', 'audio'}
+    assert int(streams['video']['nb_read_packets']) == 100
+    assert int(streams['audio']['nb_read_packets']) > 0
+    assert abs(float(probe['format']['duration']) - 4) < 0.2
+    # every frame decodes
+    subprocess.run(['ffmpeg', '-v', 'error', '-xerror', '-i', str(tmp_path / 'out.mp4'), '-f', 'null', '-'],
+                   check=True)
+
+
+@pytest.mark.asyncio
+async def test_native_mux_fallback(tmp_path, monkeypatch):
+    (tmp_path / 'v').write_bytes(fmp4(1, 1000, 6000, 90000, [(0, b'v0'), (180000, b'v1')]))
+    (tmp_path / 'a').write_bytes(fmp4(1, 500, 5000, 48000, [(0, b'a0'), (144000, b'a1')]))
+
+    def append_file(*args):
+        raise OSError(5, 'Input/output error')
+
+    monkeypatch.setattr(bilix.download.mp4_mux, 'append_file', append_file)
+    audio = Media(base_url='https://upos/a.m4s', suffix='.aac')
+    async with DownloaderBilibili(native_mux=True) as d:
+        # ffmpeg is used instead
+        assert not await d._native_mux([tmp_path / 'v', tmp_path / 'a'], tmp_path / 'out.mp4', audio)
+    assert sorted(os.listdir(tmp_path)) == ['a', 'v']
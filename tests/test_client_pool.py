@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+from bilix.client_pool import ClientRegistry, media_extensions
+
+
+async def start_server():
+    """a tiny keep-alive http server, returns server and its accepted connection count"""
+    connections = []
+    active = [0, 0]  # current, max
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connections.append(writer)
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                active[0] += 1
+                active[1] = max(active)
+                await asyncio.sleep(0.05)
+                active[0] -= 1
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, connections, active
+
+
+@pytest.mark.asyncio
+async def test_client_registry():
+    server, connections, active = await start_server()
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+    registry = ClientRegistry()
+    registry.MAX_PER_HOST = 2
+    a = registry.client(headers={'referer': 'a'})
+    b = registry.client(headers={'referer': 'b'}, cookies={'k': 'v'})
+    c = registry.client(http2=True)
+    assert len(registry.pools) == 2
+    # sequential requests of different clients reuse one connection
+    assert (await a.get(url)).text == 'ok'
+    assert (await b.get(url)).text == 'ok'
+    assert len(connections) == 1
+    await asyncio.gather(*[client.get(url) for client in (a, b) for _ in range(4)])
+    assert active[1] == 2  # per host cap
+    stats = list(registry.stats().values())[0]
+    assert stats['clients'] == 2 and stats['requests'] == 10 and stats['connections'] == 2
+    await a.aclose()
+    assert len(registry.pools) == 2
+    await b.aclose()
+    await c.aclose()
+    assert not registry.pools
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_media_transport():
+    server, connections, active = await start_server()
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+    registry = ClientRegistry()
+    client = registry.client()
+    await client.get(url)  # api connection
+    extensions = media_extensions('http1', 3)
+    await asyncio.gather(*[client.get(url, extensions=extensions) for _ in range(9)])
+    assert active[1] == 3 and len(connections) == 1 + 3
+    assert list(registry.stats().values())[0]['connections'] == 4
+    await client.aclose()
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,42 @@
+import pytest
+from bilix.progress import CLIProgress
+from bilix.progress.abc import Progress
+
+
+@pytest.mark.asyncio
+async def test_batched_advance():
+    progress = CLIProgress()
+    progress.FLUSH_INTERVAL = 100.
+    progress.FLUSH_BYTES = 1000
+    task_id = await progress.add_task(description='test', total=3000)
+    assert await progress.advance(task_id, 400) == 0
+    assert await progress.advance(task_id, 400) == 0
+    assert progress.tasks[task_id].completed == 0
+    assert await progress.advance(task_id, 400) == 1200
+    assert await progress.advance(task_id, 100) == 0
+    assert await progress.flush(task_id) == 100
+    assert await progress.flush(task_id) == 0
+    assert progress.tasks[task_id].completed == 1300
+    await progress.update(task_id, visible=False)
+
+
+@pytest.mark.asyncio
+async def test_advance_without_super_init():
+    class MyProgress(Progress):
+        def __init__(self):  # a third party progress which does not call super().__init__()
+            self.completed = 0
+
+        start = stop = classmethod(lambda cls: None)
+        tasks = active_speed = lambda self: None
+
+        async def add_task(self, description: str, **kwargs):
+            return 0
+
+        async def update(self, task_id, *, advance=None, **kwargs):
+            self.completed += advance or 0
+
+    progress = MyProgress()
+    progress.FLUSH_BYTES = 1000
+    assert await progress.advance(0, 400) == 0
+    assert await progress.flush(0) == 400
+    assert progress.completed == 400
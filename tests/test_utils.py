@@ -1,4 +1,10 @@
-from bilix.utils import parse_bytes_str, legal_title, valid_sess_data
+import errno
+import os
+import httpx
+import pytest
+import bilix.utils
+from bilix.utils import parse_bytes_str, legal_title, valid_sess_data, MirrorSelector, merge_files, append_file, \
+    req_retry, preallocate_file
 
 
 def test_legal_file_name():
@@ -15,3 +21,108 @@ def test_valid_sess_data():
     s = valid_sess_data(None)
     s = valid_sess_data("hello world!")
     pass
+
+
+def test_mirror_selector():
+    mirrors = MirrorSelector(['a', 'b', 'c'])
+    # unmeasured mirrors are tried first
+    assert [mirrors.choose() for _ in range(3)] == [0, 1, 2]
+    mirrors.report(0, ttfb=0.1, size=1000, elapsed=1.)
+    mirrors.report(1, ttfb=0.1, size=100000, elapsed=1.)
+    mirrors.report_error(2)
+    assert mirrors.choose() == 1
+    mirrors.report(1)
+    for _ in range(MirrorSelector.MAX_ERRORS - 1):
+        mirrors.report_error(2)
+    assert mirrors.dropped == [False, False, True]
+    for _ in range(MirrorSelector.MAX_ERRORS):
+        mirrors.report_error(1)
+    assert mirrors.dropped == [False, True, True]
+    assert mirrors.choose() == 0
+    for _ in range(MirrorSelector.MAX_ERRORS):
+        mirrors.report_error(0)
+    assert not mirrors.dropped[0]  # never drop the last one
+
+
+def test_mirror_selector_unknown_throughput():
+    mirrors = MirrorSelector(['a', 'b'])
+    assert [mirrors.choose() for _ in range(2)] == [0, 1]
+    mirrors.report(0, ttfb=0.1, size=1024 * 1024, elapsed=1.)  # 1MB/s
+    mirrors.report(1, ttfb=0.05)  # a probe, only ttfb
+    # b is as fast as a in transfer, not infinitely fast
+    assert mirrors.score(1) == pytest.approx(1024 * 1024 / 1.05)
+    mirrors.report(1, ttfb=0.05, size=1024 * 1024, elapsed=10.)
+    assert mirrors.choose() == 0
+
+
+@pytest.mark.asyncio
+async def test_req_retry_report_throughput():
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=b'x' * 1000)))
+    mirrors = MirrorSelector(['https://a/x', 'https://b/x'])
+    async with client:
+        await req_retry(client, mirrors)
+    assert mirrors.throughput[0] and mirrors.throughput[1] is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('unsupported', [set(), {'reflink', 'copy_file_range', 'sendfile'}])
+async def test_merge_files(tmp_path, monkeypatch, unsupported):
+    monkeypatch.setattr(bilix.utils, '_unsupported_copy', set(unsupported))  # chunked fallback
+    monkeypatch.setattr(bilix.utils, 'COPY_CHUNK_SIZE', 1000)
+    parts = [os.urandom(n) for n in (4096, 0, 12345, 1)]
+    file_list = []
+    for i, data in enumerate(parts):
+        (file := tmp_path / f'part-{i}').write_bytes(data)
+        file_list.append(file)
+    await merge_files(file_list, tmp_path / 'merged')
+    assert (tmp_path / 'merged').read_bytes() == b''.join(parts)
+    assert os.listdir(tmp_path) == ['merged']
+
+
+@pytest.mark.parametrize('platform,error', [('linux', errno.ENOTSOCK), ('linux', errno.EIO), ('darwin', None)])
+def test_append_file_sendfile_fallback(tmp_path, monkeypatch, platform, error):
+    calls = []
+
+    def sendfile(*args):
+        calls.append(args)
+        raise OSError(error or errno.ENOTSOCK, os.strerror(error or errno.ENOTSOCK))
+
+    monkeypatch.setattr(bilix.utils, '_unsupported_copy', {'reflink', 'copy_file_range'})
+    monkeypatch.setattr(bilix.utils.sys, 'platform', platform)
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    data = os.urandom(5000)
+    (tmp_path / 'src').write_bytes(data)
+    (tmp_path / 'dst').write_bytes(b'head')
+    with open(tmp_path / 'dst', 'r+b') as f, open(tmp_path / 'src', 'rb') as src:
+        assert append_file(f, src, 100) == 'chunked'
+    assert (tmp_path / 'dst').read_bytes() == b'head' + data[100:]
+    assert len(calls) == (1 if error else 0)
+
+
+@pytest.mark.parametrize('unsupported', [{'reflink'}, {'reflink', 'copy_file_range'},
+                                         {'reflink', 'copy_file_range', 'sendfile'}])
+def test_append_file_short_src(tmp_path, monkeypatch, unsupported):
+    monkeypatch.setattr(bilix.utils, '_unsupported_copy', set(unsupported))
+    (tmp_path / 'src').write_bytes(os.urandom(5000))
+    (tmp_path / 'dst').write_bytes(b'head')
+    with open(tmp_path / 'dst', 'r+b') as f, open(tmp_path / 'src', 'rb') as src:
+        with pytest.raises(OSError, match='4900 of 6000 bytes'):
+            append_file(f, src, 100, 6000)
+
+
+@pytest.mark.parametrize('supported', [True, False])
+def test_preallocate_file(tmp_path, monkeypatch, supported):
+    if not supported:
+        def posix_fallocate(*args):  # glibc emulation writes the whole file, it should not be used
+            raise AssertionError
+
+        monkeypatch.setattr(bilix.utils, '_fallocate', lambda fd, size: False)
+        monkeypatch.setattr(os, 'posix_fallocate', posix_fallocate, raising=False)
+    path = tmp_path / 'file'
+    path.write_bytes(b'old')
+    preallocate_file(path, 10 * 1024 * 1024)
+    assert path.stat().st_size == 10 * 1024 * 1024
+    if not supported:  # sparse
+        assert path.stat().st_blocks * 512 < 1024 * 1024
+    with open(path, 'rb') as f:
+        assert f.read(3) == bytes(3)